@@ -135,9 +135,60 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
+# Shared by the web server and the celery workers (flight warnings are invalidated by both).
+# The table is created by "python manage.py createcachetable"
+# Holds the flight warnings, the state of every aircraft and the scheduling metrics, a few entries per aircraft
+# and flight plan. Everything in it can be evicted: the coordination of the scheduling runs and the schedules
+# passed between the scheduling tasks are kept in the database (see crm/triggers.py and crm/payloads.py).
+# Once MAX_ENTRIES is reached, 1 / CULL_FREQUENCY of the entries is dropped.
+# "state" holds the values written or read on every telemetry request (crm/telemetry.py), so it does not go through
+# the database: memcached at MEMCACHED_LOCATION (host:port) shared by all the processes, otherwise a memory cache
+# of the process, which is only enough for a single web process (runserver, the tests).
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "crm_cache",
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.environ.get("CACHE_MAX_ENTRIES", 100000)),
+            "CULL_FREQUENCY": int(os.environ.get("CACHE_CULL_FREQUENCY", 10)),
+        },
+    },
+    "state": {
+        "BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+        "LOCATION": os.environ["MEMCACHED_LOCATION"],
+    } if os.environ.get("MEMCACHED_LOCATION") else {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "crm-state",
+    },
+}
+
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+# Number of worker processes used by generate_schedules for the generation attempts
+SCHEDULE_GENERATION_PROCESSES = int(os.environ.get("SCHEDULE_GENERATION_PROCESSES", 1))
+# Where the durations and query counts of the scheduling stages go (crm/metrics.py): comma separated
+# crm.metrics.LogSink, crm.metrics.JsonFileSink (to SCHEDULING_METRICS_FILE), crm.metrics.PrometheusSink (/crm/metrics)
+SCHEDULING_METRICS_SINKS = [
+    sink for sink in os.environ.get("SCHEDULING_METRICS_SINKS", "crm.metrics.LogSink").split(",") if sink
+]
+SCHEDULING_METRICS_FILE = os.environ.get("SCHEDULING_METRICS_FILE", "scheduling-metrics.jsonl")
+# /crm/metrics is served to the staff users and to the scrapers sending "Authorization: Bearer <token>"
+SCHEDULING_METRICS_TOKEN = os.environ.get("SCHEDULING_METRICS_TOKEN", "")
+# Plan changes are rescheduled after this many seconds without other changes (crm/triggers.py),
+# but not later than SCHEDULING_MAX_DELAY seconds after the first one
+SCHEDULING_QUIET_PERIOD = int(os.environ.get("SCHEDULING_QUIET_PERIOD", 30))
+SCHEDULING_MAX_DELAY = int(os.environ.get("SCHEDULING_MAX_DELAY", 300))
+# A scheduling run that has not written its flights after this many seconds is considered dead, the incremental
+# rescheduling no longer falls back to the full regeneration because of it (crm/triggers.py)
+SCHEDULING_RUN_TIMEOUT = int(os.environ.get("SCHEDULING_RUN_TIMEOUT", 3 * CELERY_TASK_TIME_LIMIT))
+# Fuel telemetry (crm/telemetry.py): the readings older than FUEL_READINGS_DOWNSAMPLE_AFTER seconds are reduced to
+# the last one per FUEL_READINGS_BUCKET (minute, hour or day), the ones older than FUEL_READINGS_RETENTION seconds
+# are dropped, both by the periodic crm.tasks.compact_fuel_readings
+FUEL_READINGS_BUCKET = os.environ.get("FUEL_READINGS_BUCKET", "minute")
+FUEL_READINGS_DOWNSAMPLE_AFTER = int(os.environ.get("FUEL_READINGS_DOWNSAMPLE_AFTER", 24 * 60 * 60))
+FUEL_READINGS_RETENTION = int(os.environ.get("FUEL_READINGS_RETENTION", 90 * 24 * 60 * 60))
+
 CELERY_BROKER_URL = (
     "amqp://" + os.environ.get("RABBITMQ_USER", "guest") + ":" + os.environ.get("RABBITMQ_PASS", "guest") + "@" +
     os.environ.get("RABBITMQ_HOST", "rabbitmq") + ":" + os.environ.get("RABBITMQ_PORT", "5672")
@@ -0,0 +1,44 @@
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime
+
+from .models import EmployeeLog
+
+
+class UnavailabilityIndex:
+    # Unavailability periods (EmployeeLog that are not OK) of every employee, loaded for a time window at once.
+    # Overlapping periods of an employee are merged, so the periods are disjoint and sorted both by start and end,
+    # and an overlap query is a binary search. Same semantics as Employee.is_available.
+
+    def __init__(self, periods=()):
+        self._starts = defaultdict(list)  # employee pk -> starts of the merged periods
+        self._ends = defaultdict(list)  # employee pk -> ends of the merged periods
+        by_employee = defaultdict(list)
+        for employee, start, end in periods:
+            if start is not None and end is not None:
+                by_employee[employee].append((start, end))
+        for employee, intervals in by_employee.items():
+            starts, ends = self._starts[employee], self._ends[employee]
+            for start, end in sorted(intervals):
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+
+    @classmethod
+    def load(cls, since: datetime, until: datetime, employees=None):
+        # Periods that overlap [since, until) in a single query, employees - pks to load the periods for (all if None)
+        logs = EmployeeLog.objects.exclude(status=EmployeeLog.OK).filter(disability_end__gte=since,
+                                                                         disability_start__lt=until)
+        if employees is not None:
+            logs = logs.filter(employee__in=employees)
+        return cls(logs.values_list('employee', 'disability_start', 'disability_end'))
+
+    def is_available(self, employee, start_datetime: datetime, end_datetime: datetime) -> bool:
+        # the first period that has not ended before the start is the only one that can overlap
+        ends = self._ends.get(employee)
+        if not ends:
+            return True
+        idx = bisect_left(ends, start_datetime)
+        return idx == len(ends) or self._starts[employee][idx] >= end_datetime
@@ -0,0 +1,202 @@
+import dataclasses
+import json
+import subprocess
+import time
+import tracemalloc
+from contextlib import suppress
+from datetime import date, datetime, time as day_time, timedelta, timezone
+from random import Random
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .crew import ATTENDANT_OCCUPATIONS, PILOT_OCCUPATIONS
+from .models import Aircraft, AircraftDeviceLife, AircraftDynamicInfo, Airport, Employee, Flight, FlightPlan, \
+    Occupation, Runway, ScheduleConfig
+from .tasks import assign_employees, check_flights_compatibility, create_flights, generate_schedules
+
+# names of the occupations the generator creates when there are none (pks as in the fixtures)
+OCCUPATIONS = {1: "Pilot", 2: "Second Pilot", 3: "Senior Flight Attendant", 4: "Flight Attendant"}
+DEVICE_NAMES = ("Engine 1", "Engine 2", "APU", "Landing gear", "Brakes", "Radar")
+
+
+@dataclasses.dataclass(frozen=True)
+class NetworkSize:
+    airports: int = 10
+    aircraft: int = 40
+    devices: int = 4  # per aircraft
+    employees: int = 200
+    plans: int = 40  # round trips from the hub, two plans each
+    days: int = 28
+
+    @property
+    def label(self):
+        return ', '.join(f'{field.name}={getattr(self, field.name)}' for field in dataclasses.fields(self))
+
+
+def generate_network(size: NetworkSize, seed: int, start: date):
+    # Seeded synthetic network: a hub (the first airport) with round trips to the other airports, every aircraft
+    # landed in the hub before start, crew of all the occupations and plans running from start for size.days.
+    # The same size and seed always create the same data (up to pks).
+    rng = Random(seed)
+    for pk, name in OCCUPATIONS.items():
+        Occupation.objects.get_or_create(pk=pk, defaults={'name': name})
+    config = ScheduleConfig.objects.all().first()
+    if config is None:
+        config = ScheduleConfig.objects.create(
+            show_past_flights_time=timedelta(days=7), show_future_flights_time=timedelta(days=30),
+            warning_schedule_delay_time=timedelta(minutes=10), warning_arrival_delay_time=timedelta(minutes=10),
+            warning_arrival_shifted_time=timedelta(minutes=10),
+            min_between_flights_delay_minutes=timedelta(minutes=45), max_flight_generation_attempts=10,
+            flight_generation_timeout=timedelta(minutes=1),
+        )
+
+    airports = Airport.objects.bulk_create([
+        Airport(iata=f'{idx:03d}', icao=f'B{idx:03d}', name=f'Benchmark airport {idx}',
+                latitude=round(rng.uniform(-60, 60), 5), longitude=round(rng.uniform(-90, 90), 5),
+                altitude=rng.randint(0, 2000), timezone='UTC', country='Benchmark', city=f'City {idx}')
+        for idx in range(size.airports)
+    ])
+    Runway.objects.bulk_create([Runway(airport=airport, length=3000, category=0, is_active=True)
+                                for airport in airports])
+    hub = airports[0]
+
+    aircraft = Aircraft.objects.bulk_create([
+        Aircraft(tail_code=f'B-{idx:05d}', aircraft_model='Benchmark', mtow_weight_kg=75000, max_payload_kg=17000,
+                 range_of_flight_km=6000, cargo_volume_m=30, fuel_capacity_kg=24000, takeoff_length_m=1800,
+                 landing_length_m=1200, speed_kmh=800)
+        for idx in range(size.aircraft)
+    ])
+    AircraftDynamicInfo.objects.bulk_create([
+        AircraftDynamicInfo(aircraft=item, economy_class_cap=rng.randint(100, 300), business_class_cap=20,
+                            first_class_cap=0, pilots_number=2, attendants_number=rng.randint(2, 4),
+                            fuel_remaining_kg=20000)
+        for item in aircraft
+    ])
+    now = datetime.combine(start, day_time(), tzinfo=timezone.utc)
+    AircraftDeviceLife.objects.bulk_create([
+        AircraftDeviceLife(aircraft=item, device_name=DEVICE_NAMES[idx % len(DEVICE_NAMES)], latest_update=now,
+                           max_operation_time_h=50000, max_operation_cycles=20000,
+                           total_operation_time_h=rng.randint(0, 40000), total_operation_cycles=rng.randint(0, 15000),
+                           after_service_time_h=rng.randint(0, 500), after_service_cycles=rng.randint(0, 300),
+                           service_time_period_h=1000, service_cycles_period=600)
+        for item in aircraft for idx in range(size.devices)
+    ])
+
+    users = get_user_model().objects.bulk_create([
+        get_user_model()(username=f'benchmark-{seed}-{idx}', password='!') for idx in range(size.employees)
+    ])
+    occupations = PILOT_OCCUPATIONS + ATTENDANT_OCCUPATIONS
+    Employee.objects.bulk_create([Employee(user=user, occupation_id=rng.choice(occupations)) for user in users])
+
+    plans = []
+    for idx in range(size.plans):
+        spoke = airports[1 + idx % (len(airports) - 1)] if len(airports) > 1 else hub
+        departure = rng.randint(6 * 60, 14 * 60)
+        duration = rng.randint(60, 240)
+        days = sorted(rng.sample(range(7), rng.randint(1, 7)))
+        capacity = rng.randint(50, 120)
+        for source, destination, minute in ((hub, spoke, departure),
+                                            (spoke, hub, departure + duration + rng.randint(60, 120))):
+            plans.append(FlightPlan(
+                planning_departure_time=_minute_of_day(minute),
+                planning_arrival_time=_minute_of_day(minute + duration),
+                source=source, destination=destination, flight_code=f'B{seed}-{len(plans)}',
+                passanger_capacity=capacity, days_of_week=[str(day) for day in days], start_date=start,
+                end_date=start + timedelta(days=size.days - 1),
+            ))
+    plans = FlightPlan.objects.bulk_create(plans)
+
+    # every aircraft has landed in the hub by the first flight of a plan that has already ended
+    landed = now - timedelta(days=1)
+    arrival_plan = FlightPlan.objects.create(
+        planning_departure_time=day_time(), planning_arrival_time=day_time(), source=hub, destination=hub,
+        flight_code=f'B{seed}-landed', passanger_capacity=1, days_of_week=['0'], start_date=landed.date(),
+        end_date=landed.date(),
+    )
+    Flight.objects.bulk_create([
+        Flight(flight_plan=arrival_plan, aircraft=item, actual_destination=hub, planning_departure_datetime=landed,
+               planning_arrival_datetime=landed, actual_departure_datetime=landed, actual_arrival_datetime=landed)
+        for item in aircraft
+    ])
+    return config, plans
+
+
+def _minute_of_day(minute: int) -> day_time:
+    minute %= 24 * 60
+    return day_time(minute // 60, minute % 60)
+
+
+@dataclasses.dataclass(frozen=True)
+class StageResult:
+    stage: str
+    seconds: float
+    queries: int
+    peak_memory_kb: int  # Python allocations of this process (tracemalloc), not the database or worker processes
+
+
+def measure(stage: str, function, *args, **kwargs):
+    # (result of the function, StageResult)
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            result = function(*args, **kwargs)
+            seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, StageResult(stage, round(seconds, 4), len(queries), peak // 1024)
+
+
+def run_stages(start_dt: datetime, seed: int = 0) -> list:
+    # The pipeline of regenerate_schedules run in this process, then the compatibility check of the flight board.
+    # Stages after a failed one are not run.
+    results = []
+    data, result = measure('generate_schedules', generate_schedules, start_dt.isoformat(), seed)
+    results.append(result)
+    if data is None:
+        return results
+    data, result = measure('assign_employees', assign_employees, data)
+    results.append(result)
+    if data is None:
+        return results
+    results.append(measure('create_flights', create_flights, data)[1])
+    flights = Flight.objects.filter(planning_departure_datetime__gte=start_dt)
+    results.append(measure('check_flights_compatibility', check_flights_compatibility, flights)[1])
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, size: NetworkSize, seed: int, scheduler: int, results: list):
+    # Results are appended to a JSON lines file, one line per run
+    record = {
+        'commit': current_commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'size': dataclasses.asdict(size),
+        'seed': seed,
+        'scheduler': scheduler,
+        'stages': [dataclasses.asdict(result) for result in results],
+    }
+    with open(path, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    return record
+
+
+def previous_results(path, size: NetworkSize, seed: int, scheduler: int):
+    # The last stored run with the same parameters, None if there is none
+    previous = None
+    with suppress(FileNotFoundError), open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            if (record['size'], record['seed'], record['scheduler']) == (dataclasses.asdict(size), seed, scheduler):
+                previous = record
+    return previous
@@ -0,0 +1,83 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+from django.db.models import Q
+
+from .compatibility import FLIGHT_RELATED
+
+# Flights board: the window flights are paginated by the keyset (planning departure, pk), so a page costs the same
+# wherever it is in the window. The warnings of a flight depend only on the earlier flights of its aircraft (see
+# get_flights_warnings), so only the page and the earlier window flights of the page aircraft are checked.
+PAGE_SIZE = 50
+
+# states a flight can be filtered by
+FLIGHT_STATES = {
+    'scheduled': Q(canceled=False, actual_departure_datetime__isnull=True),
+    'departed': Q(actual_departure_datetime__isnull=False, actual_arrival_datetime__isnull=True),
+    'arrived': Q(actual_arrival_datetime__isnull=False),
+    'canceled': Q(canceled=True),
+}
+
+
+@dataclass
+class FlightsPage:
+    flights: list = field(default_factory=list)
+    previous_cursor: Optional[str] = None
+    next_cursor: Optional[str] = None
+
+
+def encode_cursor(flight) -> str:
+    return f'{flight.planning_departure_datetime.isoformat()},{flight.pk}'
+
+
+def decode_cursor(value: Optional[str]):
+    # (departure, pk) or None if the cursor is missing or malformed
+    try:
+        departure, pk = value.rsplit(',', 1)
+        return datetime.fromisoformat(departure), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def filter_flights(flights, airport=None, aircraft=None, state=None):
+    # airport - departing from or arriving to it, state - one of FLIGHT_STATES
+    if airport is not None:
+        flights = flights.filter(Q(flight_plan__source=airport) | Q(flight_plan__destination=airport))
+    if aircraft is not None:
+        flights = flights.filter(aircraft=aircraft)
+    if state in FLIGHT_STATES:
+        flights = flights.filter(FLIGHT_STATES[state])
+    return flights
+
+
+def flights_page(flights, after: Optional[str] = None, before: Optional[str] = None, size=PAGE_SIZE) -> FlightsPage:
+    # The page of the flights after the cursor (before it if only before is given), the first page without them.
+    # A single query of at most size + 1 rows.
+    flights = flights.select_related(*FLIGHT_RELATED)
+    after, before = decode_cursor(after), decode_cursor(before)
+    if after is None and before is not None:
+        departure, pk = before
+        rows = list(flights.filter(Q(planning_departure_datetime__lt=departure) | Q(
+            planning_departure_datetime=departure, pk__lt=pk
+        )).order_by('-planning_departure_datetime', '-pk')[:size + 1])
+        page = rows[:size][::-1]
+        return FlightsPage(page, encode_cursor(page[0]) if len(rows) > size else None,
+                           encode_cursor(page[-1]) if page else None)
+    if after is not None:
+        departure, pk = after
+        flights = flights.filter(Q(planning_departure_datetime__gt=departure) | Q(
+            planning_departure_datetime=departure, pk__gt=pk
+        ))
+    rows = list(flights.order_by('planning_departure_datetime', 'pk')[:size + 1])
+    page = rows[:size]
+    return FlightsPage(page, encode_cursor(page[0]) if after is not None and page else None,
+                       encode_cursor(page[-1]) if len(rows) > size else None)
+
+
+def checked_flights(window, page: list):
+    # Flights whose compatibility determines the page: the window flights of the page aircraft up to the page end
+    if not page:
+        return window.none()
+    return window.filter(aircraft__in={flight.aircraft_id for flight in page},
+                         planning_departure_datetime__lte=page[-1].planning_departure_datetime)
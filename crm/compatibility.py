@@ -0,0 +1,118 @@
+import hashlib
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .availability import UnavailabilityIndex
+from .forecast import DeviceLifeForecast
+from .models import Flight
+
+# related objects the compatibility checks and the flight tables read
+FLIGHT_RELATED = ('flight_plan__source', 'flight_plan__destination', 'aircraft', 'actual_destination')
+
+# bumped on every change of the compatibility inputs, cached warnings of the older versions are never read again
+WARNINGS_VERSION_KEY = 'crm:flight-warnings:version'
+
+
+def invalidate_warnings():
+    # after the commit, otherwise a board view running in between would cache the old data under the new version
+    transaction.on_commit(_bump_warnings_version)
+
+
+def _bump_warnings_version():
+    try:
+        cache.incr(WARNINGS_VERSION_KEY)
+    except ValueError:
+        cache.set(WARNINGS_VERSION_KEY, 1, None)
+
+
+def _warnings_key(flights: list) -> str:
+    # Warnings of a flight depend on the other flights checked with it (device usage is predicted over
+    # all of them), so the cached warnings are keyed by the whole checked set
+    version = cache.get_or_set(WARNINGS_VERSION_KEY, 0, None)
+    digest = hashlib.md5(','.join(str(flight.pk) for flight in flights).encode()).hexdigest()
+    return f'crm:flight-warnings:{version}:{digest}'
+
+
+def get_cached_warnings(flights: list, now):
+    # flight pk -> the warning that does not depend on time (None - only time-based warnings apply),
+    # None if nothing is cached or it has expired
+    key = _warnings_key(flights)
+    cached = cache.get(key)
+    if cached is None or (cached['expires'] is not None and cached['expires'] <= now):
+        return key, None
+    return key, cached['warnings']
+
+
+def set_cached_warnings(key: str, warnings: dict, expires=None):
+    # expires - the moment after which some of the warnings may change without any change in the database
+    cache.set(key, {'warnings': warnings, 'expires': expires})
+
+
+class CompatibilityData:
+    # Everything check_flights_compatibility reads about a window of flights, prefetched in a constant number of
+    # queries: device life of the aircraft, unavailability of the crew and the flights preceding the window ones.
+
+    def __init__(self, flights: list, forecast: DeviceLifeForecast, crew: dict, unavailable: UnavailabilityIndex,
+                 previous: dict):
+        self.flights = flights  # window flights ordered by departure
+        self.forecast = forecast  # moved by the window flights as they are checked
+        self._crew = crew  # flight pk -> employee pks
+        self._unavailable = unavailable
+        self._previous = previous  # aircraft pk -> non-canceled flights ordered by planning arrival, latest first
+
+    @classmethod
+    def load(cls, flight_query_set):
+        return cls.prefetch(list(flight_query_set.select_related(*FLIGHT_RELATED)
+                                 .order_by('planning_departure_datetime')))
+
+    @classmethod
+    def prefetch(cls, flights: list):
+        # flights - ordered by departure, with FLIGHT_RELATED selected
+        if not flights:
+            return cls(flights, DeviceLifeForecast(), {}, UnavailabilityIndex(), {})
+        aircraft = {flight.aircraft_id for flight in flights}
+        window_start = flights[0].planning_departure_datetime
+        window_end = max(flight.planning_arrival_datetime for flight in flights)
+
+        forecast = DeviceLifeForecast.load(aircraft)
+
+        crew = defaultdict(set)
+        for flight, employee in Flight.employees.through.objects.filter(
+                flight__in=[flight.pk for flight in flights]).values_list('flight', 'employee'):
+            crew[flight].add(employee)
+
+        unavailable = UnavailabilityIndex.load(window_start, window_end,
+                                               {employee for employees in crew.values() for employee in employees})
+
+        # Flights of the window are previous flights for each other. Flights outside of it are used as previous
+        # only if they are departed: the departed ones in the window time and the latest one before the window.
+        window_pks = {flight.pk for flight in flights}
+        departed = Flight.objects.filter(aircraft__in=aircraft, canceled=False,
+                                         actual_departure_datetime__isnull=False)
+        outside = list(departed.filter(
+            planning_departure_datetime__gte=window_start, planning_departure_datetime__lt=window_end
+        ).exclude(pk__in=window_pks).select_related(*FLIGHT_RELATED))
+        outside += departed.filter(planning_departure_datetime__lt=window_start).order_by(
+            'aircraft', '-planning_arrival_datetime'
+        ).distinct('aircraft').select_related(*FLIGHT_RELATED)
+        previous = defaultdict(list)
+        for flight in [flight for flight in flights if not flight.canceled] + outside:
+            previous[flight.aircraft_id].append(flight)
+        for candidates in previous.values():
+            candidates.sort(key=lambda flight: flight.planning_arrival_datetime, reverse=True)
+        return cls(flights, forecast, crew, unavailable, previous)
+
+    def crew_available(self, flight: Flight) -> bool:
+        return all(
+            self._unavailable.is_available(employee, flight.planning_departure_datetime,
+                                           flight.planning_arrival_datetime)
+            for employee in self._crew.get(flight.pk, ())
+        )
+
+    def previous_candidates(self, flight: Flight):
+        # Same order as get_previous_flight: departed before the flight, the latest arrival first
+        for candidate in self._previous.get(flight.aircraft_id, ()):
+            if candidate.planning_departure_datetime < flight.planning_departure_datetime:
+                yield candidate
@@ -0,0 +1,92 @@
+import heapq
+from collections import defaultdict
+from datetime import datetime
+
+from .availability import UnavailabilityIndex
+from .models import ScheduleConfig
+
+# Occupation ID:
+# pilot = 1, second pilot = 2
+PILOT_OCCUPATIONS = (1, 2)
+# senior attendant = 3, attendant = 4
+ATTENDANT_OCCUPATIONS = (3, 4)
+
+# if current location of an employee is unknown, we assume he is in LED
+# (unless ScheduleConfig.crew_home_base is set, see crew_home_base)
+DEFAULT_CREW_LOCATION = 1
+
+
+def crew_home_base(config: ScheduleConfig = None):
+    # airport pk where the employees without flights are
+    if config is not None and config.crew_home_base_id is not None:
+        return config.crew_home_base_id
+    return DEFAULT_CREW_LOCATION
+
+
+class CrewQueues:
+    # Crew members in the airports, per airport and role (PILOT_OCCUPATIONS or ATTENDANT_OCCUPATIONS):
+    # a heap of (ready at, employee pk) of those who are still busy after their last flight and a heap of pks
+    # of those who are ready. A flight takes the ready employees with the lowest pks without looking at the rest.
+    # Flights have to be taken in the order of departure, once ready an employee stays ready.
+
+    def __init__(self, occupations: dict):
+        self.occupations = occupations  # employee pk -> occupation pk
+        self._waiting = defaultdict(list)  # (airport pk, role) -> heap of (ready at, employee pk)
+        self._ready = defaultdict(list)  # (airport pk, role) -> heap of employee pks
+
+    @classmethod
+    def start(cls, occupations: dict, locations: dict, start_dt: datetime):
+        # locations: employee pk -> airport pk, everybody is ready at start_dt
+        queues = cls(occupations)
+        for employee, airport in locations.items():
+            queues.add(employee, airport, start_dt)
+        return queues
+
+    def role(self, employee):
+        occupation = self.occupations.get(employee)
+        for role in (PILOT_OCCUPATIONS, ATTENDANT_OCCUPATIONS):
+            if occupation in role:
+                return role
+        return None
+
+    def add(self, employee, airport, ready_at: datetime):
+        role = self.role(employee)
+        if role is not None:
+            heapq.heappush(self._waiting[airport, role], (ready_at, employee))
+
+    def take(self, role, airport, departure: datetime, arrival: datetime, count: int,
+             unavailable: UnavailabilityIndex = None) -> list:
+        # Up to count employees of the role that are in the airport at departure and available until arrival.
+        # They are removed from the queues, the caller adds them to the destination.
+        waiting, ready = self._waiting[airport, role], self._ready[airport, role]
+        while waiting and waiting[0][0] <= departure:
+            heapq.heappush(ready, heapq.heappop(waiting)[1])
+        taken, skipped = [], []
+        while ready and len(taken) < count:
+            employee = heapq.heappop(ready)
+            if unavailable is None or unavailable.is_available(employee, departure, arrival):
+                taken.append(employee)
+            else:
+                skipped.append(employee)
+        for employee in skipped:
+            heapq.heappush(ready, employee)
+        return taken
+
+
+def assign_crew(flights, queues: CrewQueues, routes: dict, crew_numbers: dict,
+                unavailable: UnavailabilityIndex = None) -> list:
+    # flights: [(departure, arrival, aircraft pk, plan pk)] ordered by departure
+    # routes: plan pk -> (source pk, destination pk), crew_numbers: aircraft pk -> (pilots, attendants)
+    # Returns [(departure, arrival, aircraft pk, plan pk, crew pks)]
+    variant = []
+    for (departure_time, arrival_time, aircraft_id, plan_id) in flights:
+        source, destination = routes[plan_id]
+        pilots_number, attendants_number = crew_numbers[aircraft_id]
+        # the flight gets as many employees as there are, up to the numbers required by the aircraft
+        crew = queues.take(PILOT_OCCUPATIONS, source, departure_time, arrival_time, pilots_number, unavailable)
+        crew += queues.take(ATTENDANT_OCCUPATIONS, source, departure_time, arrival_time, attendants_number,
+                            unavailable)
+        for employee in crew:
+            queues.add(employee, destination, arrival_time)
+        variant.append((departure_time, arrival_time, aircraft_id, plan_id, crew))
+    return variant
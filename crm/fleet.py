@@ -0,0 +1,57 @@
+import hashlib
+import json
+
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import AircraftDynamicInfo
+from .telemetry import STATE_CACHE, latest_fuel_key, latest_fuel_many
+
+# Dynamic state of the aircraft polled by the dashboards, read through the "state" cache: the cabin capacities and
+# the crew requirements of AircraftDynamicInfo (invalidated by its signals, see crm/signals.py) and the latest fuel
+# reading (kept up to date by crm/telemetry.py). The cache does not go through the database, so a warm read of the
+# whole fleet makes no database queries.
+STATE_KEY = 'crm:aircraft-state'
+# aircraft with the dynamic info
+FLEET_KEY = 'crm:aircraft-state:fleet'
+# bounds the staleness when a read races with the invalidation
+STATE_TIMEOUT = 5 * 60
+STATE_FIELDS = ('economy_class_cap', 'business_class_cap', 'first_class_cap', 'pilots_number', 'attendants_number')
+
+
+def _state_key(aircraft) -> str:
+    return f'{STATE_KEY}:{aircraft}'
+
+
+def invalidate_aircraft_state(aircraft):
+    # after the commit, otherwise a read running in between would cache the old state again
+    transaction.on_commit(lambda: caches[STATE_CACHE].delete_many([
+        _state_key(aircraft), latest_fuel_key(aircraft), FLEET_KEY
+    ]))
+
+
+def aircraft_states(aircraft=None) -> dict:
+    # {aircraft pk: state} of the aircraft with the dynamic info among the aircraft pks (all if None)
+    cache = caches[STATE_CACHE]
+    if aircraft is None:
+        aircraft = cache.get(FLEET_KEY)
+        if aircraft is None:
+            aircraft = list(AircraftDynamicInfo.objects.order_by('aircraft').values_list('aircraft', flat=True))
+            cache.set(FLEET_KEY, aircraft, STATE_TIMEOUT)
+    keys = {pk: _state_key(pk) for pk in aircraft}
+    cached = cache.get_many(keys.values())
+    states = {pk: cached[key] for pk, key in keys.items() if key in cached}
+    missing = [pk for pk in keys if pk not in states]
+    if missing:
+        loaded = {pk: dict(zip(STATE_FIELDS, values)) for pk, *values in AircraftDynamicInfo.objects.filter(
+            aircraft__in=missing).values_list('aircraft', *STATE_FIELDS)}
+        cache.set_many({keys[pk]: state for pk, state in loaded.items()}, STATE_TIMEOUT)
+        states.update(loaded)
+    fuel = latest_fuel_many(states)
+    return {pk: {**states[pk], 'fuel_remaining_kg': fuel[pk][1], 'fuel_recorded': fuel[pk][0]}
+            for pk in keys if pk in states}
+
+
+def state_etag(data) -> str:
+    # quoted ETag of the JSON data of a response
+    return '"%s"' % hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
@@ -0,0 +1,55 @@
+import math
+from datetime import datetime
+
+from .models import AircraftDeviceLife
+
+DEVICE_LIFE_FIELDS = ('aircraft', 'max_operation_time_h', 'total_operation_time_h', 'service_time_period_h',
+                      'after_service_time_h', 'max_operation_cycles', 'total_operation_cycles',
+                      'service_cycles_period', 'after_service_cycles')
+
+
+def flight_hours(departure: datetime, arrival: datetime) -> int:
+    # operation hours a flight adds to the devices, started hours count
+    return math.ceil((arrival - departure).total_seconds() / 3600)
+
+
+class DeviceLifeForecast:
+    # Remaining life of the devices of every aircraft, predicted over the planned flights.
+    # Every flight adds the same hours and one cycle to all the devices of its aircraft, so whether any of them
+    # crosses a limit depends only on the device closest to it: per aircraft only the minimum of the remaining
+    # hours and the minimum of the remaining cycles (to the end of life or to the service, whichever is earlier)
+    # are kept, and a flight is checked and applied in O(1) regardless of the number of devices.
+
+    def __init__(self, devices=()):
+        # devices: rows of DEVICE_LIFE_FIELDS
+        self._hours = {}  # aircraft pk -> remaining hours of its device closest to a limit
+        self._cycles = {}  # aircraft pk -> remaining cycles of its device closest to a limit
+        for aircraft, max_h, total_h, period_h, after_h, max_cycles, total_cycles, period_cycles, after_cycles \
+                in devices:
+            hours = min(max_h - total_h, period_h - after_h)
+            cycles = min(max_cycles - total_cycles, period_cycles - after_cycles)
+            self._hours[aircraft] = min(hours, self._hours.get(aircraft, hours))
+            self._cycles[aircraft] = min(cycles, self._cycles.get(aircraft, cycles))
+
+    @classmethod
+    def load(cls, aircraft=None):
+        # a single query, aircraft - pks to load the devices for (all if None)
+        devices = AircraftDeviceLife.objects.all()
+        if aircraft is not None:
+            devices = devices.filter(aircraft__in=aircraft)
+        return cls(devices.values_list(*DEVICE_LIFE_FIELDS))
+
+    def fits(self, aircraft, hours: int) -> bool:
+        # whether all the devices of the aircraft can make one more flight of the hours
+        if aircraft not in self._hours:
+            return True
+        return self._hours[aircraft] >= hours and self._cycles[aircraft] >= 1
+
+    def fly(self, aircraft, hours: int) -> bool:
+        # Applies the flight if it fits, a flight that does not fit is not made and changes nothing
+        if not self.fits(aircraft, hours):
+            return False
+        if aircraft in self._hours:
+            self._hours[aircraft] -= hours
+            self._cycles[aircraft] -= 1
+        return True
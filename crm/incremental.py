@@ -0,0 +1,168 @@
+import dataclasses
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+
+from .availability import UnavailabilityIndex
+from .compatibility import invalidate_warnings
+from .crew import ATTENDANT_OCCUPATIONS, PILOT_OCCUPATIONS, crew_home_base
+from .models import Employee, Flight, FlightPlan, ScheduleConfig
+from .snapshot import SchedulingSnapshot
+from .timeline import FleetTimeline, TimelineFlight
+from .triggers import finish_run, is_superseded
+from .writer import insert_flights
+
+
+@dataclasses.dataclass
+class Reschedule:
+    removed: set = dataclasses.field(default_factory=set)  # pks of the deleted flights of the changed plan
+    moved: dict = dataclasses.field(default_factory=dict)  # flight pk -> new aircraft pk
+    created: list = dataclasses.field(default_factory=list)  # (departure, arrival, aircraft pk, plan pk, crew)
+    crew_added: dict = dataclasses.field(default_factory=lambda: defaultdict(set))  # flight pk -> employee pks
+    crew_removed: dict = dataclasses.field(default_factory=lambda: defaultdict(set))  # flight pk -> employee pks
+
+
+def release_flights(timeline: FleetTimeline, flights, movable: set) -> list:
+    # Removes the flights from the timeline, then removes one by one the movable flights that became invalid
+    # because of it (the broken part of a rotation). Returns the removed invalid flights.
+    affected, released = set(), []
+    for flight in flights:
+        timeline.remove_flight(flight)
+        affected.add(flight.aircraft)
+    while affected:
+        resource = affected.pop()
+        invalid = [flight for flight in timeline.invalid_flights(resource) if flight.key in movable]
+        if invalid:
+            timeline.remove_flight(invalid[0])
+            released.append(invalid[0])
+            affected.add(resource)
+    return released
+
+
+class IncrementalScheduler:
+    # Re-plans a single changed flight plan. Its future flights are removed from the fleet and crew timelines,
+    # flights of the rotations broken by the removal are released, and then the new occurrences of the plan
+    # and the released flights are placed into the gaps of the timelines. Other flights stay in place.
+
+    def __init__(self, snapshot: SchedulingSnapshot, crew: FleetTimeline, occupations: dict, flights: dict,
+                 unavailable: UnavailabilityIndex = None):
+        self.snapshot = snapshot
+        self.fleet = snapshot.timeline
+        self.crew = crew
+        self.occupations = occupations  # employee pk -> occupation pk
+        self.flights = flights  # movable flight pk -> (plan pk, crew pks)
+        self.unavailable = unavailable or UnavailabilityIndex()
+
+    @classmethod
+    def load(cls, start_dt: datetime, config: ScheduleConfig):
+        service_time = config.min_between_flights_delay_minutes
+        # unlike generate_schedules, flights after start_dt are kept, so the timeline has all of them
+        snapshot = SchedulingSnapshot.load(start_dt, config, timeline=FleetTimeline.load(service_time=service_time))
+        crew = FleetTimeline.load_crew(start_dt, crew_home_base(config), service_time=service_time)
+        movable = Flight.objects.filter(canceled=False, actual_departure_datetime__isnull=True,
+                                        planning_departure_datetime__gte=start_dt)
+        flights = {pk: (plan_pk, set()) for pk, plan_pk in movable.values_list('pk', 'flight_plan')}
+        for pk, employee in Flight.employees.through.objects.filter(flight__in=movable).values_list(
+                'flight', 'employee'):
+            flights[pk][1].add(employee)
+        # the last occurrences of the plans may arrive the day after their end date
+        last_day = max((plan.end_date for plan in snapshot.plans.values()), default=start_dt.date())
+        unavailable = UnavailabilityIndex.load(start_dt, datetime.combine(last_day, time(), start_dt.tzinfo) +
+                                               timedelta(days=2))
+        return cls(snapshot, crew, dict(Employee.objects.values_list('pk', 'occupation')), flights, unavailable)
+
+    def reschedule(self, plan: FlightPlan, occurrences):
+        # occurrences: [(departure, arrival, plan pk)] of the changed plan, banned flights excluded.
+        # Returns (Reschedule, None) or (None, [plan pk, error text]) like generate_single_schedule.
+        result = Reschedule()
+        movable = set(self.flights)
+        result.removed = {pk for pk, (plan_pk, _) in self.flights.items() if plan_pk == plan.pk}
+
+        fleet_flights = self._timeline_flights(self.fleet, result.removed)
+        released = release_flights(self.fleet, fleet_flights, movable)
+        crew_flights = self._timeline_flights(self.crew, result.removed)
+        for flight in release_flights(self.crew, crew_flights, movable - result.removed):
+            result.crew_removed[flight.key].add(flight.aircraft)
+
+        # (departure, arrival, plan pk, flight pk or None for the new flights, aircraft pk or None to choose)
+        work = [(departure, arrival, plan_pk, None, None) for departure, arrival, plan_pk in occurrences]
+        work += [(f.departure, f.arrival, self.flights[f.key][0], f.key, None) for f in released]
+        released_keys = {f.key for f in released}
+        for flight in self._timeline_flights(self.fleet, set(result.crew_removed) - released_keys):
+            work.append((flight.departure, flight.arrival, self.flights[flight.key][0], flight.key, flight.aircraft))
+
+        for departure, arrival, plan_pk, pk, aircraft in sorted(work, key=lambda item: item[0]):
+            plan_info = self.snapshot.plans[plan_pk]
+            if aircraft is None:
+                fitting = {
+                    craft for craft in self.fleet.aircraft() if self.fleet.fits(
+                        TimelineFlight(departure, arrival, craft, plan_info.source_id, plan_info.destination_id))
+                }
+                candidates = self.snapshot.aircraft_with_capacity(plan_info.passanger_capacity, among=fitting)
+                if not candidates:
+                    return None, [plan.pk, f"Cannot reschedule flight by plan {plan_pk} with departure: {departure}. "
+                                           f"There is no aircraft that fits into the current schedule."]
+                aircraft = candidates[0]
+                self.fleet.add_flight(TimelineFlight(departure, arrival, aircraft, plan_info.source_id,
+                                                     plan_info.destination_id, pk))
+                if pk is not None:
+                    result.moved[pk] = aircraft
+
+            crew = set() if pk is None else self.flights[pk][1] - result.crew_removed[pk]
+            added = self._choose_crew(departure, arrival, plan_info, aircraft, crew, pk)
+            if added is None:
+                return None, [plan.pk, f"Cannot reschedule flight by plan {plan_pk} with departure: {departure}. "
+                                       f"There is no available crew."]
+            if pk is None:
+                result.created.append((departure, arrival, aircraft, plan_pk, sorted(added)))
+            elif added:
+                result.crew_added[pk] |= added
+        return result, None
+
+    def _choose_crew(self, departure, arrival, plan: FlightPlan, aircraft, crew: set, pk):
+        # Adds employees to the crew until the aircraft requirements are met, returns the added ones
+        info = self.snapshot.aircraft[aircraft]
+        added = set()
+        for occupations, required in ((PILOT_OCCUPATIONS, info.pilots_number),
+                                      (ATTENDANT_OCCUPATIONS, info.attendants_number)):
+            missing = required - sum(1 for e in crew if self.occupations.get(e) in occupations)
+            for employee in sorted(self.crew.aircraft()):
+                if missing <= 0:
+                    break
+                if self.occupations.get(employee) not in occupations or employee in crew:
+                    continue
+                flight = TimelineFlight(departure, arrival, employee, plan.source_id, plan.destination_id, pk)
+                if self.crew.fits(flight) and self.unavailable.is_available(employee, departure, arrival):
+                    self.crew.add_flight(flight)
+                    added.add(employee)
+                    missing -= 1
+            if missing > 0:
+                return None
+        return added
+
+    @staticmethod
+    def _timeline_flights(timeline: FleetTimeline, keys: set) -> list:
+        return [flight for resource in timeline.aircraft() for flight in timeline.flights(resource)
+                if flight.key in keys]
+
+    @staticmethod
+    @transaction.atomic
+    def write(result: Reschedule, run: str = None) -> bool:
+        # nothing is written if the run is superseded (see crm/triggers.py)
+        if is_superseded(run, lock=True):
+            return False
+        Flight.objects.filter(pk__in=result.removed).delete()
+        Flight.objects.bulk_update([Flight(pk=pk, aircraft_id=aircraft) for pk, aircraft in result.moved.items()],
+                                   ['aircraft'])
+        through = Flight.employees.through
+        for pk, employees in result.crew_removed.items():
+            through.objects.filter(flight_id=pk, employee_id__in=employees).delete()
+        through.objects.bulk_create([
+            through(flight_id=pk, employee_id=employee)
+            for pk, employees in result.crew_added.items() for employee in employees
+        ])
+        insert_flights(result.created)
+        invalidate_warnings()
+        finish_run(run)
+        return True
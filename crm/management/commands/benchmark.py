@@ -0,0 +1,54 @@
+import dataclasses
+from datetime import date, datetime, timezone
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from crm.benchmark import NetworkSize, generate_network, previous_results, run_stages, save_results
+from crm.models import ScheduleConfig
+
+
+class Command(BaseCommand):
+    help = ("Generates a synthetic network in a throwaway test database and measures wall time, queries and peak "
+            "memory of every stage of the schedule generation. Results are appended to a JSON lines file and "
+            "compared with the last stored run with the same parameters.")
+
+    def add_arguments(self, parser):
+        for field in dataclasses.fields(NetworkSize):
+            parser.add_argument(f'--{field.name}', type=int, default=field.default)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--start', type=date.fromisoformat, default=date(2021, 5, 3),
+                            help="First day of the plans, YYYY-MM-DD")
+        parser.add_argument('--scheduler', type=int, default=ScheduleConfig.RANDOM_SCHEDULER,
+                            choices=[value for value, name in ScheduleConfig.SCHEDULER_CHOICES])
+        parser.add_argument('--output', default='benchmark-results.jsonl', help="JSON lines file with the results")
+        parser.add_argument('--no-save', action='store_true', help="Do not store the results")
+
+    def handle(self, *args, **options):
+        size = NetworkSize(**{field.name: options[field.name] for field in dataclasses.fields(NetworkSize)})
+        seed, scheduler = options['seed'], options['scheduler']
+        # the benchmark creates and changes a lot of data, so it never runs in the real database
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            config, plans = generate_network(size, seed, options['start'])
+            ScheduleConfig.objects.filter(pk=config.pk).update(scheduler=scheduler)
+            self.stdout.write(f"{size.label}, seed={seed}: {len(plans)} plans")
+            results = run_stages(datetime.combine(options['start'], datetime.min.time(), tzinfo=timezone.utc), seed)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        previous = previous_results(options['output'], size, seed, scheduler)
+        previous_stages = {stage['stage']: stage for stage in previous['stages']} if previous else {}
+        self.stdout.write(f"{'stage':<30}{'seconds':>12}{'queries':>10}{'peak KiB':>12}")
+        for result in results:
+            line = f"{result.stage:<30}{result.seconds:>12.3f}{result.queries:>10}{result.peak_memory_kb:>12}"
+            before = previous_stages.get(result.stage)
+            if before is not None:
+                line += (f"   was {before['seconds']:.3f} s, {before['queries']} queries, "
+                         f"{before['peak_memory_kb']} KiB ({previous['commit']})")
+            self.stdout.write(line)
+        if len(results) < 4:
+            self.stdout.write(self.style.WARNING(f"{results[-1].stage} failed, the next stages were not run"))
+        if not options['no_save']:
+            save_results(options['output'], size, seed, scheduler, results)
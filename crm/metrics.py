@@ -0,0 +1,152 @@
+import dataclasses
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import StageCounter
+
+logger = get_task_logger(__name__)
+
+# counters of PrometheusSink: metric name -> (StageMetrics field, multiplier to keep them integer, help)
+COUNTERS = {
+    'crm_stage_runs_total': (None, 1, "Finished runs of the stage"),
+    'crm_stage_seconds_total': ('seconds', 1000, "Wall time of the stage"),
+    'crm_stage_queries_total': ('queries', 1, "SQL queries made by the stage"),
+    'crm_stage_query_seconds_total': ('query_seconds', 1000, "Time of the SQL queries of the stage"),
+    'crm_stage_rows_total': ('rows', 1, "Rows (flights, variants) processed by the stage"),
+    'crm_stage_attempts_total': ('attempts', 1, "Schedule generation attempts"),
+    'crm_stage_successful_attempts_total': ('successes', 1, "Successful schedule generation attempts"),
+    'crm_stage_failures_total': ('failed', 1, "Runs of the stage that raised"),
+}
+
+
+@dataclasses.dataclass
+class StageMetrics:
+    stage: str
+    seconds: float = 0
+    queries: int = 0
+    query_seconds: float = 0
+    rows: Optional[int] = None
+    attempts: Optional[int] = None
+    successes: Optional[int] = None
+    # the block has raised
+    failed: bool = False
+
+    def as_dict(self):
+        return {key: round(value, 6) if isinstance(value, float) else value
+                for key, value in dataclasses.asdict(self).items()}
+
+
+class LogSink:
+    def emit(self, metrics: StageMetrics):
+        logger.info(' '.join(f'{key}={value}' for key, value in metrics.as_dict().items() if value is not None))
+
+
+class JsonFileSink:
+    # One JSON line per finished stage
+    def __init__(self, path=None):
+        self.path = path or settings.SCHEDULING_METRICS_FILE
+
+    def emit(self, metrics: StageMetrics):
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(metrics.as_dict()) + '\n')
+
+
+class PrometheusSink:
+    # StageCounter rows shared by all the processes, so the web process can expose the metrics of the workers
+    # (see prometheus_text). All the counters of a stage are added by a single atomic upsert.
+    def emit(self, metrics: StageMetrics):
+        counters = []
+        for name, (field, multiplier, _) in COUNTERS.items():
+            value = 1 if field is None else getattr(metrics, field)
+            if value is not None:
+                counters += [metrics.stage, name, round(value * multiplier)]
+        table = StageCounter._meta.db_table
+        rows = ', '.join(['(%s, %s, %s)'] * (len(counters) // 3))
+        with connection.cursor() as cursor:
+            cursor.execute(f'INSERT INTO {table} (stage, name, value) VALUES {rows} '
+                           f'ON CONFLICT (stage, name) DO UPDATE SET value = {table}.value + EXCLUDED.value', counters)
+
+
+def prometheus_text() -> str:
+    # Counters of PrometheusSink in the Prometheus text exposition format
+    values = {(name, stage): value for stage, name, value in StageCounter.objects.order_by('stage')
+              .values_list('stage', 'name', 'value')}
+    lines = []
+    for name, (_, multiplier, help_text) in COUNTERS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for (counter, stage), value in values.items():
+            if counter == name:
+                lines.append(f'{name}{{stage="{stage}"}} {value / multiplier:g}')
+    return '\n'.join(lines) + '\n'
+
+
+_sinks = None
+# the queries of the sinks are not counted in the stages around them
+_sink_io = threading.local()
+
+
+@receiver(setting_changed)
+def _reset_sinks(setting, **kwargs):
+    global _sinks
+    if setting in ('SCHEDULING_METRICS_SINKS', 'SCHEDULING_METRICS_FILE'):
+        _sinks = None
+
+
+def get_sinks() -> list:
+    # Sinks from settings.SCHEDULING_METRICS_SINKS (dotted paths of classes with emit(metrics)), created once
+    global _sinks
+    if _sinks is None:
+        _sinks = [import_string(path)() for path in settings.SCHEDULING_METRICS_SINKS]
+    return _sinks
+
+
+def emit(metrics: StageMetrics):
+    _sink_io.active = True
+    try:
+        for sink in get_sinks():
+            try:
+                sink.emit(metrics)
+            except Exception:
+                # metrics must never break the scheduling
+                logger.exception(f"Metrics sink {sink.__class__.__name__} failed")
+    finally:
+        _sink_io.active = False
+
+
+@contextmanager
+def stage(name: str):
+    # Measures the block: wall time and the number and time of the SQL queries of this process.
+    # The block may set rows, attempts and successes of the yielded StageMetrics. Stages may be nested.
+    # A block that raises is recorded as failed.
+    metrics = StageMetrics(name)
+
+    def count_query(execute, sql, params, many, context):
+        if getattr(_sink_io, 'active', False):
+            return execute(sql, params, many, context)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            metrics.queries += 1
+            metrics.query_seconds += time.perf_counter() - started
+
+    started = time.perf_counter()
+    try:
+        with connection.execute_wrapper(count_query):
+            yield metrics
+    except Exception:
+        metrics.failed = True
+        raise
+    finally:
+        metrics.seconds = time.perf_counter() - started
+        emit(metrics)
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0008_alter_employeelog_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='max_successful_schedules',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0009_scheduleconfig_max_successful_schedules'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='crew_home_base',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='crm.airport'),
+        ),
+    ]
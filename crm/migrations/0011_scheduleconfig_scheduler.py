@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0010_scheduleconfig_crew_home_base'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduleconfig',
+            name='scheduler',
+            field=models.SmallIntegerField(choices=[(0, 'Random attempts'), (1, 'Matching of aircraft rotations')], default=0),
+        ),
+    ]
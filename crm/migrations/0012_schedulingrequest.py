@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0011_scheduleconfig_scheduler'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulingRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_dt', models.DateTimeField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('flight_plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='crm.flightplan')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0012_schedulingrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FuelReading',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recorded', models.DateTimeField()),
+                ('fuel_kg', models.PositiveIntegerField()),
+                ('aircraft', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='crm.aircraft')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='fuelreading',
+            index=models.Index(fields=['aircraft', '-recorded'], name='crm_fuelrea_aircraf_22929c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fuelreading',
+            index=models.Index(fields=['recorded'], name='crm_fuelrea_recorde_212ea1_idx'),
+        ),
+    ]
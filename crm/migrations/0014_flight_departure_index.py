@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0013_fuelreading'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='flight',
+            index=models.Index(fields=['planning_departure_datetime', 'id'], name='crm_flight_plannin_a533f0_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0014_flight_departure_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulingRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=32, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('merged', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShardResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('handle', models.JSONField()),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='crm.schedulingrun')),
+            ],
+            options={
+                'unique_together': {('run', 'index')},
+            },
+        ),
+    ]
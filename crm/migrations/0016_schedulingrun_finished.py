@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0015_schedulingrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedulingrun',
+            name='finished',
+            field=models.BooleanField(default=False),
+        ),
+    ]
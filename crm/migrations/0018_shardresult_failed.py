@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0017_schedulespayload'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='shardresult',
+            name='handle',
+            field=models.JSONField(null=True),
+        ),
+    ]
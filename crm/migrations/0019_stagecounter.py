@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0018_shardresult_failed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StageCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=64)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('stage', 'name')},
+            },
+        ),
+    ]
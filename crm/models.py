@@ -5,10 +5,17 @@ from django.urls import reverse
 from django.utils.timezone import make_aware
 from timezone_field import TimeZoneField
 from multiselectfield import MultiSelectField
-from django.db.models import Q
+from django.db.models import Case, F, OuterRef, Q, Subquery, Value, When
+from django.dispatch import Signal
 
 
 class ScheduleConfig(models.Model):
+    RANDOM_SCHEDULER = 0
+    FLOW_SCHEDULER = 1
+    SCHEDULER_CHOICES = (
+        (RANDOM_SCHEDULER, "Random attempts"),
+        (FLOW_SCHEDULER, "Matching of aircraft rotations"),
+    )
     show_past_flights_time = models.DurationField()
     show_future_flights_time = models.DurationField()
 
@@ -18,7 +25,11 @@ class ScheduleConfig(models.Model):
 
     min_between_flights_delay_minutes = models.DurationField()
     max_flight_generation_attempts = models.PositiveSmallIntegerField()
+    max_successful_schedules = models.PositiveSmallIntegerField(default=0)  # 0 - run all the attempts
     flight_generation_timeout = models.DurationField()
+    scheduler = models.SmallIntegerField(choices=SCHEDULER_CHOICES, default=RANDOM_SCHEDULER)
+    # where the employees without flights are, LED if not set
+    crew_home_base = models.ForeignKey('Airport', blank=True, null=True, on_delete=models.SET_NULL)
 
 
 class Airport(models.Model):
@@ -98,6 +109,50 @@ class FlightPlan(models.Model):
         return f"flight plan {self.flight_code}"
 
 
+class SchedulingRequest(models.Model):
+    # A plan change waiting for the debounced rescheduling (see crm/triggers.py)
+    flight_plan = models.ForeignKey(FlightPlan, on_delete=models.CASCADE)
+    start_dt = models.DateTimeField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class SchedulingRun(models.Model):
+    # Token of a full regeneration or an incremental rescheduling, only the latest one writes its flights
+    # (see crm/triggers.py)
+    token = models.CharField(max_length=32, unique=True)
+    created = models.DateTimeField(auto_now_add=True)
+    # the finished shards have been merged (see crm/sharding.py)
+    merged = models.BooleanField(default=False)
+    # the flights have been written
+    finished = models.BooleanField(default=False)
+
+
+class SchedulesPayload(models.Model):
+    # Packed schedules passed between the tasks of the scheduling chain (see crm/payloads.py)
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class ShardResult(models.Model):
+    # Handle of the schedules of a finished shard of the run, None if the shard has failed
+    run = models.ForeignKey(SchedulingRun, on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField()
+    handle = models.JSONField(null=True)
+
+    class Meta:
+        unique_together = [('run', 'index')]
+
+
+class StageCounter(models.Model):
+    # Counter of a scheduling stage recorded by crm.metrics.PrometheusSink
+    stage = models.CharField(max_length=255)
+    name = models.CharField(max_length=64)
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('stage', 'name')]
+
+
 class Occupation(models.Model):
     name = models.CharField(max_length=255, unique=True)
     description = models.TextField(null=True)
@@ -121,6 +176,19 @@ class Employee(models.Model):
         # if there are any get the planned destination
         return flights[0].flight_plan.destination
 
+    @classmethod
+    def planned_locations_at(cls, date, default=None) -> dict:
+        # Same as planned_location_at for all the employees in a single query:
+        # employee pk -> airport pk, default for the employees without flights before date
+        last_destination = Flight.objects.filter(
+            canceled=False,
+            employees=OuterRef('pk'),
+            planning_departure_datetime__lte=date).order_by('-planning_arrival_datetime')
+        employees = cls.objects.annotate(
+            location=Subquery(last_destination.values('flight_plan__destination')[:1]))
+        return {pk: default if location is None else location
+                for pk, location in employees.values_list('pk', 'location')}
+
     # checks whether or not an employee is available in range
     # start_date <= is_available? < end_date
     def is_available(self, start_datetime, end_datetime):
@@ -177,12 +245,10 @@ class Aircraft(models.Model):
         return self.tail_code
 
     def departed(self):
-        for device in self.aircraftdevicelife_set.all():
-            device.depart_update()
+        AircraftDeviceLife.update_aircraft(cycles={self.pk: 1})
 
     def landed(self, hours_flown):
-        for device in self.aircraftdevicelife_set.all():
-            device.land_update(hours_flown)
+        AircraftDeviceLife.update_aircraft(hours={self.pk: hours_flown})
 
 
 class AircraftDynamicInfo(models.Model):
@@ -194,9 +260,16 @@ class AircraftDynamicInfo(models.Model):
     attendants_number = models.PositiveSmallIntegerField(default=0)
     fuel_remaining_kg = models.PositiveIntegerField()
 
-    def update_fuel(self, fuel_kg):
-        self.fuel_remaining_kg = fuel_kg
-        self.save()
+
+class FuelReading(models.Model):
+    # Append-only fuel telemetry (see crm/telemetry.py)
+    aircraft = models.ForeignKey(Aircraft, on_delete=models.CASCADE)
+    recorded = models.DateTimeField()
+    fuel_kg = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['aircraft', '-recorded']), models.Index(fields=['recorded'])]
+
 
 class AircraftDeviceLife(models.Model):
     aircraft = models.ForeignKey(Aircraft, on_delete=models.CASCADE)
@@ -223,9 +296,39 @@ class AircraftDeviceLife(models.Model):
         self.latest_update = make_aware(datetime.now())
         self.save()
 
+    @classmethod
+    def update_aircraft(cls, cycles=None, hours=None):
+        # Adds the cycles and the hours flown ({aircraft pk: value}) to all the devices of the aircraft in a single
+        # UPDATE, which sends no post_save, so devices_updated is sent instead
+        cycles, hours = cycles or {}, hours or {}
+        aircraft = sorted(set(cycles) | set(hours))
+        if not aircraft:
+            return
+        changes = {}
+        if cycles:
+            changes.update(total_operation_cycles=F('total_operation_cycles') + _per_aircraft(cycles, aircraft),
+                           after_service_cycles=F('after_service_cycles') + _per_aircraft(cycles, aircraft))
+        if hours:
+            changes.update(total_operation_time_h=F('total_operation_time_h') + _per_aircraft(hours, aircraft),
+                           after_service_time_h=F('after_service_time_h') + _per_aircraft(hours, aircraft))
+        cls.objects.filter(aircraft__in=aircraft).update(latest_update=make_aware(datetime.now()), **changes)
+        devices_updated.send(sender=cls, aircraft=aircraft)
+
     def __str__(self):
         return str(self.aircraft) + ' ' + self.device_name
 
+
+def _per_aircraft(values: dict, aircraft: list):
+    # {aircraft pk: value} -> the value of the aircraft of the updated row (0 for the aircraft not in the values)
+    if len(aircraft) == 1:
+        return Value(values[aircraft[0]])
+    return Case(*(When(aircraft=pk, then=Value(value)) for pk, value in values.items()), default=Value(0),
+                output_field=models.IntegerField())
+
+
+# sent by the bulk updates of AircraftDeviceLife with the pks of the aircraft whose devices were updated
+devices_updated = Signal()
+
 AIRCRAFT_EVENT_STATUS = ((0, "Can fly with passengers"), (1, "Can fly without passengers"), (2, "Can't fly at all"))
 
 
@@ -247,6 +350,10 @@ class Flight(models.Model):
     aircraft = models.ForeignKey(Aircraft, on_delete=models.CASCADE)
     employees = models.ManyToManyField(Employee)
 
+    class Meta:
+        # keyset pagination of the flights board (see crm/board.py)
+        indexes = [models.Index(fields=['planning_departure_datetime', 'id'])]
+
     def get_absolute_url(self):
         return reverse("crm:edit flight", kwargs={'pk': self.pk})
 
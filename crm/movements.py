@@ -0,0 +1,73 @@
+from datetime import datetime
+
+from django.db import transaction
+from django.utils.timezone import is_naive, make_aware
+from rest_framework import status
+
+from .compatibility import invalidate_warnings
+from .forecast import flight_hours
+from .models import AircraftDeviceLife, Flight
+
+# Departures and arrivals of the movement feed, applied in batches: {"flight": pk, "event": DEPARTURE or ARRIVAL,
+# "datetime": ISO 8601}. The events are applied in their order, so a batch may hold both events of a flight.
+DEPARTURE = 'departure'
+ARRIVAL = 'arrival'
+
+
+def _parse(event):
+    # (flight pk, event, datetime) or None if the event is malformed
+    try:
+        pk, kind, moment = int(event['flight']), event['event'], datetime.fromisoformat(event['datetime'])
+    except (TypeError, KeyError, ValueError):
+        return None
+    if kind not in (DEPARTURE, ARRIVAL):
+        return None
+    return pk, kind, make_aware(moment) if is_naive(moment) else moment
+
+
+def _apply(flight: Flight, kind: str, moment: datetime, cycles: dict, hours: dict) -> int:
+    # Updates the flight and adds the cycles or hours flown of its aircraft, returns the status of the event
+    if flight.actual_arrival_datetime:
+        return status.HTTP_409_CONFLICT
+    if kind == DEPARTURE:
+        if flight.actual_departure_datetime:
+            return status.HTTP_409_CONFLICT
+        flight.actual_departure_datetime = moment
+        cycles[flight.aircraft_id] = cycles.get(flight.aircraft_id, 0) + 1
+        return status.HTTP_200_OK
+    if not flight.actual_departure_datetime or moment < flight.actual_departure_datetime:
+        return status.HTTP_409_CONFLICT
+    flight.actual_arrival_datetime = moment
+    hours[flight.aircraft_id] = hours.get(flight.aircraft_id, 0) + flight_hours(flight.actual_departure_datetime,
+                                                                                moment)
+    return status.HTTP_200_OK
+
+
+def apply_movements(events: list) -> list:
+    # Applies the events in one transaction: one query to lock the flights, one UPDATE of the flights and one of
+    # the device life of their aircraft. Returns the HTTP status of every event (the single-flight endpoints apply
+    # their event here too): 400 - malformed, 404 - unknown flight, 409 - conflicts with the state of the flight.
+    parsed = [_parse(event) for event in events]
+    results = [status.HTTP_200_OK if event else status.HTTP_400_BAD_REQUEST for event in parsed]
+    with transaction.atomic():
+        flights = Flight.objects.select_for_update().only(
+            'aircraft', 'actual_departure_datetime', 'actual_arrival_datetime'
+        ).in_bulk({event[0] for event in parsed if event})
+        changed, cycles, hours = {}, {}, {}
+        for idx, event in enumerate(parsed):
+            if event is None:
+                continue
+            pk, kind, moment = event
+            flight = flights.get(pk)
+            if flight is None:
+                results[idx] = status.HTTP_404_NOT_FOUND
+                continue
+            results[idx] = _apply(flight, kind, moment, cycles, hours)
+            if results[idx] == status.HTTP_200_OK:
+                changed[pk] = flight
+        if changed:
+            Flight.objects.bulk_update(changed.values(), ['actual_departure_datetime', 'actual_arrival_datetime'])
+            AircraftDeviceLife.update_aircraft(cycles=cycles, hours=hours)
+            # bulk_update sends no signals (see crm/signals.py)
+            invalidate_warnings()
+    return results
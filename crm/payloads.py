@@ -0,0 +1,119 @@
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from .models import SchedulesPayload
+
+# Schedules are passed between the tasks of the scheduling chain as small handles: (start_dt, SchedulesPayload pk,
+# scheduling run or None (see crm/triggers.py), [shard index, number of shards] or None (see crm/sharding.py)).
+# The schedules themselves are packed into flat int64 columns and stored in a SchedulesPayload row, unlike the
+# cache it is never evicted in the middle of the chain.
+# longer than a chain can wait in the queue, the payloads that were never consumed are removed after it
+SCHEDULES_TIMEOUT = 24 * 60 * 60
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# version, has crew, number of schedules, number of flights, number of crew members
+HEADER = struct.Struct('<BBQQQ')
+VERSION = 1
+
+
+class SchedulesExpired(Exception):
+    pass
+
+
+def _microseconds(value: datetime) -> int:
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _column(values) -> bytes:
+    column = array('q', values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def pack_schedules(schedules: list) -> bytes:
+    # [[(departure, arrival, aircraft pk, plan pk[, crew pks])]] -> compressed columns: lengths of the schedules,
+    # departures and arrivals (microseconds since the epoch), aircraft, plans, then crew sizes and crew members
+    flights = [flight for schedule in schedules for flight in schedule]
+    with_crew = bool(flights) and len(flights[0]) > 4
+    columns = [
+        _column(len(schedule) for schedule in schedules),
+        _column(_microseconds(flight[0]) for flight in flights),
+        _column(_microseconds(flight[1]) for flight in flights),
+        _column(flight[2] for flight in flights),
+        _column(flight[3] for flight in flights),
+    ]
+    crew_members = 0
+    if with_crew:
+        columns.append(_column(len(flight[4]) for flight in flights))
+        columns.append(_column(employee for flight in flights for employee in flight[4]))
+        crew_members = sum(len(flight[4]) for flight in flights)
+    header = HEADER.pack(VERSION, with_crew, len(schedules), len(flights), crew_members)
+    return zlib.compress(header + b''.join(columns))
+
+
+def unpack_schedules(data: bytes) -> list:
+    data = zlib.decompress(data)
+    version, with_crew, schedules_count, flights_count, crew_members = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unknown schedules format {version}")
+    offset = HEADER.size
+
+    def read(count):
+        nonlocal offset
+        column = array('q')
+        column.frombytes(data[offset:offset + count * column.itemsize])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        offset += count * column.itemsize
+        return column
+
+    lengths = read(schedules_count)
+    departures, arrivals = read(flights_count), read(flights_count)
+    aircraft, plans = read(flights_count), read(flights_count)
+    flights = [(EPOCH + timedelta(microseconds=departure), EPOCH + timedelta(microseconds=arrival), aircraft_pk,
+                plan_pk) for departure, arrival, aircraft_pk, plan_pk in zip(departures, arrivals, aircraft, plans)]
+    if with_crew:
+        crew_sizes, employees = read(flights_count), read(crew_members).tolist()
+        start = 0
+        for idx, size in enumerate(crew_sizes):
+            flights[idx] = (*flights[idx], employees[start:start + size])
+            start += size
+    schedules, start = [], 0
+    for length in lengths:
+        schedules.append(flights[start:start + length])
+        start += length
+    return schedules
+
+
+def store_schedules(start_dt: datetime, schedules: list, run: str = None, shard=None) -> tuple:
+    # Handle of the stored schedules to pass to the next task
+    SchedulesPayload.objects.filter(
+        created__lt=datetime.now(timezone.utc) - timedelta(seconds=SCHEDULES_TIMEOUT)
+    ).delete()
+    payload = SchedulesPayload.objects.create(data=pack_schedules(schedules))
+    return start_dt.isoformat(), payload.pk, run, shard
+
+
+def load_schedules(handle) -> tuple:
+    # (start_dt, schedules) by the handle of store_schedules
+    start_dt, key = handle[:2]
+    data = SchedulesPayload.objects.filter(pk=key).values_list('data', flat=True).first()
+    if data is None:
+        raise SchedulesExpired(f"Schedules {key} have expired or were already used")
+    return datetime.fromisoformat(start_dt), unpack_schedules(bytes(data))
+
+
+def handle_run(handle):
+    return handle[2]
+
+
+def handle_shard(handle):
+    return handle[3]
+
+
+def discard_schedules(handle):
+    SchedulesPayload.objects.filter(pk=handle[1]).delete()
@@ -0,0 +1,150 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from .snapshot import SchedulingSnapshot
+
+# ready time of the aircraft that have not flown yet
+NEVER_FLOWN = datetime.min.replace(tzinfo=timezone.utc)
+
+
+class RotationMatching:
+    # Deterministic alternative to the random attempts of generate_schedules (ScheduleConfig.FLOW_SCHEDULER).
+    # A rotation is a chain: the aircraft and then its flights, each one departing from the destination of the
+    # previous one after its arrival and the service. Every flight needs a predecessor in a chain (the aircraft
+    # itself or an earlier flight) and every predecessor is followed by one flight at most, so a schedule is
+    # a matching of the flights to the predecessors that covers all the flights (a minimum path cover).
+    # It is found with augmenting paths. Seats are not a part of the matching: when a chain has a flight that
+    # needs more seats than its aircraft has, the aircraft is forbidden to start the chain with its first flight
+    # and that flight is matched again (usually swapping the chain to a bigger aircraft). Without the seat limits
+    # the matching finds a schedule whenever there is one; with a mixed fleet this repair is a heuristic.
+    #
+    # Predecessors are "slots": slot i < len(aircraft) is the aircraft itself, slot len(aircraft) + j is flight j.
+
+    def __init__(self, snapshot: SchedulingSnapshot, flights: list):
+        self.snapshot = snapshot
+        self.flights = flights  # [(departure, arrival, plan pk)] ordered by departure
+        self.capacities = {pk: capacity for capacity, pk in snapshot.capacities}
+        self.aircraft = sorted(self.capacities)
+        self.required = [snapshot.plans[plan_pk].passanger_capacity for _, _, plan_pk in flights]
+
+        slots = []  # (airport pk, ready at) of every slot
+        for aircraft in self.aircraft:
+            airport, ready_at = snapshot.timeline.last_position(aircraft)
+            slots.append((airport, ready_at or NEVER_FLOWN))
+        service_time = snapshot.timeline.service_time
+        for _, arrival, plan_pk in flights:
+            slots.append((snapshot.plans[plan_pk].destination_id, arrival + service_time))
+        self._slots_at = defaultdict(list)  # airport pk -> slots sorted by ready time
+        for slot, (airport, _) in sorted(enumerate(slots), key=lambda item: (item[1][1], item[0])):
+            if airport is not None:
+                self._slots_at[airport].append(slot)
+        self._ready_at = {airport: [slots[slot][1] for slot in airport_slots]
+                          for airport, airport_slots in self._slots_at.items()}
+
+        self.predecessor = {}  # flight -> slot
+        self.successor = {}  # slot -> flight
+        self.forbidden = set()  # (aircraft slot, flight) that started a chain too big for the aircraft
+
+    def candidates(self, flight):
+        # Slots that can precede the flight, the latest ready first
+        departure, arrival, plan_pk = self.flights[flight]
+        source = self.snapshot.plans[plan_pk].source_id
+        airport_slots = self._slots_at.get(source, [])
+        for idx in range(bisect_right(self._ready_at.get(source, []), departure) - 1, -1, -1):
+            slot = airport_slots[idx]
+            if slot < len(self.aircraft) and (self.capacities[self.aircraft[slot]] < self.required[flight] or
+                                              (slot, flight) in self.forbidden):
+                continue
+            yield slot
+
+    def solve(self):
+        # Returns (schedule, None) or (None, [plan pk, error text]) like generate_single_schedule
+        for flight in range(len(self.flights)):
+            # the free predecessors are taken first, augmenting paths are searched only when there are none
+            slot = next((slot for slot in self.candidates(flight) if slot not in self.successor), None)
+            if slot is not None:
+                self._match(flight, slot)
+                continue
+            deficient = self._augment(flight)
+            if deficient is not None:
+                return None, self._error(flight, deficient)
+
+        while True:
+            violation = self._too_small_aircraft()
+            if violation is None:
+                break
+            slot, flight = violation
+            del self.predecessor[flight]
+            del self.successor[slot]
+            self.forbidden.add((slot, flight))
+            deficient = self._augment(flight)
+            if deficient is not None:
+                return None, self._error(flight, deficient)
+
+        aircraft_of = self._chains()
+        return [(departure, arrival, aircraft_of[flight], plan_pk)
+                for flight, (departure, arrival, plan_pk) in enumerate(self.flights)], None
+
+    def _match(self, flight, slot):
+        self.predecessor[flight] = slot
+        self.successor[slot] = flight
+
+    def _augment(self, flight):
+        # Searches for an alternating path from the unmatched flight and rematches the flights along it.
+        # Returns None on success, otherwise the flights reached by the search: together they have fewer
+        # predecessors than flights, so some of them cannot be scheduled.
+        visited, reached = set(), {flight}
+        frames = [[flight, self.candidates(flight), None]]  # [flight, its candidates, the slot tried]
+        while frames:
+            frame = frames[-1]
+            for slot in frame[1]:
+                if slot in visited:
+                    continue
+                visited.add(slot)
+                frame[2] = slot
+                owner = self.successor.get(slot)
+                if owner is None:
+                    # every flight of the path takes the slot it tried, the owner of which is the next one
+                    for path_flight, _, path_slot in frames:
+                        self._match(path_flight, path_slot)
+                    return None
+                reached.add(owner)
+                frames.append([owner, self.candidates(owner), None])
+                break
+            else:
+                frames.pop()
+        return reached
+
+    def _chains(self) -> dict:
+        # flight -> aircraft pk of its chain
+        aircraft_of = {}
+        for slot, aircraft in enumerate(self.aircraft):
+            while slot in self.successor:
+                flight = self.successor[slot]
+                aircraft_of[flight] = aircraft
+                slot = len(self.aircraft) + flight
+        return aircraft_of
+
+    def _too_small_aircraft(self):
+        # (aircraft slot, first flight of its chain) of a chain with a flight that needs more seats than the aircraft
+        for slot, aircraft in enumerate(self.aircraft):
+            flight = self.successor.get(slot)
+            while flight is not None:
+                if self.required[flight] > self.capacities[aircraft]:
+                    return slot, self.successor[slot]
+                flight = self.successor.get(len(self.aircraft) + flight)
+        return None
+
+    def _error(self, flight, deficient):
+        departure, arrival, plan_pk = self.flights[flight]
+        plans = sorted({self.flights[other][2] for other in deficient})
+        return [plan_pk, f"Cannot create flight by plan {plan_pk} with departure: {departure}. There are not "
+                         f"enough aircraft for the flights by plans {plans} departing from "
+                         f"{self.flights[min(deficient)][0]} to {self.flights[max(deficient)][0]}."]
+
+
+def match_rotations(flights_info, banned_flights, snapshot: SchedulingSnapshot):
+    # Single deterministic pass instead of generate_single_schedule attempts
+    flights = [info for info in flights_info if info not in banned_flights]
+    return RotationMatching(snapshot, flights).solve()
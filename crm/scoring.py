@@ -0,0 +1,49 @@
+import dataclasses
+from statistics import pstdev
+
+# weight of each metric in VariantScore.total, missing crew outweighs everything else
+SCORE_WEIGHTS = {
+    'missing_crew': 1000.0,
+    'deadheading': 10.0,
+    'idle_hours': 0.1,
+    'spread': 1.0,
+    'duty_imbalance': 1.0,
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class VariantScore:
+    # Cost metrics of a crew assignment variant, lower is better
+    missing_crew: int  # seats the aircraft require but nobody was assigned to
+    deadheading: int  # employees that end the horizon away from where they started and have to be moved back
+    idle_hours: float  # time the employees wait between their flights
+    spread: int  # airports where the flown crew ends the horizon
+    duty_imbalance: float  # standard deviation of flight hours of the crew members
+
+    def total(self, weights: dict = None) -> float:
+        weights = weights or SCORE_WEIGHTS
+        return sum(weight * getattr(self, metric) for metric, weight in weights.items())
+
+
+def score_variant(variant, routes: dict, crew_numbers: dict, locations: dict) -> VariantScore:
+    # variant: [(departure, arrival, aircraft pk, plan pk, crew pks)] ordered by departure, see assign_crew
+    # routes: plan pk -> (source pk, destination pk), crew_numbers: aircraft pk -> (pilots, attendants)
+    # locations: employee pk -> airport pk at the start of the horizon, for every crew member
+    missing_crew, idle_seconds = 0, 0.0
+    flown_seconds = dict.fromkeys(locations, 0.0)
+    last_arrival, last_location = {}, {}
+    for departure, arrival, aircraft, plan, crew in variant:
+        missing_crew += max(sum(crew_numbers[aircraft]) - len(crew), 0)
+        for employee in crew:
+            if employee in last_arrival:
+                idle_seconds += (departure - last_arrival[employee]).total_seconds()
+            flown_seconds[employee] = flown_seconds.get(employee, 0.0) + (arrival - departure).total_seconds()
+            last_arrival[employee] = arrival
+            last_location[employee] = routes[plan][1]
+    return VariantScore(
+        missing_crew=missing_crew,
+        deadheading=sum(1 for employee, airport in last_location.items() if airport != locations.get(employee)),
+        idle_hours=idle_seconds / 3600,
+        spread=len(set(last_location.values())),
+        duty_imbalance=pstdev(flown_seconds.values()) / 3600 if len(flown_seconds) > 1 else 0.0,
+    )
@@ -0,0 +1,53 @@
+from operator import itemgetter
+
+from django.db import transaction
+
+from .models import SchedulingRun
+
+# Plans that share no airports are scheduled independently: aircraft and crew move only along the plans, so they
+# stay in the component of the airport they are in and never join two components. Every component is generated
+# and staffed by its own chain of tasks (a shard), the last finished shard writes the flights of all of them.
+# A shard that stops early reports its failure the same way, then the last one fails the whole run instead.
+
+
+def plan_components(plans) -> list:
+    # plans: [(plan pk, source pk, destination pk)] -> [[plan pks]] connected by the airports, in the order of
+    # their smallest plan pk
+    parent = {}
+
+    def find(airport):
+        parent.setdefault(airport, airport)
+        while parent[airport] != airport:
+            parent[airport] = parent[parent[airport]]
+            airport = parent[airport]
+        return airport
+
+    for _, source, destination in plans:
+        parent[find(source)] = find(destination)
+    components = {}
+    for pk, source, _ in sorted(plans):
+        components.setdefault(find(source), []).append(pk)
+    return list(components.values())
+
+
+def collect(run: str, index: int, count: int, handle):
+    # Stores the handle of the finished shard (None - the shard has failed). Returns the handles of all the shards
+    # to the single caller that has to merge them, None to the others and to the shards of a superseded run.
+    # The shards of the run are collected one by one under the lock of its row, so exactly one sees all of them.
+    with transaction.atomic():
+        scheduling_run = SchedulingRun.objects.select_for_update().filter(token=run).first()
+        if scheduling_run is None or scheduling_run.merged:
+            return None
+        scheduling_run.shardresult_set.update_or_create(index=index, defaults={'handle': handle})
+        handles = dict(scheduling_run.shardresult_set.values_list('index', 'handle'))
+        if len(handles) < count:
+            return None
+        scheduling_run.merged = True
+        scheduling_run.save(update_fields=['merged'])
+        scheduling_run.shardresult_set.all().delete()
+    return [handles[idx] for idx in range(count)]
+
+
+def merge_variants(variants: list) -> list:
+    # crew variants of the shards -> one variant ordered by departure
+    return sorted((flight for variant in variants for flight in variant), key=itemgetter(0))
@@ -0,0 +1,28 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .compatibility import invalidate_warnings
+from .fleet import invalidate_aircraft_state
+from .models import AircraftDeviceLife, AircraftDynamicInfo, EmployeeLog, Flight, ScheduleConfig, devices_updated
+
+
+# Inputs of the flight warnings (see check_flights_compatibility). Bulk writes of the flights do not send signals,
+# so the schedule writers invalidate the warnings themselves.
+@receiver(post_save, sender=Flight)
+@receiver(post_delete, sender=Flight)
+@receiver(post_save, sender=EmployeeLog)
+@receiver(post_delete, sender=EmployeeLog)
+@receiver(post_save, sender=AircraftDeviceLife)
+@receiver(post_delete, sender=AircraftDeviceLife)
+@receiver(devices_updated, sender=AircraftDeviceLife)
+@receiver(post_save, sender=ScheduleConfig)
+@receiver(post_delete, sender=ScheduleConfig)
+@receiver(m2m_changed, sender=Flight.employees.through)
+def flight_warnings_inputs_changed(**kwargs):
+    invalidate_warnings()
+
+
+@receiver(post_save, sender=AircraftDynamicInfo)
+@receiver(post_delete, sender=AircraftDynamicInfo)
+def aircraft_state_changed(instance, **kwargs):
+    invalidate_aircraft_state(instance.aircraft_id)
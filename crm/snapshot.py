@@ -0,0 +1,50 @@
+import dataclasses
+from bisect import bisect_left
+from datetime import datetime
+from typing import Optional
+
+from .models import Airport, AircraftDynamicInfo, FlightPlan, ScheduleConfig
+from .timeline import FleetTimeline
+
+
+@dataclasses.dataclass(frozen=True)
+class SchedulingSnapshot:
+    # Everything the schedule generation attempts read, loaded once per generate_schedules run.
+    # Attempts share it (it is sent to the worker processes once) and must not modify it.
+    config: ScheduleConfig
+    plans: dict  # plan pk -> FlightPlan
+    airports: dict  # airport pk -> Airport
+    aircraft: dict  # aircraft pk -> AircraftDynamicInfo
+    capacities: tuple  # (passenger capacity, aircraft pk) sorted by capacity
+    timeline: FleetTimeline
+
+    @classmethod
+    def load(cls, start_dt: Optional[datetime] = None, config: ScheduleConfig = None, timeline: FleetTimeline = None,
+             plan_pks=None):
+        # plan_pks - to schedule only these plans (a shard, see crm/sharding.py)
+        config = config or ScheduleConfig.objects.all().first()
+        plans = FlightPlan.objects.all()
+        if start_dt is not None:
+            plans = plans.filter(end_date__gte=start_dt.date())
+        if plan_pks is not None:
+            plans = plans.filter(pk__in=plan_pks)
+        aircraft = {info.aircraft_id: info for info in AircraftDynamicInfo.objects.all()}
+        capacities = sorted(
+            (info.business_class_cap + info.first_class_cap + info.economy_class_cap, pk)
+            for pk, info in aircraft.items()
+        )
+        return cls(
+            config=config,
+            plans={plan.pk: plan for plan in plans},
+            airports={airport.pk: airport for airport in Airport.objects.all()},
+            aircraft=aircraft,
+            capacities=tuple(capacities),
+            # flights departing after start_dt are going to be replaced, so by default the timeline ends there
+            timeline=timeline or FleetTimeline.load(until=start_dt,
+                                                    service_time=config.min_between_flights_delay_minutes),
+        )
+
+    def aircraft_with_capacity(self, passenger_capacity: int, among=None) -> list:
+        # Aircraft (from among, if given) with at least passenger_capacity seats, the smallest first
+        idx = bisect_left(self.capacities, (passenger_capacity, ))
+        return [pk for capacity, pk in self.capacities[idx:] if among is None or pk in among]
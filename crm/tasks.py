@@ -1,17 +1,33 @@
-import dataclasses
-import math
-from collections import defaultdict
 from datetime import datetime
 from enum import Enum, unique
-from itertools import chain
+from heapq import merge
 from operator import itemgetter
-from random import choice
+from random import Random, choice
 
+from billiard import Pool
 from celery import shared_task
-from django.db.models import Max, Q
-
-from .models import Flight, FlightPlan, Runway, Aircraft, Airport, AircraftDynamicInfo, Employee, ScheduleConfig, \
-    AircraftDeviceLife
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import Flight, FlightPlan, Runway, Employee, ScheduleConfig, \
+    AircraftDynamicInfo, SchedulingRequest
+from .availability import UnavailabilityIndex
+from .compatibility import FLIGHT_RELATED, CompatibilityData, get_cached_warnings, set_cached_warnings
+from .crew import CrewQueues, assign_crew, crew_home_base
+from .forecast import flight_hours
+from .incremental import IncrementalScheduler
+from .metrics import stage
+from .payloads import SchedulesExpired, discard_schedules, handle_run, handle_shard, load_schedules, \
+    store_schedules
+from .rotations import match_rotations
+from .scoring import score_variant
+from .sharding import collect, merge_variants, plan_components
+from .snapshot import SchedulingSnapshot
+from .telemetry import compact_readings
+from .timeline import TimelineFlight
+from .triggers import fail_run, is_superseded, new_incremental_run, new_regeneration_run, should_wait, \
+    take_requests
+from .writer import write_schedule
 
 from django.utils import timezone
 from celery.utils.log import get_task_logger
@@ -38,25 +54,35 @@ def check_airports_availability(self, flight_plan_pk):
 
 
 def get_flights_datetimes(plan: FlightPlan, starts_datetime=None):
-    logger.info(f"Start date: {plan.start_date}. End date: {plan.end_date}. Days: {plan.days_of_week}")
-    current_date = plan.start_date
-    if starts_datetime is not None and current_date <= starts_datetime.date():
-        current_date = starts_datetime.date()
-    results = []
-    while current_date <= plan.end_date:
-        if str(current_date.weekday()) in list(plan.days_of_week):
-            departure_dt = datetime.combine(current_date, plan.planning_departure_time, tzinfo=timezone.now().tzinfo)
-            arrival_dt = datetime.combine(current_date, plan.planning_arrival_time, tzinfo=timezone.now().tzinfo)
-            if arrival_dt < departure_dt:
-                arrival_dt += timezone.timedelta(days=1)
-            if departure_dt >= starts_datetime:
-                results.append((departure_dt, arrival_dt, plan.pk))
-        current_date += timezone.timedelta(days=1)
-    return results
-
-
-class ScheduleError(Exception):
-    pass
+    # Sorted [(departure, arrival, plan pk)] of the plan. Instead of walking every calendar day,
+    # departures are stepped by a week from the first date of every day of week of the plan.
+    logger.debug("Start date: %s. End date: %s. Days: %s", plan.start_date, plan.end_date, plan.days_of_week)
+    first_date = plan.start_date
+    if starts_datetime is not None and first_date <= starts_datetime.date():
+        first_date = starts_datetime.date()
+    first_departure = datetime.combine(first_date, plan.planning_departure_time, tzinfo=timezone.utc)
+    duration = datetime.combine(first_date, plan.planning_arrival_time, tzinfo=timezone.utc) - first_departure
+    if duration < timezone.timedelta(0):
+        duration += timezone.timedelta(days=1)
+    last_departure = datetime.combine(plan.end_date, plan.planning_departure_time, tzinfo=timezone.utc)
+    week = timezone.timedelta(days=7)
+
+    by_day_of_week = []
+    for day in {int(day_of_week) for day_of_week in plan.days_of_week}:
+        departure_dt = first_departure + timezone.timedelta(days=(day - first_date.weekday()) % 7)
+        if starts_datetime is not None and departure_dt < starts_datetime:
+            departure_dt += week
+        departures = []
+        while departure_dt <= last_departure:
+            departures.append((departure_dt, departure_dt + duration, plan.pk))
+            departure_dt += week
+        by_day_of_week.append(departures)
+    return list(merge(*by_day_of_week))
+
+
+def get_all_flights_datetimes(plans, starts_datetime=None):
+    # Occurrences of all the plans merged into a single list sorted by departure
+    return list(merge(*(get_flights_datetimes(plan, starts_datetime) for plan in plans), key=itemgetter(0)))
 
 
 @unique
@@ -82,9 +108,13 @@ permitted_warnings = [FlightWarning.ARRIVED, FlightWarning.SCHEDULED, FlightWarn
                       FlightWarning.ARRIVAL_DELAY, FlightWarning.DEPARTURE_DELAY]
 
 
-def get_previous_flight(flight: Flight, flight_status: dict):
-    flights = Flight.objects.filter(planning_departure_datetime__lt=flight.planning_departure_datetime,
-                                    aircraft=flight.aircraft, canceled=False).order_by('-planning_arrival_datetime')
+def get_previous_flight(flight: Flight, flight_status: dict, data: CompatibilityData = None):
+    if data is not None:
+        flights = data.previous_candidates(flight)
+    else:
+        flights = Flight.objects.filter(planning_departure_datetime__lt=flight.planning_departure_datetime,
+                                        aircraft=flight.aircraft, canceled=False)
+        flights = flights.order_by('-planning_arrival_datetime')
     for prev_flight_candidate in flights:
         departed = FlightWarning.ARRIVED if prev_flight_candidate.actual_departure_datetime is not None else None
         if flight_status.get(prev_flight_candidate.pk, departed) in permitted_warnings:
@@ -92,8 +122,9 @@ def get_previous_flight(flight: Flight, flight_status: dict):
     return None
 
 
-def prev_flight_checks(flight: Flight, flight_status: dict, config: ScheduleConfig):
-    prev_flight = get_previous_flight(flight, flight_status)
+def prev_flight_checks(flight: Flight, flight_status: dict, config: ScheduleConfig, data: CompatibilityData = None):
+    # Returns the moment after which the result changes by itself (None - it does not)
+    prev_flight = get_previous_flight(flight, flight_status, data)
     if prev_flight is None:
         if flight.flight_plan.source != flight.flight_plan.destination:
             logger.warning(f"ERROR: There is no prev_flight for: {flight}")
@@ -101,7 +132,7 @@ def prev_flight_checks(flight: Flight, flight_status: dict, config: ScheduleConf
             return
         flight_status[flight.pk] = FlightWarning.DEPARTED
         return
-    logger.info(f"Prev flight {prev_flight} for flight {flight}")
+    logger.debug("Prev flight %s for flight %s", prev_flight, flight)
 
     prev_approx_duration = prev_flight.planning_arrival_datetime - prev_flight.planning_departure_datetime
     prev_departure = max(timezone.now(), prev_flight.planning_departure_datetime)
@@ -118,6 +149,9 @@ def prev_flight_checks(flight: Flight, flight_status: dict, config: ScheduleConf
     elif prev_flight.actual_departure_datetime is None:
         if prev_approx_arrival > aircraft_required_dt:
             flight_status[flight.pk] = FlightWarning.PREVIOUS_NOT_DEPARTURE_TOO_LONG
+        else:
+            # the previous flight is going to be too late if it does not depart until then
+            return aircraft_required_dt - prev_approx_duration
     else:
         if prev_flight.actual_arrival_datetime is None:
             if prev_approx_arrival >= aircraft_required_dt:
@@ -128,324 +162,472 @@ def prev_flight_checks(flight: Flight, flight_status: dict, config: ScheduleConf
             flight_status[flight.pk] = FlightWarning.PREVIOUS_ARRIVED_TO_LATE
 
 
-def get_device_info_dict(device: AircraftDeviceLife) -> dict:
-    return {"device_pk": device.pk,
-            "total_operation_time_h": device.total_operation_time_h,
-            "total_operation_cycles": device.total_operation_cycles,
-            "after_service_time_h": device.after_service_time_h,
-            "after_service_cycles": device.after_service_cycles}
-
-
-def check_aircraft_devices(flight: Flight, devices_predicted_info: dict, update_predicted_info=False):
-    # devices predicted info is the dict where key is device.pk
-    # each value of dict is another dict with the next fields:
-    # {"device_pk": value, "total_operation_time_h": value, "total_operation_cycles": value,
-    #  "after_service_time_h": value, "after_service_cycles": value}
-    devices = AircraftDeviceLife.objects.filter(aircraft=flight.aircraft)
-    flight_time_h = math.ceil((flight.planning_arrival_datetime - flight.planning_departure_datetime).seconds / 3600)
-    for device in devices:
-        device_pred = devices_predicted_info.get(device.pk, get_device_info_dict(device))
-        life_remain = min(device.max_operation_time_h - device_pred["total_operation_time_h"],
-                          device.service_time_period_h - device_pred["after_service_time_h"])
-        cycles_remain = min(device.max_operation_cycles - device_pred["total_operation_cycles"],
-                            device.service_cycles_period - device_pred["after_service_cycles"])
-        if life_remain < flight_time_h or cycles_remain < 1:
-            return False
-        if update_predicted_info:
-            update_device_prediction(flight_time_h, device, devices_predicted_info)
-    return True
-
-
-def update_device_prediction(flight_time, device, devices_predicted_info):
-    device_dict = devices_predicted_info.get(device.pk, get_device_info_dict(device))
-    device_dict['total_operation_time_h'] += flight_time
-    device_dict['total_operation_cycles'] += 1
-    device_dict['after_service_time_h'] += flight_time
-    device_dict['after_service_cycles'] += 1
-    devices_predicted_info[device.pk] = device_dict
-
-
-def check_employee_ready(flight):
+def check_employee_ready(flight, data: CompatibilityData = None):
+    if data is not None:
+        return data.crew_available(flight)
     employees = flight.employees.all()
     return all(e.is_available(flight.planning_departure_datetime, flight.planning_arrival_datetime) for e in employees)
 
 
-def check_flights_compatibility(flight_query_set):
-    flight_status, devices_prediction = {}, {}
-    config = ScheduleConfig.objects.all().first()
+def time_warning(flight: Flight, config: ScheduleConfig, now: datetime) -> FlightWarning:
+    # Warnings that depend only on the flight itself and the current time
+    flight_duration = flight.planning_arrival_datetime - flight.planning_departure_datetime
+    if flight.actual_departure_datetime is None:
+        if flight.planning_departure_datetime + config.warning_schedule_delay_time <= now:
+            return FlightWarning.DEPARTURE_DELAY
+    else:
+        if flight.actual_arrival_datetime is None:
+            flight_approx_arrival = flight.actual_departure_datetime + flight_duration
+            if flight_approx_arrival + config.warning_arrival_delay_time <= now:
+                return FlightWarning.ARRIVAL_DELAY
+        else:
+            arrival_shifting = flight.actual_arrival_datetime - flight.planning_arrival_datetime
+            if arrival_shifting > config.warning_arrival_shifted_time:
+                return FlightWarning.ARRIVAL_SHIFTED
+    if flight.actual_arrival_datetime is None:
+        if flight.actual_departure_datetime is None:
+            return FlightWarning.SCHEDULED
+        return FlightWarning.DEPARTED
+    return FlightWarning.ARRIVED
+
 
-    for flight in flight_query_set.order_by('planning_departure_datetime'):
+def check_flights_compatibility(flight_query_set):
+    # Warnings that do not depend on time are cached until the inputs change (see crm/signals.py),
+    # the time-based ones are evaluated from the flights on every call
+    with stage('check_flights_compatibility') as metrics:
+        config = ScheduleConfig.objects.all().first()
+        now = timezone.now()
+        flights = list(flight_query_set.select_related(*FLIGHT_RELATED).order_by('planning_departure_datetime'))
+        key, warnings = get_cached_warnings(flights, now)
+        if warnings is None:
+            warnings, expires = get_flights_warnings(flights, config, now)
+            set_cached_warnings(key, warnings, expires)
+        metrics.rows = len(flights)
+        return {flight.pk: warnings[flight.pk] or time_warning(flight, config, now) for flight in flights}
+
+
+def get_flights_warnings(flights: list, config: ScheduleConfig, now: datetime):
+    # Everything the checks need is prefetched for the whole window, then the flights are checked in one pass
+    # ordered by departure, so the previous flights of the window are checked before the next ones.
+    # Returns flight pk -> warning or None if only the time-based warnings apply, and the moment the result expires.
+    flight_status, warnings, expires = {}, {}, None
+    data = CompatibilityData.prefetch(flights)
+
+    for flight in data.flights:
+        hours = flight_hours(flight.planning_departure_datetime, flight.planning_arrival_datetime)
         if flight.canceled:
             flight_status[flight.pk] = FlightWarning.CANCELED
-        elif not check_aircraft_devices(flight, devices_prediction, update_predicted_info=True):
+        elif not data.forecast.fly(flight.aircraft_id, hours):
             flight_status[flight.pk] = FlightWarning.AIRCRAFT_DEVICE_PROBLEM
-        elif not check_employee_ready(flight):
+        elif not check_employee_ready(flight, data):
             flight_status[flight.pk] = FlightWarning.EMPLOYEE_NOT_AVAILABLE
         else:
-            prev_flight_checks(flight, flight_status, config)
+            changes_at = prev_flight_checks(flight, flight_status, config, data)
+            if changes_at is not None and changes_at > now:
+                expires = changes_at if expires is None else min(expires, changes_at)
 
+        warnings[flight.pk] = flight_status.get(flight.pk)
         if flight.pk not in flight_status:
-            flight_duration = flight.planning_arrival_datetime - flight.planning_departure_datetime
-            if flight.actual_departure_datetime is None:
-                if flight.planning_departure_datetime + config.warning_schedule_delay_time <= timezone.now():
-                    flight_status[flight.pk] = FlightWarning.DEPARTURE_DELAY
-            else:
-                if flight.actual_arrival_datetime is None:
-                    flight_approx_arrival = flight.actual_departure_datetime + flight_duration
-                    if flight_approx_arrival + config.warning_arrival_delay_time <= timezone.now():
-                        flight_status[flight.pk] = FlightWarning.ARRIVAL_DELAY
-                else:
-                    arrival_shifting = flight.actual_arrival_datetime - flight.planning_arrival_datetime
-                    if arrival_shifting > config.warning_arrival_shifted_time:
-                        flight_status[flight.pk] = FlightWarning.ARRIVAL_SHIFTED
-        if flight.pk not in flight_status:
-            if flight.actual_arrival_datetime is None:
-                if flight.actual_departure_datetime is None:
-                    flight_status[flight.pk] = FlightWarning.SCHEDULED
-                else:
-                    flight_status[flight.pk] = FlightWarning.DEPARTED
-            else:
-                flight_status[flight.pk] = FlightWarning.ARRIVED
-
-    return flight_status
-
-
-def get_actually_available_aircraft(airport: Airport, service_duration_s=0):
-    aircraft_flight = Flight.objects.filter(canceled=False, actual_destination=airport,
-                                            actual_arrival_datetime__lte=timezone.now() - timezone.timedelta(
-                                                seconds=service_duration_s)).values(
-        'aircraft').annotate(last_arrival=Max('actual_arrival_datetime'))
-    logger.info(f"Flights: {aircraft_flight}")
-    # TODO: optimise there:
-    valid = filter(lambda flight: Flight.objects.filter(flight_plan__source=airport,
-                                                        aircraft=flight['aircraft'],
-                                                        actual_departure_datetime__gte=flight[
-                                                            'last_arrival']).count() == 0,
-                   aircraft_flight)
-    # logger.info("ABC" + str(Flight.objects.filter(flight_plan__source=airport,
-    #                                               actual_departure_datetime__gte=aircraft_flight[0][
-    #                                                   'last_arrival']).get()))
-    return map(lambda availability_info: availability_info['aircraft'], valid)
-
-
-def get_planned_available_aircraft(airport: Airport, datetime_point: datetime, service_time=None):
-    # TODO: make it smarter, this implementation guarantee that result is correct
-    # current algo:
-    # get all available aircraft now
-    # apply all flights: arrived -> add, departure -> remove
-    # return residual aircraft list
-
-    # it might be a smarter algo, but a lot of transactions:
-    #  get list of all aircraft
-    #  look when every aircraft last arrived ('planned_arrived_datetime' field)
-    #  check that aircraft not departure from airport in range [arrived, planned_arrived_datetime]
-    all_aircraft = {aircraft for aircraft in get_actually_available_aircraft(airport)}
-    logger.info(f"Now in airport {airport}: {all_aircraft}")
-    with_service_datetime = datetime_point - (timezone.timedelta(seconds=0) if service_time is None else service_time)
-    logger.info(f"with_service_datetime: {with_service_datetime}")
-    flights = Flight.objects.filter(
-        Q(flight_plan__destination=airport, planning_arrival_datetime__gt=with_service_datetime) |
-        Q(flight_plan__source=airport, planning_departure_datetime__gt=datetime_point),
-        canceled=False).order_by('planning_arrival_datetime')
-    for flight in flights:
-        if flight.flight_plan.source == airport and flight.flight_plan.destination != airport:
-            if flight.aircraft.pk not in all_aircraft:
-                raise ScheduleError(
-                    f"Aircraft {flight.aircraft} not in airport {airport} at {flight.planning_departure_datetime}")
-            logger.info(f"Aicraft {flight.aircraft.pk} removed: {flight}")
-            all_aircraft.remove(flight.aircraft.pk)
-        elif flight.flight_plan.destination == airport and flight.flight_plan.source != airport:
-            if flight.aircraft in all_aircraft:
-                raise ScheduleError(
-                    f"Aircraft {flight.aircraft} is already in airport {airport} at {flight.planning_arrival_datetime}")
-            all_aircraft.add(flight.aircraft.pk)
-            logger.info(f"Aircraft {flight.aircraft.pk} added: {flight}")
-        elif flight.flight_plan.source == airport and flight.flight_plan.destination == airport:
-            pass
-        else:
-            raise RuntimeError(f"Wrong query, flight {flight} is not connected with {airport} airport")
-    return all_aircraft
-
-
-def aircraft_smart_chooser(departure: datetime, arrival: datetime, plan: FlightPlan, aircraft_list: set):
-    candidates = []
-    for aircraft in aircraft_list:
-        craft_info = AircraftDynamicInfo.objects.get(aircraft=aircraft)
-        # CHECK THAT ENOUGH FUEL
-        # CHECK THAT MAINTENANCE IS NOT REQUIRED
-        capacity = craft_info.business_class_cap + craft_info.first_class_cap + craft_info.economy_class_cap
-        if capacity >= plan.passanger_capacity:
-            candidates.append(aircraft)
-    return choice(candidates) if candidates else None
-
-
-def generate_single_schedule(flights_info, banned_flights):
-    config = ScheduleConfig.objects.all().first()
-    schedule, in_flight = [], []
-    available_aircraft = defaultdict(set)
-    service_time = config.min_between_flights_delay_minutes
+            flight_status[flight.pk] = time_warning(flight, config, now)
+    return warnings, expires
+
+
+def aircraft_smart_chooser(departure: datetime, arrival: datetime, plan: FlightPlan, aircraft_list: set,
+                           snapshot: SchedulingSnapshot, rng: Random = None):
+    # CHECK THAT ENOUGH FUEL
+    # CHECK THAT MAINTENANCE IS NOT REQUIRED
+    # ordered by capacity, so the choice depends only on the seed of rng
+    candidates = snapshot.aircraft_with_capacity(plan.passanger_capacity, among=aircraft_list)
+    if not candidates:
+        return None
+    return rng.choice(candidates) if rng is not None else choice(candidates)
+
+
+def generate_single_schedule(flights_info, banned_flights, snapshot: SchedulingSnapshot = None, seed=None):
+    rng = Random(seed)
+    if snapshot is None:
+        snapshot = SchedulingSnapshot.load()
+    # every attempt moves aircraft in its own copy of the timeline
+    timeline = snapshot.timeline.copy()
+    schedule = []
     for departure, arrival, plan_pk in flights_info:
-        while in_flight and in_flight[0][0] <= departure:
-            dep, destination, craft = in_flight.pop(0)
-            available_aircraft[destination].add(craft)
-            logger.info(f"Aicraft: {craft} arrived to {destination}")
         if (departure, arrival, plan_pk) not in banned_flights:
-            plan = FlightPlan.objects.get(pk=plan_pk)
-            if plan.source not in available_aircraft:
-                available_aircraft[plan.source] = get_planned_available_aircraft(plan.source, departure, service_time)
-            aircraft = aircraft_smart_chooser(departure, arrival, plan, available_aircraft[plan.source])
+            plan = snapshot.plans[plan_pk]
+            available_aircraft = timeline.available_at(plan.source_id, departure)
+            aircraft = aircraft_smart_chooser(departure, arrival, plan, available_aircraft, snapshot, rng)
             if aircraft is None:
                 return None, [plan.pk,
                               f"Cannot create flight by plan {plan.pk} with departure: {departure}. There is no "
-                              f"available aircraft. All aircrafts: {available_aircraft[plan.source]}"]
-            available_aircraft[plan.source].remove(aircraft)
-            logger.info(f"Aircraft: {aircraft} departure from {plan.source}")
-            in_flight.append((arrival + config.min_between_flights_delay_minutes, plan.destination, aircraft))
+                              f"available aircraft. All aircrafts: {available_aircraft}"]
+            timeline.add_flight(
+                TimelineFlight(departure, arrival, aircraft, plan.source_id, plan.destination_id, plan.pk))
+            logger.debug("Aircraft: %s departure from %s", aircraft, snapshot.airports[plan.source_id])
             schedule.append((departure, arrival, aircraft, plan.pk))
     return schedule, None
 
 
-@shared_task(bind=True)
-def generate_schedules(self, start_dt: str):
-    start_dt = timezone.datetime.fromisoformat(start_dt)
-    plans = FlightPlan.objects.filter(end_date__gte=start_dt.date())
-    plans.update(status=FlightPlan.PROCESSING_FPM)
+# (function, *context) of the running map_in_processes, set once per worker process
+_process_context = None
+
+
+def _set_process_context(*context):
+    global _process_context
+    _process_context = context
+
+
+def _call_in_context(item):
+    function, *context = _process_context
+    return function(*context, item)
+
+
+def map_in_processes(function, items, context: tuple, count: int):
+    # Yields function(*context, item) for the items in their order, in SCHEDULE_GENERATION_PROCESSES worker
+    # processes (but no more than count) or in this process. The function has to be a module level one.
+    processes = min(settings.SCHEDULE_GENERATION_PROCESSES, count)
+    if processes <= 1:
+        _set_process_context(function, *context)
+        results = map(_call_in_context, items)
+        pool = None
+    else:
+        # forked workers must open their own database connections
+        connections.close_all()
+        # the context is sent to every worker once, the tasks are just the items
+        pool = Pool(processes, initializer=_set_process_context, initargs=(function, *context))
+        results = pool.imap(_call_in_context, items)
     try:
-        config = ScheduleConfig.objects.all().first()
-    except:
-        plans.update(status=FlightPlan.ERROR_FPM)
-        plans.update(description="Please create a config for the schedulers in the admin panel.")
-        self.request.chain = None
-        return
-    logger.info(f"Generating schedules from {start_dt.date()}")
-    flights_info = list(chain.from_iterable(get_flights_datetimes(plan, starts_datetime=start_dt) for plan in plans))
-    flights_info = sorted(flights_info, key=itemgetter(0))
-    logger.info(f"Flights info: {flights_info}")
-    banned_flights = Flight.objects.filter(canceled=True, planning_departure_datetime__gte=start_dt)
-    banned_flights = list(map(lambda f: (f.planning_departure_datetime, f.planning_arrival_datetime, f.flight_plan.pk),
-                              banned_flights))
-    logger.info(f"Banned flights: {banned_flights}")
-
-    schedules = []
-    plan_pk, error_text = None, None
-    for attempt in range(config.max_flight_generation_attempts):  # TODO: make it parallel
-        schedule, error = generate_single_schedule(flights_info, banned_flights)
-        if error is None:
-            logger.info(f"Attempt #{attempt + 1} was successful.")
-            schedules.append(schedule)
-        else:
-            plan_pk, error_text = error
-            logger.info(f"Attempt #{attempt + 1} was not successful.")
+        yield from results
+    finally:
+        if pool is not None:
+            # without close() billiard waits ~30s in terminate() for the unfinished tasks of a stopped imap
+            pool.close()
+            pool.terminate()
+            pool.join()
+        _set_process_context(None)
+
+
+def run_schedule_attempts(flights_info, banned_flights, snapshot: SchedulingSnapshot, attempts: int, seed=0,
+                          successes_limit=0):
+    # Yields (attempt, schedule, error) in the order of attempts, attempt i uses the seed + i random seed,
+    # so the result is reproducible regardless of the number of processes.
+    # Stops after successes_limit successful schedules (0 - no limit).
+    seeds = (seed + attempt for attempt in range(attempts))
+    results = map_in_processes(generate_single_schedule, seeds, (flights_info, banned_flights, snapshot), attempts)
+    successes = 0
+    try:
+        for attempt, (schedule, error) in enumerate(results):
+            yield attempt, schedule, error
+            if error is None:
+                successes += 1
+                if successes_limit and successes >= successes_limit:
+                    break
+    finally:
+        results.close()
 
-    if plan_pk is not None and not schedules:
-        plan = FlightPlan.objects.get(pk=plan_pk)
-        plan.status = FlightPlan.ERROR_FPM
-        plan.description = error_text
-        plan.save()
+
+@shared_task(bind=True)
+def generate_schedules(self, start_dt: str, seed: int = 0, run: str = None, plan_pks=None, shard=None):
+    # run - token of the full regeneration (see regenerate_schedules), passed along the chain in the handles,
+    # plan_pks and shard - the plans and [index, number of shards] of a shard (see crm/sharding.py)
+    if is_superseded(run):
+        logger.info(f"Regeneration {run} is superseded by a newer one")
         self.request.chain = None
         return
-    plans.update(status=FlightPlan.PROCESSING_EPM)
-    return start_dt, schedules
+    with stage('generate_schedules') as metrics:
+        start_dt = timezone.datetime.fromisoformat(start_dt)
+        plans = FlightPlan.objects.filter(end_date__gte=start_dt.date())
+        if plan_pks is not None:
+            plans = plans.filter(pk__in=plan_pks)
+        plans.update(status=FlightPlan.PROCESSING_FPM)
+        config = ScheduleConfig.objects.all().first()
+        if config is None:
+            plans.update(status=FlightPlan.ERROR_FPM)
+            plans.update(description="Please create a config for the schedulers in the admin panel.")
+            self.request.chain = None
+            stop_chain(run, shard, "Please create a config for the schedulers in the admin panel.")
+            return
+        logger.info(f"Generating schedules from {start_dt.date()}")
+        with stage('generate_schedules.load') as load_metrics:
+            snapshot = SchedulingSnapshot.load(start_dt, config, plan_pks=plan_pks)
+            flights_info = get_all_flights_datetimes(snapshot.plans.values(), starts_datetime=start_dt)
+            banned_flights = Flight.objects.filter(canceled=True, planning_departure_datetime__gte=start_dt)
+            banned_flights = set(banned_flights.values_list('planning_departure_datetime',
+                                                            'planning_arrival_datetime', 'flight_plan'))
+            load_metrics.rows = len(flights_info)
+        logger.info(f"{len(flights_info)} flights of {len(snapshot.plans)} plans, {len(banned_flights)} banned")
+        logger.debug("Flights info: %s, banned flights: %s", flights_info, banned_flights)
+        metrics.rows = len(flights_info)
+
+        schedules = []
+        plan_pk, error_text = None, None
+        with stage('generate_schedules.attempts') as attempts_metrics:
+            if config.scheduler == ScheduleConfig.FLOW_SCHEDULER:
+                attempts = [(0, *match_rotations(flights_info, banned_flights, snapshot))]
+            else:
+                attempts = run_schedule_attempts(flights_info, banned_flights, snapshot,
+                                                 config.max_flight_generation_attempts, seed,
+                                                 config.max_successful_schedules)
+            attempts_metrics.attempts = 0
+            for attempt, schedule, error in attempts:
+                attempts_metrics.attempts += 1
+                if error is None:
+                    logger.info(f"Attempt #{attempt + 1} was successful.")
+                    schedules.append(schedule)
+                else:
+                    plan_pk, error_text = error
+                    logger.info(f"Attempt #{attempt + 1} was not successful.")
+            attempts_metrics.successes = len(schedules)
+            attempts_metrics.rows = len(flights_info) * attempts_metrics.attempts
+        metrics.attempts, metrics.successes = attempts_metrics.attempts, attempts_metrics.successes
+
+        if plan_pk is not None and not schedules:
+            plan = snapshot.plans[plan_pk]
+            plan.status = FlightPlan.ERROR_FPM
+            plan.description = error_text
+            plan.save()
+            self.request.chain = None
+            stop_chain(run, shard, f"Plan {plan.flight_code} could not be scheduled.")
+            return
+        plans.update(status=FlightPlan.PROCESSING_EPM)
+        return store_schedules(start_dt, schedules, run, shard)
 
 
 def update_plan_status(plans, status):
-    for pk in plans:
-        plan = FlightPlan.objects.get(pk=pk)
-        plan.status = status
-        plan.save()
+    FlightPlan.objects.filter(pk__in=plans).update(status=status)
+
+
+# description of the plans of a run that has lost its schedules
+SCHEDULES_LOST = "The generated schedules were lost, please reschedule the plan."
+
+
+def schedules_lost(data, error: SchedulesExpired):
+    # the schedules of the chain are gone, the run cannot go on
+    logger.error(f"{error}, the scheduling run {handle_run(data)} has failed")
+    stop_chain(handle_run(data), handle_shard(data), SCHEDULES_LOST)
 
 
-@dataclasses.dataclass
-class EmployeeState:  # Класс, энкапсулирующий состояние конкретного сотрудника на одной итерации алгоритма
-    obj: Employee
-    location: Airport
-    time: datetime  # дата последнего изменения состояния
+def stop_chain(run, shard, description):
+    # The chain of the run stops without schedules: a shard is collected as a failed one, otherwise the run fails
+    # (see fail_run), so the incremental rescheduling does not wait for it
+    if shard is not None:
+        merge_shards(run, shard, None)
+    else:
+        fail_run(run, description)
+
+
+@shared_task
+def chain_failed(request, exc, traceback, run, shard):
+    # Error callback of the chains of a regeneration: one of the tasks has raised
+    logger.error(f"Task {request.id} of regeneration {run} has failed: {exc!r}")
+    stop_chain(run, shard, "Scheduling has failed, please reschedule the plan.")
 
 
 @shared_task(bind=True)
 def assign_employees(self, data):
-    start_dt, schedules = data
-    states: list[EmployeeState] = [
-        # if current location of an employee is unknown, we assume
-        # he is in LED
-        EmployeeState(emp, emp.planned_location_at(start_dt)
-                      or Airport.objects.get(id=1), start_dt)
-        for emp in Employee.objects.all().order_by('id')
-    ]
-    plans = set(flights[3] for flights in schedules[0])  # assuming all schedules share flightplans
-    update_plan_status(plans, FlightPlan.PROCESSING_EPM)
-
-    variants = []
-    for flights in schedules:
-        variant, failed = [], False
-        for (departure_time, arrival_time, aircraft_id, plan_id) in flights:
-            aircraft = Aircraft.objects.get(id=aircraft_id)
-            flight_plan = FlightPlan.objects.get(id=plan_id)
-
-            # this can be a complex predicate that decides
-            # whether or not an employee is suitable for the flight
-            def predicate(employeeState):
-                return (employeeState.location == flight_plan.source
-                        and
-                        employeeState.time <= departure_time)
-
-            available = list(filter(predicate, states))
-            adi = aircraft.aircraftdynamicinfo
-
-            # IndexError implies failure to find
-            try:
-                # Occupation ID:    # TODO: enums better than comments
-                # pilot = 1
-                # second pilot = 2
-                pilots = [e for e in available if e.obj.occupation.id in [
-                    1, 2]][:adi.pilots_number]
-                # senior attendant = 3
-                # attendant = 4
-                attendants = [e for e in available if e.obj.occupation.id in [
-                    3, 4]][:adi.attendants_number]
-            except IndexError:
-                failed = True
-                break
-            crew = pilots + attendants
-            for state in crew:
-                state.location = flight_plan.destination
-                state.time = arrival_time
-            variant.append(
-                (departure_time, arrival_time, aircraft_id,
-                 plan_id, [p.obj.id for p in crew])
-            )
-        if not failed:
-            variants.append(variant)
-
-    if not variants:
-        update_plan_status(plans, FlightPlan.ERROR_EPM)
+    if is_superseded(handle_run(data)):
+        logger.info(f"Regeneration {handle_run(data)} is superseded by a newer one")
+        discard_schedules(data)
         self.request.chain = None
         return
+    try:
+        start_dt, schedules = load_schedules(data)
+    except SchedulesExpired as error:
+        schedules_lost(data, error)
+        self.request.chain = None
+        return
+    with stage('assign_employees') as metrics:
+        with stage('assign_employees.load') as load_metrics:
+            # if current location of an employee is unknown, we assume
+            # he is in the home base
+            locations = Employee.planned_locations_at(start_dt, crew_home_base(ScheduleConfig.objects.all().first()))
+            occupations = dict(Employee.objects.values_list('pk', 'occupation'))
+            plans = {flights[3] for flights in schedules[0]}  # assuming all schedules share flightplans
+            update_plan_status(plans, FlightPlan.PROCESSING_EPM)
+            last_arrival = max((flight[1] for flights in schedules for flight in flights), default=start_dt)
+            unavailable = UnavailabilityIndex.load(start_dt, last_arrival)
+            routes = {pk: (source, destination) for pk, source, destination in FlightPlan.objects.filter(
+                pk__in={flight[3] for flights in schedules for flight in flights}
+            ).values_list('pk', 'source', 'destination')}
+            crew_numbers = {aircraft: (pilots, attendants) for aircraft, pilots, attendants in AircraftDynamicInfo
+                            .objects.values_list('aircraft', 'pilots_number', 'attendants_number')}
+            load_metrics.rows = len(occupations)
+
+        # every schedule starts from the same crew positions, the variants are assigned and scored in parallel
+        with stage('assign_employees.variants') as variants_metrics:
+            context = (occupations, locations, start_dt, routes, crew_numbers, unavailable)
+            variants = list(map_in_processes(assign_and_score_crew, schedules, context, len(schedules)))
+            variants_metrics.rows = sum(len(variant) for variant, score in variants)
+        metrics.rows = len(variants)
+
+        if not variants:
+            update_plan_status(plans, FlightPlan.ERROR_EPM)
+            discard_schedules(data)
+            self.request.chain = None
+            stop_chain(handle_run(data), handle_shard(data), "No crew could be assigned to the schedules.")
+            return
+
+        best = min(range(len(variants)), key=lambda idx: (variants[idx][1].total(), idx))
+        logger.info(f"Crew variant #{best + 1} of {len(variants)} is the best: {variants[best][1]}")
+        discard_schedules(data)
+        return store_schedules(start_dt, [variants[best][0]], handle_run(data), handle_shard(data))
 
-    # TODO: evaluate each one of the possible variants of crew
-    # configurations and choose the best one
-    def choose_best(variants):
-        return variants[0]
 
-    return start_dt, choose_best(variants)
+def assign_and_score_crew(occupations, locations, start_dt, routes, crew_numbers, unavailable, flights):
+    queues = CrewQueues.start(occupations, locations, start_dt)
+    variant = assign_crew(flights, queues, routes, crew_numbers, unavailable)
+    crew_locations = {employee: airport for employee, airport in locations.items() if queues.role(employee)}
+    return variant, score_variant(variant, routes, crew_numbers, crew_locations)
 
 
 @shared_task
 def create_flights(data):
-    start_dt, schedule = data
-    logger.info(f"Schedule: {schedule}")
-    # TODO Make all queries in single transaction
-    Flight.objects.filter(
-        canceled=False, planning_departure_datetime__gte=start_dt).delete()
-    for departure, arrival, aircraft_pk, plan_pk, crew in schedule:
-        plan = FlightPlan.objects.get(pk=plan_pk)
-        logger.info(
-            f"Departure: {departure} Arrival: {arrival} Aircraft: {aircraft_pk} Plan:  {plan}")
-        flight = Flight.objects.create(planning_departure_datetime=departure,
-                                       planning_arrival_datetime=arrival,
-                                       aircraft_id=aircraft_pk,
-                                       flight_plan=plan)
-        flight.employees.set(crew)
-        flight.save()
-        plan.status = FlightPlan.SUCCESS  # HAHA
-        plan.save()
+    if is_superseded(handle_run(data)):
+        # the newer regeneration is going to replace the same flights
+        logger.info(f"Regeneration {handle_run(data)} is superseded by a newer one, its flights are not written")
+        discard_schedules(data)
+        return
+    try:
+        start_dt, (schedule, ) = load_schedules(data)
+    except SchedulesExpired as error:
+        schedules_lost(data, error)
+        return
+    logger.info(f"Writing {len(schedule)} flights from {start_dt}")
+    with stage('create_flights') as metrics:
+        if write_schedule(start_dt, schedule, run=handle_run(data)):
+            metrics.rows = len(schedule)
+        else:
+            logger.info(f"Regeneration {handle_run(data)} is superseded by a newer one, its flights are not written")
+    discard_schedules(data)
+
+
+@shared_task
+def collect_shard(data):
+    # Last task of a shard: the last finished shard of the regeneration writes the flights of all of them
+    merge_shards(handle_run(data), handle_shard(data), data)
+
+
+def merge_shards(run, shard, data):
+    # data - the handle of the shard, None if it has failed
+    index, count = shard
+    handles = collect(run, index, count, data)
+    if handles is None:
+        logger.info(f"Shard {index + 1} of {count} is {'ready' if data is not None else 'failed'}")
+        return
+    finished = [handle for handle in handles if handle is not None]
+    start_dt, variants = None, []
+    try:
+        if len(finished) < count:
+            logger.info(f"{count - len(finished)} of {count} shards have failed, regeneration {run} has failed")
+            fail_run(run, "Scheduling of another part of the route network has failed.")
+            return
+        for handle in finished:
+            start_dt, (variant, ) = load_schedules(handle)
+            variants.append(variant)
+    except SchedulesExpired as error:
+        logger.error(f"{error}, the scheduling run {run} has failed")
+        fail_run(run, SCHEDULES_LOST)
+        return
+    finally:
+        for handle in finished:
+            discard_schedules(handle)
+    create_flights(store_schedules(start_dt, [merge_variants(variants)], run))
+
+
+def regenerate_schedules(start_dt: str):
+    # Full regeneration: re-plans every plan and replaces all the flights after start_dt.
+    # The chains of the regenerations started before this one stop at their next task.
+    run = new_regeneration_run()
+    components = plan_components(list(FlightPlan.objects.filter(
+        end_date__gte=timezone.datetime.fromisoformat(start_dt).date()
+    ).values_list('pk', 'source', 'destination')))
+    if len(components) <= 1:
+        return (generate_schedules.s(start_dt, run=run) | assign_employees.s() | create_flights.s()).on_error(
+            chain_failed.s(run, None)).delay()
+    logger.info(f"Regenerating {len(components)} independent parts of the route network")
+    return [(generate_schedules.s(start_dt, run=run, plan_pks=component, shard=[idx, len(components)]) |
+             assign_employees.s() | collect_shard.s()).on_error(chain_failed.s(run, [idx, len(components)])).delay()
+            for idx, component in enumerate(components)]
+
+
+def request_rescheduling(plan_pk, start_dt: str):
+    # Debounced rescheduling after a change of the plan (see crm/triggers.py)
+    request = SchedulingRequest.objects.create(flight_plan_id=plan_pk, start_dt=start_dt)
+    transaction.on_commit(lambda: run_scheduling_requests.apply_async(
+        (request.pk, ), countdown=settings.SCHEDULING_QUIET_PERIOD))
+    return request
+
+
+@shared_task
+def run_scheduling_requests(last_request):
+    # Coalesces the requests up to last_request: the incremental rescheduling for a single changed plan,
+    # otherwise one full regeneration from the earliest start
+    if should_wait(last_request):
+        logger.info(f"Scheduling request {last_request} is superseded by a newer one")
+        return
+    taken = take_requests(last_request)
+    if taken is None:
+        return
+    plans, start_dt = taken
+    if len(plans) == 1:
+        return reschedule_plan(plans.pop(), start_dt.isoformat())
+    logger.info(f"{len(plans)} plans have changed, regenerating all schedules")
+    regenerate_schedules(start_dt.isoformat())
+
+
+@shared_task(bind=True)
+def reschedule_plan(self, plan_pk, start_dt: str):
+    # Incremental mode: re-plans the changed plan and the aircraft rotations and crew pairings broken by it
+    # from start_dt onward, everything else stays in place.
+    # Falls back to the full regeneration if the changed flights do not fit into the current schedule
+    # or a scheduling run is in flight (see crm/triggers.py).
+    config = ScheduleConfig.objects.all().first()
+    if config is None:
+        return regenerate_schedules(start_dt)
+    run = new_incremental_run()
+    if run is None:
+        logger.info("A scheduling run is in flight, regenerating all schedules")
+        regenerate_schedules(start_dt)
+        return
+    try:
+        return reschedule_in_run(plan_pk, start_dt, config, run)
+    except Exception:
+        fail_run(run, "Incremental rescheduling has failed, please reschedule the plan.")
+        raise
+
+
+def reschedule_in_run(plan_pk, start_dt: str, config: ScheduleConfig, run: str):
+    start = timezone.datetime.fromisoformat(start_dt)
+    plan = FlightPlan.objects.get(pk=plan_pk)
+    plan.status = FlightPlan.PROCESSING_FPM
+    plan.save()
+
+    with stage('reschedule_plan.reschedule') as metrics:
+        scheduler = IncrementalScheduler.load(start, config)
+        banned_flights = set(Flight.objects.filter(
+            canceled=True, flight_plan=plan, planning_departure_datetime__gte=start
+        ).values_list('planning_departure_datetime', 'planning_arrival_datetime', 'flight_plan'))
+        occurrences = [info for info in get_flights_datetimes(plan, starts_datetime=start)
+                       if info not in banned_flights]
+        result, error = scheduler.reschedule(plan, occurrences)
+        metrics.rows, metrics.attempts, metrics.successes = len(occurrences), 1, int(error is None)
+    if error is not None:
+        logger.info(f"Incremental rescheduling failed: {error[1]} Regenerating all schedules.")
+        regenerate_schedules(start_dt)
+        return
+    logger.info(f"Plan {plan}: removed {len(result.removed)}, created {len(result.created)}, "
+                f"moved {len(result.moved)} flights")
+    with stage('reschedule_plan.write') as metrics:
+        if not scheduler.write(result, run):
+            # the newer run re-plans the plan as well
+            logger.info(f"Rescheduling {run} is superseded by a newer run, its flights are not written")
+            return
+        metrics.rows = len(result.removed) + len(result.created) + len(result.moved)
+    plan.status = FlightPlan.SUCCESS
+    plan.save()
+    return plan_pk
+
+
+@shared_task(bind=True)
+def compact_fuel_readings(self):
+    # Downsampling and retention of the fuel telemetry (see crm/telemetry.py), to be run periodically
+    downsampled, purged = compact_readings(timezone.now())
+    logger.info(f"Fuel readings: {downsampled} downsampled, {purged} past the retention removed")
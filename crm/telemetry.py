@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery
+from django.db.models.functions import Trunc
+from django.utils import timezone
+from django.utils.timezone import is_naive, make_aware
+from rest_framework import status
+
+from .models import Aircraft, AircraftDynamicInfo, FuelReading
+
+# Fuel readings are only appended. The latest reading of every aircraft is also kept in the "state" cache, which
+# does not go through the database, so the current fuel is read from neither the history nor AircraftDynamicInfo,
+# which the telemetry no longer writes on every reading. compact_readings (the compact_fuel_readings task) runs
+# periodically: copies the latest readings to AircraftDynamicInfo.fuel_remaining_kg, keeps only the last reading
+# of every FUEL_READINGS_BUCKET of the readings older than FUEL_READINGS_DOWNSAMPLE_AFTER and drops the ones older
+# than FUEL_READINGS_RETENTION.
+# The latest reading of an aircraft is never dropped.
+LATEST_FUEL_KEY = 'crm:fuel:latest'
+# cache alias of the latest readings
+STATE_CACHE = 'state'
+BATCH_SIZE = 5000
+
+
+def latest_fuel_key(aircraft) -> str:
+    return f'{LATEST_FUEL_KEY}:{aircraft}'
+
+
+def _is_newer(value, cached) -> bool:
+    # values are (recorded, fuel kg), recorded is None for the fuel of AircraftDynamicInfo
+    return cached is None or cached[0] is None or cached[0] <= value[0]
+
+
+def record_readings(readings: list):
+    # readings: [(aircraft pk, recorded, fuel kg)] of existing aircraft, inserted in batches of BATCH_SIZE
+    FuelReading.objects.bulk_create([
+        FuelReading(aircraft_id=aircraft, recorded=recorded, fuel_kg=fuel_kg)
+        for aircraft, recorded, fuel_kg in readings
+    ], batch_size=BATCH_SIZE)
+    latest = {}
+    for aircraft, recorded, fuel_kg in readings:
+        if _is_newer((recorded, fuel_kg), latest.get(aircraft)):
+            latest[aircraft] = (recorded, fuel_kg)
+
+    def update_cache():
+        # a delayed batch does not replace the newer cached readings (concurrent batches may still race)
+        cache = caches[STATE_CACHE]
+        cached = cache.get_many([latest_fuel_key(aircraft) for aircraft in latest])
+        cache.set_many({
+            latest_fuel_key(aircraft): value for aircraft, value in latest.items()
+            if _is_newer(value, cached.get(latest_fuel_key(aircraft)))
+        }, None)
+
+    transaction.on_commit(update_cache)
+
+
+def _parse(item, now):
+    # (aircraft pk, recorded, fuel kg) or None if the reading is malformed, recorded defaults to now
+    try:
+        aircraft, fuel_kg = int(item['aircraft']), int(item['fuel_remaining_kg'])
+        recorded = datetime.fromisoformat(item['recorded']) if item.get('recorded') else now
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return None
+    if fuel_kg < 0:
+        return None
+    return aircraft, make_aware(recorded) if is_naive(recorded) else recorded, fuel_kg
+
+
+def record_fuel(items: list) -> list:
+    # Readings {"aircraft": pk, "fuel_remaining_kg": kg[, "recorded": ISO 8601]} -> the HTTP status of every
+    # reading: 400 - malformed, 404 - unknown aircraft. The valid readings are recorded.
+    parsed = [_parse(item, timezone.now()) for item in items]
+    known = set(Aircraft.objects.filter(pk__in={reading[0] for reading in parsed if reading})
+                .values_list('pk', flat=True))
+    record_readings([reading for reading in parsed if reading and reading[0] in known])
+    return [status.HTTP_400_BAD_REQUEST if reading is None else
+            status.HTTP_200_OK if reading[0] in known else status.HTTP_404_NOT_FOUND for reading in parsed]
+
+
+def latest_fuel_many(aircraft) -> dict:
+    # {aircraft pk: (recorded, fuel kg)} of the latest readings, (None, fuel kg) of AircraftDynamicInfo for the
+    # aircraft without readings, the aircraft with neither are left out. One query for all the uncached aircraft.
+    cache = caches[STATE_CACHE]
+    keys = {pk: latest_fuel_key(pk) for pk in aircraft}
+    cached = cache.get_many(keys.values())
+    latest = {pk: tuple(cached[key]) for pk, key in keys.items() if key in cached}
+    missing = [pk for pk in keys if pk not in latest]
+    if missing:
+        readings = FuelReading.objects.filter(aircraft=OuterRef('pk')).order_by('-recorded')
+        loaded = {}
+        for pk, recorded, fuel_kg, info_fuel_kg in Aircraft.objects.filter(pk__in=missing).annotate(
+            recorded=Subquery(readings.values('recorded')[:1]), fuel_kg=Subquery(readings.values('fuel_kg')[:1]),
+        ).values_list('pk', 'recorded', 'fuel_kg', 'aircraftdynamicinfo__fuel_remaining_kg'):
+            if recorded is not None:
+                loaded[pk] = (recorded, fuel_kg)
+            elif info_fuel_kg is not None:
+                loaded[pk] = (None, info_fuel_kg)
+        for pk, value in loaded.items():
+            # add: a reading recorded meanwhile is not replaced
+            cache.add(keys[pk], value, None)
+        latest.update(loaded)
+    return latest
+
+
+def latest_fuel(aircraft):
+    # (recorded, fuel kg) of the latest reading, (None, fuel kg) of AircraftDynamicInfo if there are no readings,
+    # None if there is neither
+    return latest_fuel_many([aircraft]).get(aircraft)
+
+
+def _later_readings():
+    return FuelReading.objects.filter(aircraft=OuterRef('aircraft'), recorded__gt=OuterRef('recorded'))
+
+
+def compact_readings(now: datetime) -> tuple:
+    # -> (number of the downsampled readings, number of the readings past the retention)
+    with transaction.atomic():
+        dynamic_info = list(AircraftDynamicInfo.objects.annotate(latest_fuel_kg=Subquery(
+            FuelReading.objects.filter(aircraft=OuterRef('aircraft')).order_by('-recorded').values('fuel_kg')[:1]
+        )).exclude(latest_fuel_kg=None).exclude(latest_fuel_kg=F('fuel_remaining_kg')))
+        for info in dynamic_info:
+            info.fuel_remaining_kg = info.latest_fuel_kg
+        AircraftDynamicInfo.objects.bulk_update(dynamic_info, ['fuel_remaining_kg'], batch_size=BATCH_SIZE)
+
+        bucket = Trunc('recorded', settings.FUEL_READINGS_BUCKET, tzinfo=timezone.utc)
+        downsampled, _ = FuelReading.objects.annotate(bucket=bucket).filter(
+            Exists(_later_readings().annotate(bucket=bucket).filter(bucket=OuterRef('bucket'))),
+            recorded__lt=now - timedelta(seconds=settings.FUEL_READINGS_DOWNSAMPLE_AFTER),
+        ).delete()
+        purged, _ = FuelReading.objects.filter(
+            Exists(_later_readings()), recorded__lt=now - timedelta(seconds=settings.FUEL_READINGS_RETENTION),
+        ).delete()
+    return downsampled, purged
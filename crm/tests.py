@@ -1,9 +1,38 @@
+import json
 import os
-from datetime import datetime, timezone
-from django.test import TestCase, Client
+import tempfile
+from statistics import pstdev
+from datetime import datetime, timedelta, timezone
+from airline.celery import app as celery_app
+from billiard import Pool
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from unittest.mock import patch
-from .models import Employee, Airport, FlightPlan, Flight, Aircraft, AircraftDeviceLife
-from .tasks import assign_employees
+from .models import Employee, Airport, FlightPlan, Flight, Aircraft, AircraftDeviceLife, ScheduleConfig, EmployeeLog, \
+    SchedulingRequest, AircraftDynamicInfo, FuelReading, SchedulingRun, ShardResult, SchedulesPayload, \
+    StageCounter
+from .tasks import assign_employees, generate_schedules, generate_single_schedule, get_flights_datetimes, \
+    create_flights, reschedule_plan, get_all_flights_datetimes, check_flights_compatibility, FlightWarning, \
+    request_rescheduling, run_scheduling_requests, collect_shard, regenerate_schedules, compact_fuel_readings
+from .availability import UnavailabilityIndex
+from .compatibility import WARNINGS_VERSION_KEY
+from .benchmark import NetworkSize, generate_network, run_stages
+from .board import checked_flights, flights_page
+from .crew import ATTENDANT_OCCUPATIONS, PILOT_OCCUPATIONS, CrewQueues
+from .forecast import DeviceLifeForecast, flight_hours
+from .incremental import IncrementalScheduler
+from .metrics import stage
+from .movements import apply_movements
+from .payloads import SchedulesExpired, discard_schedules, load_schedules, pack_schedules, store_schedules
+from .rotations import RotationMatching
+from .scoring import score_variant
+from .sharding import plan_components
+from .snapshot import SchedulingSnapshot
+from .telemetry import latest_fuel, record_readings
+from .timeline import FleetTimeline, TimelineFlight, aircraft_on_ground
+from .triggers import new_regeneration_run
+from .writer import write_schedule
 from django.utils import timezone
 from django.utils.timezone import make_aware
 
@@ -31,6 +60,17 @@ class EmployeeModelTest(TestCase):
         loc2 = empl.planned_location_at(date2)
         self.assertFalse(loc2.exists())
 
+    def test_planned_locations_at(self):
+        for date in ("2021-04-25T06:00:00+00:00", "2021-04-27T06:00:00+00:00", "2021-05-03T00:00:00+00:00"):
+            date = datetime.fromisoformat(date)
+            with self.subTest(date=date):
+                with self.assertNumQueries(1):
+                    locations = Employee.planned_locations_at(date, default=3)
+                self.assertEquals(locations, {
+                    employee.pk: getattr(employee.planned_location_at(date), 'pk', 3)
+                    for employee in Employee.objects.all()
+                })
+
     def test_is_available(self):
         john = Employee.objects.get(id=12)
         start = datetime.fromisoformat("2021-05-11T00:00:00+00:00")
@@ -53,6 +93,22 @@ class EmployeeModelTest(TestCase):
         with self.subTest():
             self.assertFalse(john.is_available(start4, end4))
 
+    def test_unavailability_index(self):
+        # overlaps the log from 2021-05-17 to 2021-05-20, the periods are merged
+        EmployeeLog.objects.create(employee_id=12, status=EmployeeLog.LEAVE_PAID,
+                                   disability_start=datetime(2021, 5, 19, tzinfo=timezone.utc),
+                                   disability_end=datetime(2021, 5, 22, tzinfo=timezone.utc))
+        john = Employee.objects.get(id=12)
+        since = datetime(2021, 5, 10, tzinfo=timezone.utc)
+        index = UnavailabilityIndex.load(since, since + timezone.timedelta(days=20))
+        points = [since + timezone.timedelta(hours=12 * i) for i in range(30)]
+        for start in points:
+            for end in points:
+                if start < end:
+                    with self.subTest(start=start, end=end):
+                        self.assertEquals(index.is_available(john.pk, start, end), john.is_available(start, end))
+        self.assertTrue(index.is_available(4, since, points[-1]))
+
 class AssignEmployeesTest(TestCase):
     fixtures = [
         "auth.Group.json",
@@ -88,14 +144,796 @@ class AssignEmployeesTest(TestCase):
                  datetime(2021, 5, 3, 6, 0, tzinfo=timezone.utc), 1, 1)
             ],
         ]
-        start_date, schedule = assign_employees(
-            (start_date, schedule_variants))
+        start_date, (schedule, ) = load_schedules(assign_employees(store_schedules(start_date, schedule_variants)))
 
         ans = [(*tup, [4, 5, 22, 23, 24, 25, 26, 27])
                for tup in schedule_variants[0]]
         self.assertEquals(start_date, start_date)
         self.assertEquals(ans, schedule)
 
+    def test_best_variant_is_chosen(self):
+        start_date = datetime(2021, 4, 26, 0, 0, tzinfo=timezone.utc)
+        flight = (start_date, datetime(2021, 4, 26, 6, 0, tzinfo=timezone.utc), 1)
+        # nobody is in SVO to fly by plan 2
+        start_date, (schedule, ) = load_schedules(
+            assign_employees(store_schedules(start_date, [[(*flight, 2)], [(*flight, 1)]])))
+        self.assertEquals(schedule, [(*flight, 1, [4, 5, 22, 23, 24, 25, 26, 27])])
+
+    def test_score_variant(self):
+        day = datetime(2021, 4, 26, tzinfo=timezone.utc)
+        hour = timezone.timedelta(hours=1)
+        variant = [
+            (day, day + hour * 2, 1, 1, [1, 2]),
+            (day + hour * 3, day + hour * 5, 2, 2, [1]),
+        ]
+        score = score_variant(variant, {1: (1, 2), 2: (2, 1)}, {1: (1, 1), 2: (2, 0)}, {1: 1, 2: 1, 3: 1})
+        self.assertEquals((score.missing_crew, score.deadheading, score.idle_hours, score.spread), (1, 1, 1.0, 2))
+        self.assertAlmostEqual(score.duty_imbalance, pstdev([4, 2, 0]))
+        self.assertLess(score.total(), score_variant(variant[:1], {1: (1, 2)}, {1: (3, 1)}, {1: 1}).total())
+
+
+class CrewQueuesTest(TestCase):
+    def test_take(self):
+        start = datetime(2021, 4, 26, tzinfo=timezone.utc)
+        hour = timezone.timedelta(hours=1)
+        queues = CrewQueues.start({1: 1, 2: 2, 3: 1, 4: 3}, {1: 1, 2: 1, 3: 2, 4: 1}, start)
+        unavailable = UnavailabilityIndex([(1, start + hour, start + hour * 2)])
+        with self.subTest(msg='Lowest pks of the role in the airport'):
+            self.assertEquals(queues.take(PILOT_OCCUPATIONS, 1, start, start + hour, 5), [1, 2])
+        queues.add(1, 2, start + hour)
+        queues.add(2, 2, start + hour * 3)
+        with self.subTest(msg='Busy and unavailable employees are skipped'):
+            self.assertEquals(queues.take(PILOT_OCCUPATIONS, 2, start + hour * 2, start + hour * 3, 2, unavailable),
+                              [3])
+        with self.subTest(msg='Skipped employees stay in the airport'):
+            self.assertEquals(queues.take(PILOT_OCCUPATIONS, 2, start + hour * 3, start + hour * 4, 2), [1, 2])
+            self.assertEquals(queues.take(ATTENDANT_OCCUPATIONS, 1, start, start + hour, 2), [4])
+
+
+class FleetTimelineTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.Flights.json",
+    ]
+
+    def setUp(self):
+        self.service = timezone.timedelta(minutes=45)
+        self.timeline = FleetTimeline({1: 1, 2: 1}, service_time=self.service)
+        self.flight = TimelineFlight(datetime(2021, 4, 26, 0, 0, tzinfo=timezone.utc),
+                                     datetime(2021, 4, 26, 6, 0, tzinfo=timezone.utc), 1, 1, 2, 1)
+
+    def test_aircraft_at(self):
+        self.timeline.add_flight(self.flight)
+        with self.subTest(msg='Before departure'):
+            self.assertEquals(self.timeline.aircraft_at(1, self.flight.departure - self.service), {1, 2})
+            self.assertEquals(self.timeline.available_at(1, self.flight.departure - self.service), {2})
+        with self.subTest(msg='In the air'):
+            self.assertEquals(self.timeline.aircraft_at(1, self.flight.departure), {2})
+            self.assertEquals(self.timeline.aircraft_at(2, self.flight.arrival), set())
+        with self.subTest(msg='After arrival and service'):
+            self.assertEquals(self.timeline.aircraft_at(2, self.flight.arrival + self.service), {1})
+        with self.subTest(msg='Removed flight'):
+            copy = self.timeline.copy()
+            copy.remove_flight(self.flight)
+            self.assertEquals(copy.available_at(1, self.flight.arrival + self.service), {1, 2})
+            self.assertEquals(copy.aircraft_at(2, self.flight.arrival + self.service), set())
+        with self.subTest(msg='Original is not changed by the copy'):
+            self.assertEquals(self.timeline.available_at(2, self.flight.arrival + self.service), {1})
+
+    def test_invalid_flights(self):
+        self.assertEquals(self.timeline.add_flight(self.flight), [])
+        back = TimelineFlight(self.flight.arrival + self.service, self.flight.arrival + self.service * 2, 1, 2, 1, 2)
+        wrong_source = TimelineFlight(back.arrival, back.arrival + self.service, 2, 2, 1, 2)
+        self.assertEquals(self.timeline.add_flight(back), [])
+        self.assertEquals(self.timeline.add_flight(wrong_source), [wrong_source])
+        self.assertEquals(self.timeline.remove_flight(self.flight), [back])
+        self.assertEquals(self.timeline.invalid_flights(), [back, wrong_source])
+
+    def test_load(self):
+        timeline = FleetTimeline.load(service_time=self.service)
+        with self.subTest(msg='All planned flights are loaded'):
+            self.assertEquals([f.key for f in timeline.flights(1)], [1, 2, 3, 4, 5, 6, 7])
+        with self.subTest(msg='Aircraft is moved by planned flights'):
+            self.assertEquals(timeline.position_at(1, datetime(2021, 4, 26, 12, 0, tzinfo=timezone.utc)), 2)
+        until = FleetTimeline.load(until=datetime(2021, 4, 28, 0, 0, tzinfo=timezone.utc))
+        with self.subTest(msg='Flights after until are skipped'):
+            self.assertEquals([f.key for f in until.flights(1)], [1, 2])
+
+    def test_aircraft_on_ground(self):
+        day = datetime(2021, 4, 26, tzinfo=timezone.utc)
+        hours = timezone.timedelta(hours=6)
+        Flight.objects.filter(pk=1).update(actual_departure_datetime=day, actual_arrival_datetime=day + hours,
+                                           actual_destination=2)
+        Flight.objects.filter(pk=2).update(actual_departure_datetime=day + hours * 4)
+        with self.subTest(msg='Aircraft in the air'), self.assertNumQueries(1):
+            self.assertEquals(aircraft_on_ground(), {})
+
+        Flight.objects.filter(pk=2).update(actual_arrival_datetime=day + hours * 5, actual_destination=1)
+        Flight.objects.create(flight_plan_id=1, aircraft_id=2, planning_departure_datetime=day,
+                              planning_arrival_datetime=day + hours, actual_departure_datetime=day,
+                              actual_arrival_datetime=day + hours, actual_destination_id=2)
+        with self.subTest(msg='Last arrival only'):
+            self.assertEquals(aircraft_on_ground(), {1: (1, day + hours * 5), 2: (2, day + hours)})
+            self.assertEquals(aircraft_on_ground([2]), {2: (2, day + hours)})
+        with self.subTest(msg='Several airports in one query'), self.assertNumQueries(1):
+            self.assertEquals(aircraft_on_ground(Airport.objects.all()),
+                              {1: (1, day + hours * 5), 2: (2, day + hours)})
+        with self.subTest(msg='Landed before'):
+            self.assertEquals(aircraft_on_ground(landed_before=day + hours * 2), {2: (2, day + hours)})
+
+
+class FlightsDatetimesTest(TestCase):
+    fixtures = [
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+    ]
+
+    @staticmethod
+    def walk_days(plan, starts_datetime):
+        current_date, results = max(plan.start_date, starts_datetime.date()), []
+        while current_date <= plan.end_date:
+            if str(current_date.weekday()) in plan.days_of_week:
+                departure = datetime.combine(current_date, plan.planning_departure_time, tzinfo=timezone.utc)
+                arrival = datetime.combine(current_date, plan.planning_arrival_time, tzinfo=timezone.utc)
+                if arrival < departure:
+                    arrival += timezone.timedelta(days=1)
+                if departure >= starts_datetime:
+                    results.append((departure, arrival, plan.pk))
+            current_date += timezone.timedelta(days=1)
+        return results
+
+    def test_same_as_walking_days(self):
+        plan = FlightPlan.objects.get(pk=1)
+        plan.end_date = plan.start_date + timezone.timedelta(days=100)
+        for days, departure, arrival in (('1,4,6', '00:00:00', '06:00:00'), ('0,2,3,5', '22:30:00', '01:15:00')):
+            plan.days_of_week = days.split(',')
+            plan.planning_departure_time = datetime.strptime(departure, '%H:%M:%S').time()
+            plan.planning_arrival_time = datetime.strptime(arrival, '%H:%M:%S').time()
+            for starts in ('2021-04-01T00:00:00+00:00', '2021-04-28T00:00:00+00:00', '2021-04-28T23:00:00+00:00'):
+                starts = datetime.fromisoformat(starts)
+                with self.subTest(msg=f'Days {days}, departure {departure}, from {starts}'):
+                    self.assertEquals(get_flights_datetimes(plan, starts), self.walk_days(plan, starts))
+
+    def test_all_plans_are_sorted(self):
+        starts = datetime(2021, 4, 25, 0, 0, tzinfo=timezone.utc)
+        flights_info = get_all_flights_datetimes(FlightPlan.objects.all(), starts)
+        self.assertEquals(flights_info, sorted(flights_info, key=lambda info: info[0]))
+        self.assertEquals(len(flights_info), 5)
+
+
+class GenerateSchedulesTest(TestCase):
+    fixtures = [
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.AircraftDynamicInfo.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        # aircraft 1 landed in LED, aircraft 2 landed in DME
+        landed = datetime(2021, 4, 20, 6, 0, tzinfo=timezone.utc)
+        for aircraft in (1, 2):
+            Flight.objects.create(flight_plan_id=aircraft, aircraft_id=aircraft, actual_destination_id=aircraft,
+                                  planning_departure_datetime=landed, planning_arrival_datetime=landed,
+                                  actual_departure_datetime=landed, actual_arrival_datetime=landed)
+        self.start_dt = datetime(2021, 4, 25, 0, 0, tzinfo=timezone.utc)
+
+    def test_seed_is_reproducible(self):
+        flights_info = sorted(
+            f for plan in FlightPlan.objects.all() for f in get_flights_datetimes(plan, self.start_dt))
+        schedule, error = generate_single_schedule(flights_info, set(), seed=7)
+        self.assertIsNone(error)
+        for _ in range(3):
+            self.assertEquals(generate_single_schedule(flights_info, set(), seed=7), (schedule, None))
+
+    def test_attempt_uses_snapshot_only(self):
+        snapshot = SchedulingSnapshot.load(self.start_dt)
+        flights_info = sorted(
+            f for plan in snapshot.plans.values() for f in get_flights_datetimes(plan, self.start_dt))
+        with self.assertNumQueries(0):
+            schedule, error = generate_single_schedule(flights_info, set(), snapshot, seed=1)
+        self.assertIsNone(error)
+        self.assertEquals(len(schedule), len(flights_info))
+
+    def test_successes_limit(self):
+        ScheduleConfig.objects.update(max_successful_schedules=2)
+        start_dt, schedules = load_schedules(generate_schedules(self.start_dt.isoformat(), seed=3))
+        self.assertEquals(len(schedules), 2)
+        self.assertEquals(schedules, load_schedules(generate_schedules(self.start_dt.isoformat(), seed=3))[1])
+
+    def test_flow_scheduler(self):
+        ScheduleConfig.objects.update(scheduler=ScheduleConfig.FLOW_SCHEDULER)
+        start_dt, schedules = load_schedules(generate_schedules(self.start_dt.isoformat()))
+        self.assertEquals(len(schedules), 1)
+        snapshot = SchedulingSnapshot.load(self.start_dt)
+        timeline = snapshot.timeline.copy()
+        capacities = {pk: capacity for capacity, pk in snapshot.capacities}
+        for departure, arrival, aircraft, plan_pk in schedules[0]:
+            plan = snapshot.plans[plan_pk]
+            with self.subTest(departure=departure, plan=plan_pk):
+                self.assertGreaterEqual(capacities[aircraft], plan.passanger_capacity)
+                self.assertEquals(timeline.add_flight(TimelineFlight(departure, arrival, aircraft, plan.source_id,
+                                                                     plan.destination_id)), [])
+
+    def test_flow_scheduler_error(self):
+        ScheduleConfig.objects.update(scheduler=ScheduleConfig.FLOW_SCHEDULER)
+        FlightPlan.objects.filter(pk=1).update(passanger_capacity=10000)
+        self.assertIsNone(generate_schedules(self.start_dt.isoformat()))
+        self.assertEquals(FlightPlan.objects.get(pk=1).status, FlightPlan.ERROR_FPM)
+
+    def test_rotation_matching_capacity(self):
+        # the small aircraft 2 is taken first, but only the big one can fly the second flight after the first one
+        plans = {1: FlightPlan(pk=1, source_id=1, destination_id=2, passanger_capacity=50),
+                 2: FlightPlan(pk=2, source_id=2, destination_id=1, passanger_capacity=250)}
+        snapshot = SchedulingSnapshot(config=None, plans=plans, airports={}, aircraft={},
+                                      capacities=((100, 2), (300, 1)), timeline=FleetTimeline({1: 1, 2: 1}))
+        flights = [(self.start_dt + timedelta(hours=departure), self.start_dt + timedelta(hours=departure + 1), plan)
+                   for departure, plan in ((0, 1), (2, 2), (2, 1))]
+        schedule, error = RotationMatching(snapshot, flights).solve()
+        self.assertIsNone(error)
+        self.assertEquals([aircraft for _, _, aircraft, _ in schedule], [1, 1, 2])
+
+
+class PooledGenerationTest(TransactionTestCase):
+    # the pool closes the database connections before forking, which a TestCase transaction would not survive
+    fixtures = [
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.AircraftDynamicInfo.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        landed = datetime(2021, 4, 20, 6, 0, tzinfo=timezone.utc)
+        for aircraft in (1, 2):
+            Flight.objects.create(flight_plan_id=aircraft, aircraft_id=aircraft, actual_destination_id=aircraft,
+                                  planning_departure_datetime=landed, planning_arrival_datetime=landed,
+                                  actual_departure_datetime=landed, actual_arrival_datetime=landed)
+        self.start_dt = datetime(2021, 4, 25, 0, 0, tzinfo=timezone.utc).isoformat()
+
+    def test_same_schedules_as_sequential(self):
+        ScheduleConfig.objects.update(max_flight_generation_attempts=6)
+        sequential = load_schedules(generate_schedules(self.start_dt, seed=3))[1]
+        with override_settings(SCHEDULE_GENERATION_PROCESSES=2), patch('crm.tasks.Pool', wraps=Pool) as pool:
+            pooled = load_schedules(generate_schedules(self.start_dt, seed=3))[1]
+        self.assertEquals(pool.call_args[0][0], 2)
+        self.assertEquals(len(pooled), 6)
+        self.assertEquals(pooled, sequential)
+
+
+class ShardedGenerationTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.AircraftDynamicInfo.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        # plans 3 and 4 fly between two other airports, aircraft 3 and 5 are there
+        for pk, iata in ((3, 'AAA'), (4, 'BBB')):
+            Airport.objects.create(pk=pk, iata=iata, icao=f'X{iata}', name=iata, latitude=0, longitude=0, altitude=0,
+                                   timezone='UTC', country='Nowhere', city=iata)
+        for pk, (source, destination) in ((3, (3, 4)), (4, (4, 3))):
+            plan = FlightPlan.objects.get(pk=pk - 2)
+            plan.pk, plan.source_id, plan.destination_id, plan.flight_code = pk, source, destination, f'PLAN-{pk}'
+            plan.save(force_insert=True)
+        landed = datetime(2021, 4, 20, 6, 0, tzinfo=timezone.utc)
+        for aircraft, plan, airport in ((1, 2, 1), (2, 1, 2), (3, 4, 3), (5, 3, 4)):
+            Flight.objects.create(flight_plan_id=plan, aircraft_id=aircraft, actual_destination_id=airport,
+                                  planning_departure_datetime=landed, planning_arrival_datetime=landed,
+                                  actual_departure_datetime=landed, actual_arrival_datetime=landed)
+        self.start_dt = datetime(2021, 4, 25, 0, 0, tzinfo=timezone.utc).isoformat()
+
+    def test_plan_components(self):
+        plans = [(1, 1, 2), (2, 2, 1), (3, 3, 4), (4, 5, 6), (5, 6, 2)]
+        self.assertEquals(plan_components(plans), [[1, 2, 4, 5], [3]])
+
+    def test_shards_are_written_together(self):
+        celery_app.conf.task_always_eager = True
+        try:
+            shards = regenerate_schedules(self.start_dt)
+        finally:
+            celery_app.conf.task_always_eager = False
+        self.assertEquals(len(shards), 2)
+        flights = Flight.objects.filter(actual_departure_datetime__isnull=True)
+        for plan in FlightPlan.objects.all():
+            with self.subTest(plan=plan.pk):
+                self.assertEquals(flights.filter(flight_plan=plan).count(),
+                                  len(get_flights_datetimes(plan, datetime.fromisoformat(self.start_dt))))
+                self.assertEquals(plan.status, FlightPlan.SUCCESS)
+        self.assertEquals(set(flights.filter(flight_plan__in=(3, 4)).values_list('aircraft', flat=True)), {3, 5})
+        self.assertEquals(FleetTimeline.load().invalid_flights(), [])
+
+    def test_last_shard_writes(self):
+        run = new_regeneration_run()
+        handles = [assign_employees(generate_schedules(self.start_dt, run=run, plan_pks=plans, shard=[idx, 2]))
+                   for idx, plans in enumerate(([1, 2], [3, 4]))]
+        expected = sum(len(load_schedules(handle)[1][0]) for handle in handles)
+        collect_shard(handles[1])
+        self.assertFalse(Flight.objects.filter(actual_departure_datetime__isnull=True).exists())
+        # the finished shards are kept in the database, not in the evicting cache
+        self.assertEquals(list(ShardResult.objects.filter(run__token=run).values_list('index', flat=True)), [1])
+        collect_shard(handles[0])
+        self.assertTrue(SchedulingRun.objects.get(token=run).merged)
+        self.assertFalse(ShardResult.objects.exists())
+        written = Flight.objects.filter(actual_departure_datetime__isnull=True).count()
+        self.assertEquals(written, expected)
+        # a repeated delivery of a shard does not write again
+        collect_shard(handles[0])
+        self.assertEquals(Flight.objects.filter(actual_departure_datetime__isnull=True).count(), written)
+
+    def test_failed_shard(self):
+        run = new_regeneration_run()
+        handles = [generate_schedules(self.start_dt, run=run, plan_pks=plans, shard=[idx, 2])
+                   for idx, plans in enumerate(([1, 2], [3, 4]))]
+        # the second shard loses its schedules before the crew is assigned
+        discard_schedules(handles[1])
+        self.assertIsNone(assign_employees(handles[1]))
+        self.assertEquals(FlightPlan.objects.get(pk=1).status, FlightPlan.PROCESSING_EPM)
+        collect_shard(assign_employees(handles[0]))
+        self.assertFalse(Flight.objects.filter(actual_departure_datetime__isnull=True).exists())
+        statuses = dict(FlightPlan.objects.values_list('pk', 'status'))
+        self.assertEquals(statuses, dict.fromkeys((1, 2, 3, 4), FlightPlan.ERROR_EPM))
+        self.assertTrue(SchedulingRun.objects.get(token=run).finished)
+        self.assertFalse(SchedulesPayload.objects.exists())
+
+
+class ReschedulePlanTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.AircraftDynamicInfo.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        # aircraft 1 and 3 landed in LED, aircraft 2 landed in DME
+        landed = datetime(2021, 4, 20, 6, 0, tzinfo=timezone.utc)
+        for aircraft, airport in ((1, 1), (2, 2), (3, 1)):
+            Flight.objects.create(flight_plan_id=airport, aircraft_id=aircraft, actual_destination_id=airport,
+                                  planning_departure_datetime=landed, planning_arrival_datetime=landed,
+                                  actual_departure_datetime=landed, actual_arrival_datetime=landed)
+        self.start_dt = datetime(2021, 4, 25, 0, 0, tzinfo=timezone.utc).isoformat()
+        create_flights(assign_employees(generate_schedules(self.start_dt)))
+        self.plan2_flights = set(Flight.objects.filter(flight_plan=2).values_list('pk', flat=True))
+
+    @patch('crm.tasks.regenerate_schedules')
+    def test_changed_plan_is_rescheduled(self, regenerate):
+        FlightPlan.objects.filter(pk=1).update(days_of_week='0,1,4')
+        self.assertEquals(reschedule_plan(1, self.start_dt), 1)
+        regenerate.assert_not_called()
+        with self.subTest(msg='New occurrences are created'):
+            self.assertEquals(Flight.objects.filter(flight_plan=1, actual_departure_datetime__isnull=True).count(), 4)
+        with self.subTest(msg='Flights of other plans are kept'):
+            self.assertEquals(set(Flight.objects.filter(flight_plan=2).values_list('pk', flat=True)),
+                              self.plan2_flights)
+        with self.subTest(msg='New flights are staffed'):
+            self.assertFalse(Flight.objects.filter(flight_plan=1, actual_departure_datetime__isnull=True,
+                                                   employees=None).exists())
+        with self.subTest(msg='Schedule is valid'):
+            self.assertEquals(FleetTimeline.load().invalid_flights(), [])
+        self.assertEquals(FlightPlan.objects.get(pk=1).status, FlightPlan.SUCCESS)
+
+    @patch('crm.tasks.regenerate_schedules')
+    def test_fallback_to_full_regeneration(self, regenerate):
+        FlightPlan.objects.filter(pk=1).update(passanger_capacity=10000)
+        self.assertIsNone(reschedule_plan(1, self.start_dt))
+        regenerate.assert_called_once_with(self.start_dt)
+
+    @patch('crm.tasks.regenerate_schedules')
+    def test_run_in_flight(self, regenerate):
+        # the full regeneration has read the plans before the change
+        run = new_regeneration_run()
+        assign_employees(generate_schedules(self.start_dt, run=run))
+        FlightPlan.objects.filter(pk=1).update(days_of_week='0,1,4')
+        flights = set(Flight.objects.values_list('pk', flat=True))
+        self.assertIsNone(reschedule_plan(1, self.start_dt))
+        regenerate.assert_called_once_with(self.start_dt)
+        self.assertEquals(set(Flight.objects.values_list('pk', flat=True)), flights)
+
+    def test_stale_run_is_not_written(self):
+        run = new_regeneration_run()
+        handle = assign_employees(generate_schedules(self.start_dt, run=run))
+        FlightPlan.objects.filter(pk=1).update(days_of_week='0,1,4')
+        # the stale run is taken for a dead one, so the change is rescheduled incrementally
+        with override_settings(SCHEDULING_RUN_TIMEOUT=0):
+            self.assertEquals(reschedule_plan(1, self.start_dt), 1)
+        rescheduled = set(Flight.objects.values_list('pk', flat=True))
+        with self.subTest(msg='Stale chain'):
+            create_flights(handle)
+            self.assertEquals(set(Flight.objects.values_list('pk', flat=True)), rescheduled)
+        with self.subTest(msg='Write of the stale run'):
+            self.assertFalse(write_schedule(self.start_dt, [], run=run))
+            self.assertEquals(set(Flight.objects.values_list('pk', flat=True)), rescheduled)
+
+    def test_after_failed_run(self):
+        # the crew assignment of a full regeneration raises
+        celery_app.conf.task_always_eager = True
+        try:
+            with patch('crm.tasks.assign_and_score_crew', side_effect=RuntimeError('No crew')), \
+                    self.assertRaises(RuntimeError):
+                regenerate_schedules(self.start_dt)
+        finally:
+            celery_app.conf.task_always_eager = False
+        with self.subTest(msg='Run is failed'):
+            self.assertTrue(SchedulingRun.objects.get().finished)
+            self.assertEquals(set(FlightPlan.objects.values_list('status', flat=True)), {FlightPlan.ERROR_EPM})
+        FlightPlan.objects.filter(pk=1).update(days_of_week='0,1,4')
+        with patch('crm.tasks.regenerate_schedules') as regenerate:
+            self.assertEquals(reschedule_plan(1, self.start_dt), 1)
+        regenerate.assert_not_called()
+        self.assertEquals(Flight.objects.filter(flight_plan=1, actual_departure_datetime__isnull=True).count(), 4)
+
+    def test_superseded_rescheduling(self):
+        FlightPlan.objects.filter(pk=1).update(days_of_week='0,1,4')
+        flights = set(Flight.objects.values_list('pk', flat=True))
+        reschedule = IncrementalScheduler.reschedule
+
+        def interleaved(scheduler, *args):
+            # a full regeneration starts while the plan is being rescheduled
+            new_regeneration_run()
+            return reschedule(scheduler, *args)
+
+        with patch.object(IncrementalScheduler, 'reschedule', interleaved):
+            self.assertIsNone(reschedule_plan(1, self.start_dt))
+        self.assertEquals(set(Flight.objects.values_list('pk', flat=True)), flights)
+
+
+class SchedulePayloadsTest(TestCase):
+    def test_round_trip(self):
+        start = datetime(2021, 4, 26, 0, 0, 0, 250, tzinfo=timezone.utc)
+        hour = timezone.timedelta(hours=1)
+        schedules = [[(start + hour * idx, start + hour * (idx + 2), idx % 3 + 1, idx % 2 + 1) for idx in range(50)],
+                     [], [(start, start + hour, 1, 2)]]
+        variant = [(*flight, list(range(idx % 4))) for idx, flight in enumerate(schedules[0])]
+        for value in (schedules, [variant], []):
+            with self.subTest(value=len(value)):
+                handle = store_schedules(start, value)
+                # the handle is what goes through the broker
+                self.assertEquals(json.loads(json.dumps(handle)), list(handle))
+                self.assertEquals(load_schedules(json.loads(json.dumps(handle))), (start, value))
+        # compared with the JSON the broker got before
+        attempts = [[(*flight[:2], (idx + attempt) % 5, flight[3]) for idx, flight in enumerate(schedules[0])]
+                    for attempt in range(20)]
+        self.assertLess(len(pack_schedules(attempts)), len(json.dumps(attempts, default=str)) / 10)
+
+    def test_discarded(self):
+        handle = store_schedules(datetime(2021, 4, 26, tzinfo=timezone.utc), [])
+        discard_schedules(handle)
+        with self.assertRaises(SchedulesExpired):
+            load_schedules(handle)
+
+
+class SchedulingTriggersTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.AircraftDynamicInfo.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        self.start_dt = datetime(2021, 4, 25, 0, 0, tzinfo=timezone.utc)
+
+    def request(self, plan_pk, hours=0):
+        with patch('crm.tasks.run_scheduling_requests.apply_async') as apply_async, \
+                self.captureOnCommitCallbacks(execute=True):
+            request = request_rescheduling(plan_pk, (self.start_dt + timezone.timedelta(hours=hours)).isoformat())
+        apply_async.assert_called_once_with((request.pk, ), countdown=settings.SCHEDULING_QUIET_PERIOD)
+        return request.pk
+
+    @patch('crm.tasks.reschedule_plan')
+    @patch('crm.tasks.regenerate_schedules')
+    def test_burst_is_coalesced(self, regenerate, reschedule):
+        requests = [self.request(1, hours=1), self.request(2), self.request(1, hours=2)]
+        for request in requests[:-1]:
+            run_scheduling_requests(request)
+        regenerate.assert_not_called()
+        run_scheduling_requests(requests[-1])
+        regenerate.assert_called_once_with(self.start_dt.isoformat())
+        reschedule.assert_not_called()
+        self.assertFalse(SchedulingRequest.objects.exists())
+
+    @patch('crm.tasks.reschedule_plan')
+    @patch('crm.tasks.regenerate_schedules')
+    def test_single_plan_is_rescheduled(self, regenerate, reschedule):
+        requests = [self.request(1, hours=1), self.request(1)]
+        for request in requests:
+            run_scheduling_requests(request)
+        reschedule.assert_called_once_with(1, self.start_dt.isoformat())
+        regenerate.assert_not_called()
+
+    @override_settings(SCHEDULING_MAX_DELAY=0)
+    @patch('crm.tasks.reschedule_plan')
+    def test_max_delay(self, reschedule):
+        requests = [self.request(1), self.request(2)]
+        run_scheduling_requests(requests[0])
+        reschedule.assert_called_once_with(1, self.start_dt.isoformat())
+        run_scheduling_requests(requests[1])
+        reschedule.assert_called_with(2, self.start_dt.isoformat())
+
+    def test_superseded_regeneration(self):
+        landed = datetime(2021, 4, 20, 6, 0, tzinfo=timezone.utc)
+        for aircraft in (1, 2):
+            Flight.objects.create(flight_plan_id=aircraft, aircraft_id=aircraft, actual_destination_id=aircraft,
+                                  planning_departure_datetime=landed, planning_arrival_datetime=landed,
+                                  actual_departure_datetime=landed, actual_arrival_datetime=landed)
+        run = new_regeneration_run()
+        handle = assign_employees(generate_schedules(self.start_dt.isoformat(), run=run))
+        new_regeneration_run()
+        create_flights(handle)
+        self.assertFalse(Flight.objects.filter(planning_departure_datetime__gte=self.start_dt).exists())
+        with self.assertRaises(SchedulesExpired):
+            load_schedules(handle)
+        self.assertIsNone(generate_schedules(self.start_dt.isoformat(), run=run))
+
+    def test_lost_schedules(self):
+        landed = datetime(2021, 4, 20, 6, 0, tzinfo=timezone.utc)
+        for aircraft in (1, 2):
+            Flight.objects.create(flight_plan_id=aircraft, aircraft_id=aircraft, actual_destination_id=aircraft,
+                                  planning_departure_datetime=landed, planning_arrival_datetime=landed,
+                                  actual_departure_datetime=landed, actual_arrival_datetime=landed)
+        for task in (assign_employees, create_flights):
+            with self.subTest(task=task.name):
+                run = new_regeneration_run()
+                handle = generate_schedules(self.start_dt.isoformat(), run=run)
+                if task is create_flights:
+                    handle = assign_employees(handle)
+                discard_schedules(handle)
+                self.assertIsNone(task(handle))
+                self.assertEquals(set(FlightPlan.objects.values_list('status', flat=True)), {FlightPlan.ERROR_EPM})
+                self.assertTrue(SchedulingRun.objects.get(token=run).finished)
+
+
+class WriteScheduleTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.Flights.json",
+    ]
+
+    def setUp(self):
+        self.start_dt = datetime(2021, 4, 28, 0, 0, tzinfo=timezone.utc)
+        self.schedule = [
+            (datetime(2021, 4, 28, 1, 0, tzinfo=timezone.utc), datetime(2021, 4, 28, 7, 0, tzinfo=timezone.utc),
+             2, 1, [4, 5]),
+            (datetime(2021, 4, 29, 1, 0, tzinfo=timezone.utc), datetime(2021, 4, 29, 7, 0, tzinfo=timezone.utc),
+             2, 2, []),
+        ]
+
+    def test_write_schedule(self):
+        for use_copy in (True, False):
+            with self.subTest(msg=f'COPY: {use_copy}'):
+                write_schedule(self.start_dt, self.schedule, batch_size=1, use_copy=use_copy)
+                flights = Flight.objects.filter(planning_departure_datetime__gte=self.start_dt).order_by(
+                    'planning_departure_datetime')
+                self.assertEquals(
+                    [(f.planning_departure_datetime, f.planning_arrival_datetime, f.aircraft_id, f.flight_plan_id,
+                      sorted(f.employees.values_list('id', flat=True))) for f in flights],
+                    self.schedule)
+                self.assertEquals(Flight.objects.filter(planning_departure_datetime__lt=self.start_dt).count(), 2)
+                self.assertEquals(set(FlightPlan.objects.values_list('status', flat=True)), {FlightPlan.SUCCESS})
+
+    @patch('crm.writer._copy_flights', side_effect=RuntimeError)
+    def test_write_schedule_is_atomic(self, copy_flights):
+        flights = set(Flight.objects.values_list('pk', flat=True))
+        with self.assertRaises(RuntimeError):
+            write_schedule(self.start_dt, self.schedule, use_copy=True)
+        self.assertEquals(set(Flight.objects.values_list('pk', flat=True)), flights)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class FlightsCompatibilityTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.AircraftDeviceLife.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.Flights.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        # devices allow 3 more flights, flight 1 has arrived before the checked window
+        AircraftDeviceLife.objects.filter(pk=1).update(max_operation_time_h=1000, service_time_period_h=1000,
+                                                       max_operation_cycles=4, service_cycles_period=1000)
+        day = datetime(2021, 4, 26, tzinfo=timezone.utc)
+        Flight.objects.filter(pk=1).update(actual_departure_datetime=day,
+                                           actual_arrival_datetime=day + timezone.timedelta(hours=6),
+                                           actual_destination=2)
+        EmployeeLog.objects.create(employee_id=4, status=EmployeeLog.LEAVE_SICK,
+                                   disability_start=datetime(2021, 4, 28, tzinfo=timezone.utc),
+                                   disability_end=datetime(2021, 4, 28, 3, tzinfo=timezone.utc))
+        Flight.objects.filter(pk=5).update(canceled=True)
+        cache.clear()
+
+    def test_statuses(self):
+        self.assertEquals(check_flights_compatibility(Flight.objects.filter(pk__gte=2)), {
+            2: FlightWarning.DEPARTURE_DELAY,
+            3: FlightWarning.EMPLOYEE_NOT_AVAILABLE,
+            4: FlightWarning.AIRCRAFT_WILL_BE_IN_ANOTHER_AIRPORT,
+            5: FlightWarning.CANCELED,
+            6: FlightWarning.AIRCRAFT_DEVICE_PROBLEM,
+            7: FlightWarning.AIRCRAFT_DEVICE_PROBLEM,
+        })
+
+    def test_constant_number_of_queries(self):
+        for first in (2, 6):
+            with self.subTest(msg=f"Flights from {first}"), self.assertNumQueries(7):
+                check_flights_compatibility(Flight.objects.filter(pk__gte=first))
+
+    def test_cached_warnings(self):
+        flights = Flight.objects.filter(pk__gte=2)
+        before_departure = datetime(2021, 4, 26, 12, tzinfo=timezone.utc)
+        with patch('django.utils.timezone.now', return_value=before_departure):
+            self.assertEquals(check_flights_compatibility(flights)[2], FlightWarning.SCHEDULED)
+        with self.subTest(msg='Time-based warnings of the cached flights'), self.assertNumQueries(2):
+            self.assertEquals(check_flights_compatibility(flights)[2], FlightWarning.DEPARTURE_DELAY)
+        with self.subTest(msg='Invalidated by signals'), self.captureOnCommitCallbacks(execute=True):
+            EmployeeLog.objects.create(employee_id=4, status=EmployeeLog.LEAVE_SICK,
+                                       disability_start=datetime(2021, 4, 27, tzinfo=timezone.utc),
+                                       disability_end=datetime(2021, 4, 27, 3, tzinfo=timezone.utc))
+        self.assertEquals(check_flights_compatibility(flights)[2], FlightWarning.EMPLOYEE_NOT_AVAILABLE)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class MetricsTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Aircraft.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.AircraftDynamicInfo.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_json_file_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            with override_settings(SCHEDULING_METRICS_SINKS=['crm.metrics.JsonFileSink'],
+                                   SCHEDULING_METRICS_FILE=path), stage('outer') as outer:
+                with stage('inner') as inner:
+                    list(Airport.objects.all())
+                    inner.rows = 3
+                list(FlightPlan.objects.all())
+            with open(path) as file:
+                lines = [json.loads(line) for line in file]
+        self.assertEquals([(line['stage'], line['queries'], line['rows']) for line in lines],
+                          [('inner', 1, 3), ('outer', 2, None)])
+        self.assertGreaterEqual(lines[1]['seconds'], lines[0]['seconds'])
+        self.assertEquals(outer.as_dict(), lines[1])
+
+    def test_failed_stage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            with override_settings(SCHEDULING_METRICS_SINKS=['crm.metrics.JsonFileSink'],
+                                   SCHEDULING_METRICS_FILE=path), self.assertRaises(ValueError), stage('failing'):
+                list(Airport.objects.all())
+                raise ValueError
+            with open(path) as file:
+                lines = [json.loads(line) for line in file]
+        self.assertEquals([(line['stage'], line['queries'], line['failed']) for line in lines],
+                          [('failing', 1, True)])
+
+    def test_sink_queries_not_counted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            with override_settings(SCHEDULING_METRICS_SINKS=['crm.metrics.PrometheusSink', 'crm.metrics.JsonFileSink'],
+                                   SCHEDULING_METRICS_FILE=path), stage('outer'), stage('inner'):
+                list(Airport.objects.all())
+            with open(path) as file:
+                lines = [json.loads(line) for line in file]
+        # the upsert of the counters of the inner stage is not a query of the outer one
+        self.assertEquals([(line['stage'], line['queries']) for line in lines], [('inner', 1), ('outer', 1)])
+        self.assertEquals(StageCounter.objects.get(stage='outer', name='crm_stage_runs_total').value, 1)
+
+    @override_settings(SCHEDULING_METRICS_SINKS=['crm.metrics.PrometheusSink'])
+    def test_prometheus_endpoint(self):
+        ScheduleConfig.objects.update(max_flight_generation_attempts=4)
+        start_dt = datetime(2021, 4, 25, 0, 0, tzinfo=timezone.utc)
+        generate_schedules(start_dt.isoformat(), seed=3)
+        generate_schedules(start_dt.isoformat(), seed=3)
+        with self.subTest(msg='Anonymous'):
+            self.assertEquals(Client().get('/crm/metrics').status_code, 403)
+        with self.subTest(msg='Scraper'), override_settings(SCHEDULING_METRICS_TOKEN='secret'):
+            self.assertEquals(Client().get('/crm/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEquals(Client().get('/crm/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        client = Client()
+        client.login(username=os.environ.get('ADMIN_LOGIN'), password=os.environ.get('ADMIN_PASSWORD'))
+        response = client.get('/crm/metrics')
+        self.assertEquals(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        self.assertIn('crm_stage_runs_total{stage="generate_schedules"} 2', lines)
+        self.assertIn('crm_stage_attempts_total{stage="generate_schedules.attempts"} 8', lines)
+        self.assertIn('# TYPE crm_stage_query_seconds_total counter', lines)
+        self.assertIn('crm_stage_failures_total{stage="generate_schedules"} 0', lines)
+
+
+class BenchmarkTest(TestCase):
+    def test_run_stages(self):
+        size = NetworkSize(airports=3, aircraft=8, devices=2, employees=30, plans=3, days=7)
+        start = datetime(2021, 5, 3, tzinfo=timezone.utc)
+        config, plans = generate_network(size, seed=1, start=start.date())
+        self.assertEquals(len(plans), 2 * size.plans)
+        self.assertEquals(AircraftDeviceLife.objects.count(), size.aircraft * size.devices)
+        self.assertEquals(Employee.objects.count(), size.employees)
+        results = run_stages(start, seed=1)
+        self.assertEquals([result.stage for result in results],
+                          ['generate_schedules', 'assign_employees', 'create_flights', 'check_flights_compatibility'])
+        self.assertTrue(Flight.objects.filter(planning_departure_datetime__gte=start).exists())
+
+
+class DeviceLifeForecastTest(TestCase):
+    fixtures = [
+        "crm.Aircraft.json",
+        "crm.AircraftDeviceLife.json",
+    ]
+
+    def test_same_as_every_device(self):
+        now = datetime(2021, 4, 26, tzinfo=timezone.utc)
+        limits = [(100, 90, 50, 20, 30, 10, 12, 5), (80, 0, 70, 0, 9, 0, 9, 0), (500, 100, 40, 39, 100, 0, 100, 97)]
+        for max_h, total_h, period_h, after_h, max_cycles, total_cycles, period_cycles, after_cycles in limits:
+            AircraftDeviceLife.objects.create(
+                aircraft_id=2, device_name='device', latest_update=now, max_operation_time_h=max_h,
+                total_operation_time_h=total_h, service_time_period_h=period_h, after_service_time_h=after_h,
+                max_operation_cycles=max_cycles, total_operation_cycles=total_cycles,
+                service_cycles_period=period_cycles, after_service_cycles=after_cycles)
+        with self.assertNumQueries(1):
+            forecast = DeviceLifeForecast.load([2, 3])
+        # every device separately: [remaining hours, remaining cycles]
+        remaining = [[min(max_h - total_h, period_h - after_h), min(max_cycles - total_cycles, period_cycles - after)]
+                     for max_h, total_h, period_h, after_h, max_cycles, total_cycles, period_cycles, after in limits]
+        for hours in (0, 2, 1, 3, 0, 5, 1, 1, 0):
+            fits = all(device_hours >= hours and cycles >= 1 for device_hours, cycles in remaining)
+            with self.subTest(remaining=remaining, hours=hours):
+                self.assertEquals(forecast.fly(2, hours), fits)
+            if fits:
+                remaining = [[device_hours - hours, cycles - 1] for device_hours, cycles in remaining]
+        self.assertFalse(DeviceLifeForecast.load().fits(1, 0))
+        self.assertTrue(forecast.fly(3, 1000))
+
+    def test_flight_hours(self):
+        departure = datetime(2021, 4, 26, 23, 0, tzinfo=timezone.utc)
+        self.assertEquals(flight_hours(departure, departure + timezone.timedelta(minutes=61)), 2)
+        self.assertEquals(flight_hours(departure, departure + timezone.timedelta(hours=26)), 26)
+
 
 class AircraftDeviceLifeTest(TestCase):
     fixtures = [
@@ -154,6 +992,222 @@ class AircraftLifeTest(TestCase):
         self.assertEquals(device.latest_update,
                           make_aware(mock.now.return_value))
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_single_update(self):
+        device = AircraftDeviceLife.objects.get(pk=1)
+        for name in ('Engine', 'Landing gear'):
+            device.pk, device.device_name = None, name
+            device.save()
+        cache.set(WARNINGS_VERSION_KEY, 1, None)
+        aircraft = Aircraft.objects.get(pk=1)
+        with self.subTest(msg='One query for all the devices'), self.assertNumQueries(2), \
+                self.captureOnCommitCallbacks(execute=True):
+            aircraft.departed()
+            aircraft.landed(12)
+        self.assertEquals(set(AircraftDeviceLife.objects.filter(aircraft=1).values_list(
+            'total_operation_cycles', 'after_service_cycles', 'total_operation_time_h', 'after_service_time_h')),
+            {(2, 2, 13, 13)})
+        with self.subTest(msg='Flight warnings invalidated'):
+            self.assertEquals(cache.get(WARNINGS_VERSION_KEY), 3)
+
+
+class FlightMovementsTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.AircraftDeviceLife.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.Flights.json",
+    ]
+
+    def setUp(self):
+        device = AircraftDeviceLife.objects.get(pk=1)
+        device.pk, device.aircraft_id = None, 2
+        device.save()
+        Flight.objects.filter(pk=2).update(aircraft=2)
+
+    def test_batch(self):
+        events = [
+            {'flight': 1, 'event': 'departure', 'datetime': '2021-04-26T00:10:00+00:00'},
+            {'flight': 1, 'event': 'arrival', 'datetime': '2021-04-26T06:40:00+00:00'},
+            {'flight': 2, 'event': 'departure', 'datetime': '2021-04-27T00:00:00+00:00'},
+            {'flight': 1, 'event': 'departure', 'datetime': '2021-04-26T00:20:00+00:00'},
+            {'flight': 3, 'event': 'arrival', 'datetime': '2021-04-28T06:00:00+00:00'},
+            {'flight': 1337, 'event': 'departure', 'datetime': '2021-04-28T06:00:00+00:00'},
+            {'flight': 4, 'event': 'landing', 'datetime': '2021-04-29T06:00:00+00:00'},
+            {'flight': 4, 'event': 'departure'},
+        ]
+        with self.captureOnCommitCallbacks():
+            response = self.client.post('/crm/api/flights/movements/', events, content_type='application/json')
+        with self.subTest(msg='Status of every event'):
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals([result['status'] for result in response.json()],
+                              [200, 200, 200, 409, 409, 404, 400, 400])
+        flight = Flight.objects.get(pk=1)
+        with self.subTest(msg='Flights updated'):
+            self.assertEquals(flight.actual_departure_datetime, datetime(2021, 4, 26, 0, 10, tzinfo=timezone.utc))
+            self.assertEquals(flight.actual_arrival_datetime, datetime(2021, 4, 26, 6, 40, tzinfo=timezone.utc))
+            self.assertIsNotNone(Flight.objects.get(pk=2).actual_departure_datetime)
+            self.assertIsNone(Flight.objects.get(pk=3).actual_departure_datetime)
+        with self.subTest(msg='Devices updated'):
+            self.assertEquals(list(AircraftDeviceLife.objects.order_by('aircraft').values_list(
+                'aircraft', 'total_operation_cycles', 'after_service_cycles', 'total_operation_time_h')),
+                [(1, 2, 2, 8), (2, 2, 2, 1)])
+
+    def test_single_flight_endpoints(self):
+        # flight 1 is reported by the single-flight endpoints, flight 2 of the other aircraft by a batch
+        departure, arrival = '2021-04-26T00:10:00+00:00', '2021-04-26T06:40:00+00:00'
+        responses = [
+            self.client.post('/crm/api/flights/1/departure/', {'actual_departure_datetime': departure}),
+            self.client.post('/crm/api/flights/1/departure/', {'actual_departure_datetime': departure}),
+            self.client.post('/crm/api/flights/1/arrival/', {'actual_arrival_datetime': arrival}),
+            self.client.post('/crm/api/flights/3/arrival/', {'actual_arrival_datetime': arrival}),
+            self.client.post('/crm/api/flights/1337/departure/', {'actual_departure_datetime': departure}),
+            self.client.post('/crm/api/flights/4/departure/', {}),
+        ]
+        with self.subTest(msg='Statuses'):
+            self.assertEquals([response.status_code for response in responses], [200, 409, 200, 409, 404, 400])
+        self.client.post('/crm/api/flights/movements/', [
+            {'flight': 2, 'event': 'departure', 'datetime': departure},
+            {'flight': 2, 'event': 'arrival', 'datetime': arrival},
+        ], content_type='application/json')
+        with self.subTest(msg='Same device life by both paths'):
+            self.assertEquals(list(AircraftDeviceLife.objects.order_by('aircraft').values_list(
+                'aircraft', 'total_operation_cycles', 'total_operation_time_h', 'after_service_time_h')),
+                [(1, 2, 8, 8), (2, 2, 8, 8)])
+
+    def test_constant_number_of_queries(self):
+        events = [{'flight': pk, 'event': 'departure', 'datetime': '2021-04-26T00:00:00+00:00'} for pk in range(1, 8)]
+        with self.assertNumQueries(5):  # 3 and the savepoint of the transaction
+            self.assertEquals(apply_movements(events), [200] * 7)
+
+    def test_bad_request(self):
+        response = self.client.post('/crm/api/flights/movements/', {'flight': 1}, content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+
+class FuelTelemetryTest(TestCase):
+    fixtures = [
+        "crm.Aircraft.json",
+        "crm.AircraftDynamicInfo.json",
+    ]
+
+    def setUp(self):
+        caches['state'].clear()
+
+    def test_latest_reading(self):
+        with self.subTest(msg='Dynamic info without readings'):
+            self.assertEquals(self.client.get('/crm/api/aircrafts/1/fuel/').json(),
+                              {'fuel_remaining_kg': 123, 'recorded': None})
+        # the aircraft and the reading, the latest reading is cached without database queries
+        with self.assertNumQueries(2), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/crm/api/aircrafts/1/fuel/', {'fuel_remaining_kg': 500,
+                                                                       'recorded': '2021-05-01T12:00:00+00:00'})
+        self.assertEquals(response.status_code, 200)
+        with self.subTest(msg='Served from the cache'), self.assertNumQueries(0):
+            self.assertEquals(self.client.get('/crm/api/aircrafts/1/fuel/').json()['fuel_remaining_kg'], 500)
+        with self.subTest(msg='History appended, dynamic info not written'):
+            self.assertEquals(list(FuelReading.objects.values_list('aircraft', 'fuel_kg')), [(1, 500)])
+            self.assertEquals(AircraftDynamicInfo.objects.get(aircraft=1).fuel_remaining_kg, 123)
+        caches['state'].clear()
+        with self.subTest(msg='Latest reading without the cache'):
+            self.assertEquals(self.client.get('/crm/api/aircrafts/1/fuel/').json()['fuel_remaining_kg'], 500)
+        with self.subTest(msg='Unknown aircraft'):
+            self.assertEquals(self.client.get('/crm/api/aircrafts/1337/fuel/').status_code, 404)
+            self.assertEquals(self.client.post('/crm/api/aircrafts/1337/fuel/', {'fuel_remaining_kg': 1}).status_code,
+                              404)
+
+    def test_batch(self):
+        readings = [
+            {'aircraft': 2, 'fuel_remaining_kg': 1000, 'recorded': '2021-05-01T12:00:10+00:00'},
+            {'aircraft': 2, 'fuel_remaining_kg': 1100, 'recorded': '2021-05-01T12:00:00+00:00'},
+            {'aircraft': 3, 'fuel_remaining_kg': 2000},
+            {'aircraft': 1337, 'fuel_remaining_kg': 3000},
+            {'aircraft': 3, 'fuel_remaining_kg': -1},
+            {'aircraft': 3},
+        ]
+        with self.assertNumQueries(2), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/crm/api/aircrafts/fuel/', readings, content_type='application/json')
+        with self.subTest(msg='Status of every reading'):
+            self.assertEquals([result['status'] for result in response.json()], [200, 200, 200, 404, 400, 400])
+        with self.subTest(msg='Latest readings'):
+            self.assertEquals(latest_fuel(2), (datetime(2021, 5, 1, 12, 0, 10, tzinfo=timezone.utc), 1000))
+            self.assertEquals(latest_fuel(3)[1], 2000)
+            self.assertEquals(FuelReading.objects.count(), 3)
+
+    @override_settings(FUEL_READINGS_BUCKET='minute', FUEL_READINGS_DOWNSAMPLE_AFTER=60 * 60,
+                       FUEL_READINGS_RETENTION=24 * 60 * 60)
+    def test_compact(self):
+        readings = [
+            (1, datetime(2021, 4, 20, 10, tzinfo=timezone.utc), 300),
+            (1, datetime(2021, 5, 1, 10, 0, 5, tzinfo=timezone.utc), 200),
+            (1, datetime(2021, 5, 1, 10, 0, 40, tzinfo=timezone.utc), 190),
+            (1, datetime(2021, 5, 1, 10, 1, 10, tzinfo=timezone.utc), 180),
+            (1, datetime(2021, 5, 1, 11, 59, 0, tzinfo=timezone.utc), 170),
+            (1, datetime(2021, 5, 1, 11, 59, 30, tzinfo=timezone.utc), 160),
+            (2, datetime(2021, 4, 1, tzinfo=timezone.utc), 50),
+        ]
+        record_readings(readings)
+        with patch('django.utils.timezone.now', return_value=datetime(2021, 5, 1, 12, tzinfo=timezone.utc)):
+            compact_fuel_readings()
+        with self.subTest(msg='Downsampled and past the retention removed, the latest readings kept'):
+            self.assertEquals(set(FuelReading.objects.values_list('aircraft', 'fuel_kg')),
+                              {(1, 190), (1, 180), (1, 170), (1, 160), (2, 50)})
+        with self.subTest(msg='Dynamic info updated'):
+            self.assertEquals(dict(AircraftDynamicInfo.objects.filter(aircraft__in=(1, 2, 3))
+                                   .values_list('aircraft', 'fuel_remaining_kg')), {1: 160, 2: 50, 3: 193000})
+
+
+class AircraftStateTest(TestCase):
+    fixtures = [
+        "crm.Aircraft.json",
+        "crm.AircraftDynamicInfo.json",
+    ]
+
+    def setUp(self):
+        caches['state'].clear()
+
+    def test_fleet_state(self):
+        # the fleet, the states and the latest fuel
+        with self.assertNumQueries(3):
+            response = self.client.get('/crm/api/aircrafts/state/')
+        with self.subTest(msg='All the aircraft'):
+            self.assertEquals([state['aircraft'] for state in response.json()], [1, 2, 3, 4, 5])
+            self.assertEquals(response.json()[1], {
+                'aircraft': 2, 'economy_class_cap': 456, 'business_class_cap': 56, 'first_class_cap': 8,
+                'pilots_number': 2, 'attendants_number': 6, 'fuel_remaining_kg': 253983, 'fuel_recorded': None,
+            })
+        with self.subTest(msg='Read through the cache'), self.assertNumQueries(0):
+            self.assertEquals(self.client.get('/crm/api/aircrafts/state/').json(), response.json())
+
+    def test_etag(self):
+        urls = ('/crm/api/aircrafts/state/', '/crm/api/aircrafts/2/state/', '/crm/api/aircrafts/2/fuel/')
+        for fuel_kg, url in enumerate(urls, 1000):
+            etag = self.client.get(url)['ETag']
+            with self.subTest(msg=f'Not modified {url}'):
+                self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/crm/api/aircrafts/2/fuel/', {'fuel_remaining_kg': fuel_kg})
+            with self.subTest(msg=f'Modified {url}'):
+                self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_invalidated_on_write(self):
+        self.assertEquals(self.client.get('/crm/api/aircrafts/1/state/').json()['pilots_number'], 2)
+        info = AircraftDynamicInfo.objects.get(aircraft=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            info.pilots_number, info.fuel_remaining_kg = 3, 1000
+            info.save()
+        state = self.client.get('/crm/api/aircrafts/1/state/').json()
+        self.assertEquals((state['pilots_number'], state['fuel_remaining_kg']), (3, 1000))
+        with self.subTest(msg='Removed from the fleet'), self.captureOnCommitCallbacks(execute=True):
+            info.delete()
+        self.assertEquals(self.client.get('/crm/api/aircrafts/1/state/').status_code, 404)
+        self.assertEquals(len(self.client.get('/crm/api/aircrafts/state/').json()), 4)
+
 
 class TestFlightPlanPage(TestCase):
     fixtures = [
@@ -370,6 +1424,89 @@ class TestFlightPage(TestCase):
                 Flight.objects.get(pk=1337)
 
 
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class FlightsBoardTest(TestCase):
+    fixtures = [
+        "auth.Group.json",
+        "auth.User.json",
+        "crm.Occupation.json",
+        "crm.Employee.json",
+        "crm.Aircraft.json",
+        "crm.AircraftDeviceLife.json",
+        "crm.Airport.json",
+        "crm.FlightPlan.json",
+        "crm.Flights.json",
+        "crm.ScheduleConfig.json",
+    ]
+
+    def setUp(self):
+        self.client.login(username=os.environ.get('ADMIN_LOGIN'), password=os.environ.get('ADMIN_PASSWORD'))
+        AircraftDeviceLife.objects.filter(pk=1).update(max_operation_time_h=1000, service_time_period_h=1000,
+                                                       max_operation_cycles=4, service_cycles_period=1000)
+        Flight.objects.filter(pk__in=(3, 6)).update(aircraft=2)
+        Flight.objects.filter(pk=5).update(canceled=True)
+        self.now = patch('django.utils.timezone.now', return_value=datetime(2021, 4, 25, tzinfo=timezone.utc))
+        self.now.start()
+        self.addCleanup(self.now.stop)
+        cache.clear()
+
+    def test_keyset_pages(self):
+        flights = Flight.objects.all()
+        first = flights_page(flights, size=3)
+        second = flights_page(flights, after=first.next_cursor, size=3)
+        last = flights_page(flights, after=second.next_cursor, size=3)
+        with self.subTest(msg='Forward'):
+            self.assertEquals([[flight.pk for flight in page.flights] for page in (first, second, last)],
+                              [[1, 2, 3], [4, 5, 6], [7]])
+            self.assertEquals((first.previous_cursor, last.next_cursor), (None, None))
+        with self.subTest(msg='Backward'):
+            page = flights_page(flights, before=second.previous_cursor, size=3)
+            self.assertEquals([flight.pk for flight in page.flights], [1, 2, 3])
+            page = flights_page(flights, before=last.previous_cursor, size=3)
+            self.assertEquals([flight.pk for flight in page.flights], [4, 5, 6])
+        with self.subTest(msg='Same departure'):
+            Flight.objects.filter(pk=4).update(planning_departure_datetime=datetime(2021, 4, 28, tzinfo=timezone.utc))
+            page = flights_page(flights, after=first.next_cursor, size=3)
+            self.assertEquals([flight.pk for flight in page.flights], [4, 5, 6])
+
+    def test_page_warnings(self):
+        # the page and the preceding flights of its aircraft give the same warnings as the whole window
+        window = Flight.objects.all()
+        expected = check_flights_compatibility(window)
+        page = flights_page(window, size=2)
+        while True:
+            statuses = check_flights_compatibility(checked_flights(window, page.flights))
+            with self.subTest(msg=f'Page {[flight.pk for flight in page.flights]}'):
+                self.assertEquals({flight.pk: statuses[flight.pk] for flight in page.flights},
+                                  {flight.pk: expected[flight.pk] for flight in page.flights})
+            if page.next_cursor is None:
+                break
+            page = flights_page(window, after=page.next_cursor, size=2)
+        with self.subTest(msg='Earlier flights of the other aircraft are not checked'):
+            self.assertEquals(set(checked_flights(window, [Flight.objects.get(pk=6)]).values_list('pk', flat=True)),
+                              {3, 6})
+
+    def test_filters(self):
+        cases = [({'aircraft': 2}, [3, 6]), ({'state': 'canceled'}, [5]),
+                 ({'airport': 1, 'aircraft': 1}, [1, 2, 4, 5, 7]), ({'airport': 1337}, [])]
+        for query, flights in cases:
+            response = self.client.get('/crm/flights/', query)
+            with self.subTest(msg=f'Filter {query}'):
+                self.assertEquals(response.status_code, 200)
+                self.assertEquals([flight.pk for flight, status in response.context['flight_status']], flights)
+
+    def test_page_links(self):
+        with patch('crm.views.flights_page', side_effect=lambda *args, **kwargs: flights_page(*args, **kwargs,
+                                                                                              size=3)):
+            response = self.client.get('/crm/flights/', {'aircraft': 1})
+            self.assertNotIn('previous_page', response.context)
+            response = self.client.get('/crm/flights/?' + response.context['next_page'])
+        with self.subTest(msg='Second page with the same filter'):
+            self.assertEquals([flight.pk for flight, status in response.context['flight_status']], [5, 7])
+            self.assertContains(response, 'Previous')
+            self.assertNotIn('next_page', response.context)
+
+
 class TestFlightPlanEditForm(TestCase):
     fixtures = [
         "auth.Group.json",
@@ -0,0 +1,230 @@
+import dataclasses
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Hashable, Optional
+
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Employee, Flight
+
+
+@dataclasses.dataclass(frozen=True)
+class TimelineFlight:
+    departure: datetime
+    arrival: datetime
+    aircraft: int
+    source: int  # airport pk
+    destination: int  # airport pk
+    key: Hashable = None  # flight pk for stored flights, plan pk for the planned ones
+
+
+def aircraft_on_ground(airports=None, landed_before: Optional[datetime] = None) -> dict:
+    # aircraft pk -> (airport pk, actual arrival) of the aircraft physically on the ground, in a single query.
+    # The last actual arrival of an aircraft is the one that has no departure or arrival of the aircraft after it.
+    later = Flight.objects.filter(aircraft=OuterRef('aircraft'), canceled=False).exclude(pk=OuterRef('pk')).filter(
+        Q(actual_departure_datetime__gte=OuterRef('actual_arrival_datetime')) |
+        Q(actual_arrival_datetime__gt=OuterRef('actual_arrival_datetime'))
+    )
+    flights = Flight.objects.filter(canceled=False, actual_arrival_datetime__isnull=False,
+                                    actual_destination__isnull=False).filter(~Exists(later))
+    if airports is not None:
+        flights = flights.filter(actual_destination__in=airports)
+    if landed_before is not None:
+        flights = flights.filter(actual_arrival_datetime__lte=landed_before)
+    return {
+        aircraft: (airport, arrival)
+        for aircraft, airport, arrival in flights.values_list('aircraft', 'actual_destination',
+                                                              'actual_arrival_datetime')
+    }
+
+
+class FleetTimeline:
+    # Data structure from notes.org: positions of every aircraft in time.
+    # It is loaded from the database once and then answers "which aircraft are in airport X at time T",
+    # accepts added or removed flights and reports invalid flights without touching the database.
+    #
+    # An aircraft is placed to its initial position (last actual arrival) and then moved by its flights:
+    # it leaves the source at departure and becomes available in the destination at arrival + service_time.
+    # The crew moves the same way, so a crew timeline (see load_crew) is this structure keyed by employee pk.
+
+    def __init__(self, positions: Optional[dict] = None, flights=(), service_time: Optional[timedelta] = None):
+        self.service_time = service_time or timedelta(seconds=0)
+        self._positions = dict(positions or {})  # aircraft pk -> airport pk
+        self._flights = defaultdict(list)  # aircraft pk -> flights sorted by departure
+        self._departures = defaultdict(list)  # aircraft pk -> departures of the flights above (bisect keys)
+        # Indexes by airport, so the lookups do not scan the whole fleet
+        self._visitors = defaultdict(Counter)  # airport pk -> aircraft pk -> initial position and arrivals there
+        self._last_at = defaultdict(set)  # airport pk -> aircraft whose last position (see last_position) it is
+        self._last_airports = {}  # aircraft pk -> the airport above
+        for aircraft, airport in self._positions.items():
+            self._visitors[airport][aircraft] += 1
+            self._move_last(aircraft)
+        for flight in flights:
+            self._insert(flight)
+
+    @classmethod
+    def load(cls, until: Optional[datetime] = None, service_time: Optional[timedelta] = None):
+        # Two queries: aircraft on the ground in all airports and all flights that are not finished yet.
+        # Flights departing at or after `until` are skipped, the scheduler is going to replace them.
+        on_ground = aircraft_on_ground()
+        positions = {aircraft: airport for aircraft, (airport, arrival) in on_ground.items()}
+        # the last actual movement of the aircraft: the arrival, or the departure of the flight it is in
+        moved_at = {aircraft: arrival for aircraft, (airport, arrival) in on_ground.items()}
+
+        flights = Flight.objects.filter(canceled=False, actual_arrival_datetime__isnull=True)
+        if until is not None:
+            flights = flights.filter(planning_departure_datetime__lt=until)
+        rows = []
+        for pk, aircraft, source, destination, departure, arrival, actual_departure in flights.values_list(
+            'pk', 'aircraft', 'flight_plan__source', 'flight_plan__destination', 'planning_departure_datetime',
+            'planning_arrival_datetime', 'actual_departure_datetime'
+        ):
+            if actual_departure is not None:
+                arrival, departure = actual_departure + (arrival - departure), actual_departure
+                moved_at[aircraft] = max(departure, moved_at.get(aircraft, departure))
+            rows.append((TimelineFlight(departure, arrival, aircraft, source, destination, pk), actual_departure))
+
+        timeline = cls(positions, service_time=service_time)
+        for flight, actual_departure in rows:
+            if actual_departure is None and flight.aircraft in moved_at and \
+                    flight.departure < moved_at[flight.aircraft]:
+                continue  # planned before the last actual movement, but never flown
+            timeline._insert(flight)
+        return timeline
+
+    @classmethod
+    def load_crew(cls, since: datetime, default_location=None, service_time: Optional[timedelta] = None):
+        # Every employee starts in the destination of the last flight departed before `since`
+        # (default_location if there is none) and is moved by the flights departing after it
+        crew = Flight.employees.through.objects.filter(flight__canceled=False)
+        last_destinations = crew.filter(flight__planning_departure_datetime__lt=since).order_by(
+            'employee', '-flight__planning_arrival_datetime'
+        ).distinct('employee').values_list('employee', 'flight__flight_plan__destination')
+        positions = {employee: default_location for employee in Employee.objects.values_list('pk', flat=True)}
+        positions.update(last_destinations)
+        timeline = cls(positions, service_time=service_time)
+        for employee, pk, source, destination, departure, arrival in crew.filter(
+            flight__planning_departure_datetime__gte=since
+        ).values_list(
+            'employee', 'flight', 'flight__flight_plan__source', 'flight__flight_plan__destination',
+            'flight__planning_departure_datetime', 'flight__planning_arrival_datetime'
+        ):
+            timeline._insert(TimelineFlight(departure, arrival, employee, source, destination, pk))
+        return timeline
+
+    def copy(self):
+        timeline = FleetTimeline(self._positions, service_time=self.service_time)
+        for aircraft, flights in self._flights.items():
+            timeline._flights[aircraft] = list(flights)
+            timeline._departures[aircraft] = list(self._departures[aircraft])
+        timeline._visitors = defaultdict(Counter, {airport: Counter(v) for airport, v in self._visitors.items()})
+        timeline._last_at = defaultdict(set, {airport: set(v) for airport, v in self._last_at.items()})
+        timeline._last_airports = dict(self._last_airports)
+        return timeline
+
+    def aircraft(self) -> set:
+        return set(self._positions) | {aircraft for aircraft, flights in self._flights.items() if flights}
+
+    def flights(self, aircraft) -> list:
+        return list(self._flights.get(aircraft, ()))
+
+    def position_at(self, aircraft, datetime_point: datetime):
+        # Airport pk where the aircraft is ready to depart at datetime_point, None if it is in the air
+        # (or in service after landing) or its position is unknown
+        departures = self._departures.get(aircraft)
+        idx = bisect_right(departures, datetime_point) - 1 if departures else -1
+        if idx < 0:
+            return self._positions.get(aircraft)
+        flight = self._flights[aircraft][idx]
+        if flight.arrival + self.service_time <= datetime_point:
+            return flight.destination
+        return None
+
+    def last_position(self, aircraft):
+        # (airport pk, ready at) after the last flight of the aircraft, (initial position, None) without flights
+        flights = self._flights.get(aircraft)
+        if not flights:
+            return self._positions.get(aircraft), None
+        return flights[-1].destination, flights[-1].arrival + self.service_time
+
+    def aircraft_at(self, airport, datetime_point: datetime) -> set:
+        # only the aircraft placed to the airport at some point can be there
+        return {
+            aircraft for aircraft in self._visitors.get(airport, ())
+            if self.position_at(aircraft, datetime_point) == airport
+        }
+
+    def available_at(self, airport, datetime_point: datetime) -> set:
+        # Aircraft that are in the airport at datetime_point and have no flights after it,
+        # so the airport is their last position
+        return {
+            aircraft for aircraft in self._last_at.get(airport, ())
+            if (not self._departures.get(aircraft) or self._departures[aircraft][-1] <= datetime_point)
+            and self.position_at(aircraft, datetime_point) == airport
+        }
+
+    def fits(self, flight: TimelineFlight) -> bool:
+        # Whether the flight can be added without making it or any other flight of the aircraft invalid
+        if self.position_at(flight.aircraft, flight.departure) != flight.source:
+            return False
+        departures = self._departures.get(flight.aircraft, [])
+        idx = bisect_right(departures, flight.departure)
+        if idx == len(departures):
+            return True
+        next_flight = self._flights[flight.aircraft][idx]
+        return next_flight.source == flight.destination and \
+            next_flight.departure >= flight.arrival + self.service_time
+
+    def add_flight(self, flight: TimelineFlight) -> list:
+        # Returns the invalid flights of the aircraft after the flight was added
+        self._insert(flight)
+        return self.invalid_flights(flight.aircraft)
+
+    def remove_flight(self, flight: TimelineFlight) -> list:
+        # Returns the invalid flights of the aircraft after the flight was removed
+        flights, departures = self._flights[flight.aircraft], self._departures[flight.aircraft]
+        idx = bisect_left(departures, flight.departure)
+        while idx < len(flights) and flights[idx] != flight:
+            idx += 1
+        if idx == len(flights):
+            raise ValueError(f"Flight {flight} is not in the timeline")
+        del flights[idx]
+        del departures[idx]
+        self._visitors[flight.destination][flight.aircraft] -= 1
+        if not self._visitors[flight.destination][flight.aircraft]:
+            del self._visitors[flight.destination][flight.aircraft]
+        self._move_last(flight.aircraft)
+        return self.invalid_flights(flight.aircraft)
+
+    def invalid_flights(self, aircraft=None) -> list:
+        # Flight is invalid when the aircraft is not in the source airport at the departure,
+        # or it has not finished the previous flight and the service after it
+        aircraft_list = [aircraft] if aircraft is not None else sorted(self._flights)
+        invalid = []
+        for craft in aircraft_list:
+            location, ready_at = self._positions.get(craft), None
+            for flight in self._flights.get(craft, ()):
+                if (location is not None and location != flight.source) or \
+                        (ready_at is not None and ready_at > flight.departure):
+                    invalid.append(flight)
+                location, ready_at = flight.destination, flight.arrival + self.service_time
+        return invalid
+
+    def _insert(self, flight: TimelineFlight):
+        departures = self._departures[flight.aircraft]
+        idx = bisect_right(departures, flight.departure)
+        departures.insert(idx, flight.departure)
+        self._flights[flight.aircraft].insert(idx, flight)
+        self._visitors[flight.destination][flight.aircraft] += 1
+        self._move_last(flight.aircraft)
+
+    def _move_last(self, aircraft):
+        # Updates the last position index after the flights of the aircraft changed
+        airport = self.last_position(aircraft)[0]
+        if aircraft in self._last_airports:
+            if self._last_airports[aircraft] == airport:
+                return
+            self._last_at[self._last_airports[aircraft]].discard(aircraft)
+        self._last_airports[aircraft] = airport
+        self._last_at[airport].add(aircraft)
@@ -0,0 +1,88 @@
+import uuid
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import FlightPlan, SchedulingRequest, SchedulingRun
+
+# Plan changes do not start the scheduling themselves. Every change is stored as a SchedulingRequest and a
+# debounced task is queued SCHEDULING_QUIET_PERIOD seconds later. The task gives way to the newer requests (the
+# task of the last one takes them all), unless the oldest one has already waited SCHEDULING_MAX_DELAY seconds.
+# A single changed plan is rescheduled incrementally, a burst of changes gets one full regeneration.
+
+# Every full regeneration and incremental rescheduling is a SchedulingRun, only the latest one writes its flights:
+# the writes check it in their transaction (is_superseded with lock), the chains of the older runs are dropped.
+# A full regeneration may have read the plans before a change, so the incremental rescheduling gives way to the
+# full regeneration while a run is in flight, otherwise the stale run would replace the rescheduled flights.
+# The runs are kept in the database rather than in the evicting cache.
+
+
+def new_regeneration_run() -> str:
+    with transaction.atomic():
+        # waits for the write of the latest run in progress (see is_superseded)
+        SchedulingRun.objects.select_for_update().order_by('-pk').first()
+        run = SchedulingRun.objects.create(token=uuid.uuid4().hex)
+        # the older runs are superseded, their shards are never merged
+        SchedulingRun.objects.filter(pk__lt=run.pk).delete()
+    return run.token
+
+
+def new_incremental_run() -> Optional[str]:
+    # token of the incremental rescheduling, None if a run is in flight
+    with transaction.atomic():
+        latest = SchedulingRun.objects.select_for_update().order_by('-pk').first()
+        deadline = timezone.now() - timedelta(seconds=settings.SCHEDULING_RUN_TIMEOUT)
+        if latest is not None and not latest.finished and latest.created > deadline:
+            return None
+        return new_regeneration_run()
+
+
+def is_superseded(run: Optional[str], lock=False) -> bool:
+    # Whether a newer run has started since the run (None - not a part of a run).
+    # lock - in the transaction of a write: no newer run starts until the transaction ends.
+    if run is None:
+        return False
+    latest = SchedulingRun.objects.order_by('-pk')
+    if lock:
+        latest = latest.select_for_update()
+    return latest.values_list('token', flat=True).first() != run
+
+
+def finish_run(run: Optional[str]):
+    # in the transaction of the write of the run
+    SchedulingRun.objects.filter(token=run).update(finished=True)
+
+
+def fail_run(run: Optional[str], description: str):
+    # The run stops without writing: the plans it is processing get the error statuses and it is finished,
+    # so the incremental rescheduling does not wait for it. Nothing changes if a newer run owns the plans.
+    with transaction.atomic():
+        if is_superseded(run, lock=True):
+            return
+        for processing, error in ((FlightPlan.PROCESSING_FPM, FlightPlan.ERROR_FPM),
+                                  (FlightPlan.PROCESSING_EPM, FlightPlan.ERROR_EPM)):
+            FlightPlan.objects.filter(status=processing).update(status=error, description=description)
+        finish_run(run)
+
+
+def should_wait(last_request: int) -> bool:
+    # whether the task of the last_request gives way to the task of a newer request
+    newer = SchedulingRequest.objects.filter(pk__gt=last_request).exists()
+    if not newer:
+        return False
+    deadline = timezone.now() - timedelta(seconds=settings.SCHEDULING_MAX_DELAY)
+    return not SchedulingRequest.objects.filter(pk__lte=last_request, created__lte=deadline).exists()
+
+
+def take_requests(last_request: int):
+    # (plan pks, the earliest start) of the requests up to last_request, which are removed, None if there are none
+    with transaction.atomic():
+        requests = list(SchedulingRequest.objects.select_for_update().filter(pk__lte=last_request)
+                        .values_list('pk', 'flight_plan', 'start_dt'))
+        if not requests:
+            return None
+        SchedulingRequest.objects.filter(pk__in=[pk for pk, plan, start_dt in requests]).delete()
+    return {plan for pk, plan, start_dt in requests}, min(start_dt for pk, plan, start_dt in requests)
@@ -1,6 +1,9 @@
 from django.urls import path
-from crm.views import AircraftsDevicesView, AircraftView, EmployeeView, EmployeesView, FlightPlanView, \
-    FlightPlansView, FlightsView, index, AircraftsView, FlightView, FlightPlanDelete, FlightDelete, FlightDeparture, FlightArrival, FuelView
+from crm.views import (
+    AircraftsDevicesView, AircraftView, EmployeeView, EmployeesView, FlightPlanView, FlightPlansView, FlightsView,
+    index, AircraftsView, FlightView, FlightPlanDelete, FlightDelete, FlightDeparture, FlightArrival, FuelView,
+    FlightMovements, FleetFuelView, AircraftStateView, FleetStateView, metrics,
+)
 
 app_name = "crm"
 urlpatterns = [
@@ -20,5 +23,10 @@ urlpatterns = [
     path('api/flights/<int:pk>/departure/',
          FlightDeparture.as_view(), name='flight_departure'),
     path('api/flights/<int:pk>/arrival/', FlightArrival.as_view(), name='flight_arrival'),
-    path('api/aircrafts/<int:pk>/fuel/', FuelView.as_view(), name='aircraft_fuel' )
+    path('api/flights/movements/', FlightMovements.as_view(), name='flight_movements'),
+    path('api/aircrafts/<int:pk>/fuel/', FuelView.as_view(), name='aircraft_fuel' ),
+    path('api/aircrafts/fuel/', FleetFuelView.as_view(), name='fleet_fuel'),
+    path('api/aircrafts/<int:pk>/state/', AircraftStateView.as_view(), name='aircraft_state'),
+    path('api/aircrafts/state/', FleetStateView.as_view(), name='fleet_state'),
+    path('metrics', metrics, name='metrics'),
 ]
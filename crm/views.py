@@ -1,23 +1,30 @@
-import math
-from datetime import datetime
-from celery import chain
+import hmac
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required as p_req
 from django.contrib.auth.mixins import PermissionRequiredMixin, LoginRequiredMixin
 from django.urls import reverse_lazy
 from django.utils import timezone
 from django.views.generic import ListView, DetailView, FormView, DeleteView
+from django.core.exceptions import PermissionDenied
 from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.utils.http import parse_etags
 from django.shortcuts import render
 
 from rest_framework import mixins, generics, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .board import FLIGHT_STATES, checked_flights, filter_flights, flights_page
+from .compatibility import FLIGHT_RELATED
+from .fleet import aircraft_states, state_etag
 from .forms import FlightForm, FlightPlanForm
+from .metrics import prometheus_text
 from .models import Employee, EmployeeLog, Aircraft, AircraftDeviceLife, AircraftLog, Flight, FlightPlan, \
-    ScheduleConfig, AircraftDynamicInfo
-from .tasks import check_airports_availability, generate_schedules, assign_employees, create_flights, \
-    check_flights_compatibility, FlightWarning
+    ScheduleConfig, Airport
+from .movements import ARRIVAL, DEPARTURE, apply_movements
+from .tasks import check_flights_compatibility, request_rescheduling, FlightWarning
+from .telemetry import latest_fuel, record_fuel
 
 
 @login_required
@@ -67,8 +74,11 @@ class EmployeesView(PermissionRequiredMixin, ListView):
     template_name = "employee_list.html"
 
 
-def add_flights_data_to_context(context, flights):
-    status_dict = check_flights_compatibility(flights)
+def add_flights_data_to_context(context, flights, status_dict=None):
+    # status_dict - warnings of the flights if they are already checked
+    if status_dict is None:
+        flights = flights.select_related(*FLIGHT_RELATED)
+        status_dict = check_flights_compatibility(flights)
 
     def status_color(status):
         if status in [FlightWarning.ARRIVED, FlightWarning.SCHEDULED, FlightWarning.DEPARTED]:
@@ -79,28 +89,57 @@ def add_flights_data_to_context(context, flights):
         else:
             return "table-danger"
 
-    context['flight_status'] = zip(flights, [
+    context['flight_status'] = list(zip(flights, [
         (status_dict[flight.pk].name.replace('_', ' '), status_color(status_dict[flight.pk]))
-        for flight in flights])
+        for flight in flights]))
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
 class FlightsView(PermissionRequiredMixin, ListView):
+    # Keyset-paginated flights board (see crm/board.py)
     permission_required = "crm.view_flight"
-    model = Employee
+    model = Flight
     template_name = "flight_list.html"
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['airports'] = Airport.objects.order_by('iata')
+        context['aircraft_list'] = Aircraft.objects.order_by('tail_code')
+        context['states'] = FLIGHT_STATES
+        context['filters'] = {'airport': _int_or_none(self.request.GET.get('airport')),
+                              'aircraft': _int_or_none(self.request.GET.get('aircraft')),
+                              'state': self.request.GET.get('state')}
         config = ScheduleConfig.objects.all().first()
         if not config:
             return context
-        flights = Flight.objects.filter(
+        window = Flight.objects.filter(
             planning_departure_datetime__gte=timezone.now() - config.show_past_flights_time,
             planning_departure_datetime__lte=timezone.now() + config.show_future_flights_time
-        ).order_by('planning_departure_datetime')
-        add_flights_data_to_context(context, flights)
+        )
+        page = flights_page(filter_flights(window, **context['filters']),
+                            after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        statuses = check_flights_compatibility(checked_flights(window, page.flights))
+        add_flights_data_to_context(context, page.flights, statuses)
+        if page.previous_cursor is not None:
+            context['previous_page'] = self.page_query('before', page.previous_cursor)
+        if page.next_cursor is not None:
+            context['next_page'] = self.page_query('after', page.next_cursor)
         return context
 
+    def page_query(self, direction, cursor):
+        # query string of the adjacent page with the same filters
+        query = self.request.GET.copy()
+        query.pop('after', None)
+        query.pop('before', None)
+        query[direction] = cursor
+        return query.urlencode()
+
 
 class FlightView(PermissionRequiredMixin, FormView):
     permission_required = "crm.view_flight"
@@ -157,10 +196,7 @@ class FlightPlanView(PermissionRequiredMixin, FormView):
     def form_valid(self, form):
         if form.instance.status == FlightPlan.PENDING:  # pending
             form.save()
-            chain(generate_schedules.s(timezone.now().isoformat()) |
-                  assign_employees.s() |
-                  create_flights.s()
-                  ).delay()
+            request_rescheduling(form.instance.pk, timezone.now().isoformat())
             return HttpResponseRedirect(self.success_url)
         return HttpResponse("You can't change status")
 
@@ -196,62 +232,96 @@ class EmployeeView(LoginRequiredMixin, DetailView):
         return context
 
 
-class FlightDeparture(APIView):
-    def get_object(self, pk):
-        try:
-            return Flight.objects.get(pk=pk)
-        except Flight.DoesNotExist:
-            raise Http404
+class FlightMovementView(APIView):
+    # A single departure or arrival, applied the same way as the batches of FlightMovements
+    event = None
 
     def post(self, request, pk):
-        flight = self.get_object(pk)
-        if flight.actual_departure_datetime or flight.actual_arrival_datetime:
-            return Response(status=status.HTTP_409_CONFLICT)
-
-        flight.actual_departure_datetime = datetime.fromisoformat(
-            request.data['actual_departure_datetime'])
-        flight.save()
-        flight.aircraft.departed()
-        return Response(status=status.HTTP_200_OK)
-
-
-class FlightArrival(APIView):
-    def get_object(self, pk):
-        try:
-            return Flight.objects.get(pk=pk)
-        except Flight.DoesNotExist:
+        data = request.data if isinstance(request.data, dict) else {}
+        result, = apply_movements([{"flight": pk, "event": self.event,
+                                    "datetime": data.get(f"actual_{self.event}_datetime")}])
+        if result == status.HTTP_404_NOT_FOUND:
             raise Http404
+        return Response(status=result)
 
-    def post(self, request, pk):
-        flight = self.get_object(pk)
-        if not flight.actual_departure_datetime or flight.actual_arrival_datetime:
-            return Response(status=status.HTTP_409_CONFLICT)
 
-        flight.actual_arrival_datetime = datetime.fromisoformat(
-            request.data['actual_arrival_datetime'])
-        flight.save()
+class FlightDeparture(FlightMovementView):
+    event = DEPARTURE
+
+
+class FlightArrival(FlightMovementView):
+    event = ARRIVAL
+
 
-        hours_flown = math.ceil((flight.actual_arrival_datetime -
-                                 flight.actual_arrival_datetime).total_seconds() / 3600)
-        if hours_flown < 0:
-            return Response(status=status.HTTP_409_CONFLICT)
+class FlightMovements(APIView):
+    # Batch of departures and arrivals (see crm/movements.py), responds with the status of every event
+    def post(self, request):
+        events = request.data
+        if not isinstance(events, list):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        results = apply_movements(events)
+        return Response([{"flight": event.get("flight") if isinstance(event, dict) else None, "status": result}
+                         for event, result in zip(events, results)], status=status.HTTP_200_OK)
 
-        flight.aircraft.landed(hours_flown)
-        return Response(status=status.HTTP_200_OK)
+
+def conditional_response(request, data):
+    # 304 Not Modified if the client already has the data (If-None-Match)
+    etag = state_etag(data)
+    known = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in known or '*' in known:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(data, status=status.HTTP_200_OK, headers={'ETag': etag})
 
 
 class FuelView(APIView):
-    def get_object(self, pk):
-        try:
-            return AircraftDynamicInfo.objects.get(aircraft=pk)
-        except AircraftDynamicInfo.DoesNotExist:
+    # The latest fuel reading of the aircraft (see crm/telemetry.py)
+    def get(self, request, pk):
+        latest = latest_fuel(pk)
+        if latest is None:
             raise Http404
+        recorded, fuel_kg = latest
+        return conditional_response(request, {"fuel_remaining_kg": fuel_kg, "recorded": recorded})
+
+    def post(self, request, pk):
+        data = request.data if isinstance(request.data, dict) else {}
+        result, = record_fuel([{"aircraft": pk, "fuel_remaining_kg": data.get("fuel_remaining_kg"),
+                                "recorded": data.get("recorded")}])
+        if result == status.HTTP_404_NOT_FOUND:
+            raise Http404
+        return Response(status=result)
+
+
+class FleetFuelView(APIView):
+    # Batch of fuel readings, responds with the status of every reading
+    def post(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        results = record_fuel(items)
+        return Response([{"aircraft": item.get("aircraft") if isinstance(item, dict) else None, "status": result}
+                         for item, result in zip(items, results)], status=status.HTTP_200_OK)
 
+
+class AircraftStateView(APIView):
+    # Cabin capacities, crew requirements and fuel of the aircraft (see crm/fleet.py)
     def get(self, request, pk):
-        dyinfo = self.get_object(pk)
-        return Response({"fuel_remaining_kg": dyinfo.fuel_remaining_kg}, status=status.HTTP_200_OK)
+        state = aircraft_states([pk]).get(pk)
+        if state is None:
+            raise Http404
+        return conditional_response(request, state)
 
-    def post(self, request, pk):
-        dyinfo = self.get_object(pk)
-        dyinfo.update_fuel(request.data["fuel_remaining_kg"])
-        return Response(status=status.HTTP_200_OK)
+
+class FleetStateView(APIView):
+    # State of all the aircraft in one response
+    def get(self, request):
+        return conditional_response(request, [{"aircraft": pk, **state} for pk, state in aircraft_states().items()])
+
+
+def metrics(request):
+    # Scrape endpoint for the scheduling stages recorded by crm.metrics.PrometheusSink,
+    # for the staff users and the SCHEDULING_METRICS_TOKEN bearer token
+    token = settings.SCHEDULING_METRICS_TOKEN
+    authorized = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not (authorized or request.user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,88 @@
+import csv
+import io
+
+from django.db import connection, transaction
+
+from .compatibility import invalidate_warnings
+from .models import Flight, FlightPlan
+from .triggers import finish_run, is_superseded
+
+BATCH_SIZE = 5000
+
+
+def copy_supported() -> bool:
+    return connection.vendor == 'postgresql'
+
+
+def _copy(cursor, table: str, columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _copy_flights(schedule, batch_size):
+    flight_table = Flight._meta.db_table
+    through = Flight.employees.through
+    flight_columns = [Flight._meta.get_field(name).column for name in (
+        'id', 'planning_departure_datetime', 'planning_arrival_datetime', 'aircraft', 'flight_plan', 'canceled'
+    )]
+    through_columns = [through._meta.get_field(name).column for name in ('flight', 'employee')]
+    with connection.cursor() as cursor:
+        for start in range(0, len(schedule), batch_size):
+            batch = schedule[start:start + batch_size]
+            # COPY does not return ids, so they are taken from the sequence first
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                           [flight_table, len(batch)])
+            ids = [row[0] for row in cursor.fetchall()]
+            _copy(cursor, flight_table, flight_columns, (
+                (pk, departure, arrival, aircraft_pk, plan_pk, False)
+                for pk, (departure, arrival, aircraft_pk, plan_pk, crew) in zip(ids, batch)
+            ))
+            _copy(cursor, through._meta.db_table, through_columns, (
+                (pk, employee) for pk, row in zip(ids, batch) for employee in row[4]
+            ))
+
+
+def _bulk_create_flights(schedule, batch_size):
+    through = Flight.employees.through
+    for start in range(0, len(schedule), batch_size):
+        batch = schedule[start:start + batch_size]
+        flights = Flight.objects.bulk_create([
+            Flight(planning_departure_datetime=departure, planning_arrival_datetime=arrival,
+                   aircraft_id=aircraft_pk, flight_plan_id=plan_pk)
+            for departure, arrival, aircraft_pk, plan_pk, crew in batch
+        ])
+        through.objects.bulk_create([
+            through(flight_id=flight.pk, employee_id=employee)
+            for flight, row in zip(flights, batch) for employee in row[4]
+        ])
+
+
+def insert_flights(schedule, batch_size=BATCH_SIZE, use_copy=None):
+    # schedule: [(departure, arrival, aircraft pk, plan pk, crew pks)]
+    # Flights and their crews are inserted in batches, with COPY on PostgreSQL
+    schedule = list(schedule)
+    if use_copy is None:
+        use_copy = copy_supported()
+    if use_copy:
+        _copy_flights(schedule, batch_size)
+    else:
+        _bulk_create_flights(schedule, batch_size)
+
+
+@transaction.atomic
+def write_schedule(start_dt, schedule, batch_size=BATCH_SIZE, use_copy=None, run=None) -> bool:
+    # Replaces all the flights after start_dt with the schedule in a single transaction,
+    # so a dead worker never leaves a half-written schedule behind.
+    # run - the scheduling run of the schedule (see crm/triggers.py), nothing is written if it is superseded
+    if is_superseded(run, lock=True):
+        return False
+    Flight.objects.filter(canceled=False, planning_departure_datetime__gte=start_dt).delete()
+    insert_flights(schedule, batch_size, use_copy)
+    FlightPlan.objects.filter(pk__in={row[3] for row in schedule}).update(status=FlightPlan.SUCCESS)
+    invalidate_warnings()
+    finish_run(run)
+    return True